@@ -0,0 +1,297 @@
+""" Columnar export of order lines and vectorized sales aggregations
+
+export() streams every order line joined with its product, category, order
+and customer into a columnar file, a chunk of rows at a time, so memory use
+is bounded by the chunk size rather than the table:
+
+    parquet  Apache Parquet, one row group per chunk (needs pyarrow)
+    arrow    Arrow IPC file, one record batch per chunk (needs pyarrow)
+    npz      NumPy zip of per-chunk column arrays (needs numpy)
+
+aggregate() then sums quantity, revenue, cost and margin by product,
+category, day or customer state straight from the file with pyarrow's or
+NumPy's vectorized kernels, without touching the database:
+
+    >>> aggregate('sales.parquet', 'category')
+    [{'category_id': 1, 'category_name': 'Instruments', 'quantity': 12,
+      'revenue': 1234.5, 'cost': 800.0, 'margin': 434.5}, ...]
+
+Money is exported as float64; the totals are for reporting, the database
+stays the source of exact amounts. pyarrow and numpy are optional and only
+imported by the formats that use them.
+"""
+
+import json
+
+from sqlalchemy import select
+
+from models import db, Category, Customer, Order, OrderProduct, Product
+
+
+FORMATS = ('parquet', 'arrow', 'npz')
+DEFAULT_CHUNK_SIZE = 100000
+
+# (name, arrow type name, numpy dtype)
+COLUMNS = [
+    ('order_product_id', 'int64', 'int64'),
+    ('order_id', 'int64', 'int64'),
+    ('order_date', 'timestamp', 'datetime64[s]'),
+    ('product_id', 'int64', 'int64'),
+    ('product_name', 'string', 'U'),
+    ('category_id', 'int64', 'int64'),
+    ('category_name', 'string', 'U'),
+    ('customer_id', 'int64', 'int64'),
+    ('customer_state', 'string', 'U'),
+    ('quantity', 'int64', 'int64'),
+    ('price', 'float64', 'float64'),
+    ('cost', 'float64', 'float64'),
+    ('revenue', 'float64', 'float64'),
+    ('margin', 'float64', 'float64'),
+]
+COLUMN_NAMES = [name for name, arrow_type, dtype in COLUMNS]
+MEASURES = ('quantity', 'revenue', 'cost', 'margin')
+
+# grouping: (key column, label column or None)
+GROUPINGS = {
+    'product': ('product_id', 'product_name'),
+    'category': ('category_id', 'category_name'),
+    'day': ('day', None),
+    'state': ('customer_state', None),
+}
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError('The parquet and arrow formats need pyarrow; use npz or pip install pyarrow')
+    return pyarrow
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise RuntimeError('The npz format needs numpy; pip install numpy')
+    return numpy
+
+
+def guess_format(path):
+    """ Pick the format from a file name, defaulting to parquet """
+    for fmt, suffixes in (('arrow', ('.arrow', '.feather', '.ipc')), ('npz', ('.npz',))):
+        if path.lower().endswith(suffixes):
+            return fmt
+    return 'parquet'
+
+
+def sales_query():
+    """ One row per order line with everything the aggregations group on """
+    line, product, order = OrderProduct.__table__, Product.__table__, Order.__table__
+    category, customer = Category.__table__, Customer.__table__
+    return select([
+        line.c.id,
+        line.c.order_id,
+        order.c.order_date,
+        line.c.product_id,
+        product.c.product_name,
+        product.c.category_id,
+        category.c.category_name,
+        order.c.customer_id,
+        customer.c.state,
+        line.c.quantity,
+        product.c.product_price,
+        product.c.product_cost,
+    ]).select_from(
+        line.join(product, product.c.id == line.c.product_id)
+            .join(order, order.c.id == line.c.order_id)
+            .outerjoin(category, category.c.id == product.c.category_id)
+            .outerjoin(customer, customer.c.id == order.c.customer_id)
+    ).order_by(line.c.id)
+
+
+def read_chunks(connection, chunk_size=DEFAULT_CHUNK_SIZE):
+    """ Yield {column: list} chunks of the sales rows, keyed on order line id """
+    query = sales_query()
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            query.where(OrderProduct.__table__.c.id > last_id).limit(chunk_size)).fetchall()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        columns = {name: [] for name in COLUMN_NAMES}
+        for (line_id, order_id, order_date, product_id, product_name, category_id, category_name,
+             customer_id, state, quantity, price, cost) in rows:
+            price = float(price)
+            cost = float(cost)
+            columns['order_product_id'].append(line_id)
+            columns['order_id'].append(order_id)
+            columns['order_date'].append(order_date)
+            columns['product_id'].append(product_id)
+            columns['product_name'].append(product_name)
+            columns['category_id'].append(category_id)
+            columns['category_name'].append(category_name or '')
+            columns['customer_id'].append(customer_id)
+            columns['customer_state'].append(state or '')
+            columns['quantity'].append(quantity)
+            columns['price'].append(price)
+            columns['cost'].append(cost)
+            columns['revenue'].append(price * quantity)
+            columns['margin'].append((price - cost) * quantity)
+        yield columns
+
+
+class ArrowWriter(object):
+    """ Writes chunks as Parquet row groups or Arrow IPC record batches """
+
+    def __init__(self, path, fmt):
+        pa = _pyarrow()
+        self.pa = pa
+        types = {
+            'int64': pa.int64(),
+            'float64': pa.float64(),
+            'timestamp': pa.timestamp('s'),
+            # Parquet dictionary-encodes these by itself; IPC files cannot
+            # change a dictionary between batches, so none is forced here.
+            'string': pa.string(),
+        }
+        self.schema = pa.schema([(name, types[arrow_type]) for name, arrow_type, dtype in COLUMNS])
+        if fmt == 'parquet':
+            self.writer = pa.parquet.ParquetWriter(path, self.schema, compression='zstd')
+        else:
+            self.writer = pa.ipc.new_file(path, self.schema,
+                                          options=pa.ipc.IpcWriteOptions(compression='zstd'))
+
+    def write(self, columns):
+        arrays = [self.pa.array(columns[field.name], type=field.type) for field in self.schema]
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+class NpzWriter(object):
+    """ Writes each chunk's columns as column/NNNNNN.npy members of a zip """
+
+    def __init__(self, path, fmt='npz'):
+        import zipfile
+        self.np = _numpy()
+        self.zip = zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+        self.chunks = 0
+
+    def write(self, columns):
+        for name, arrow_type, dtype in COLUMNS:
+            array = self.np.array(columns[name], dtype=dtype)
+            with self.zip.open('{}/{:06d}.npy'.format(name, self.chunks), 'w', force_zip64=True) as member:
+                self.np.lib.format.write_array(member, array, allow_pickle=False)
+        self.chunks += 1
+
+    def close(self):
+        self.zip.writestr('meta.json', json.dumps({'chunks': self.chunks, 'columns': COLUMN_NAMES}))
+        self.zip.close()
+
+
+WRITERS = {
+    'parquet': ArrowWriter,
+    'arrow': ArrowWriter,
+    'npz': NpzWriter,
+}
+
+
+def export(path, fmt=None, chunk_size=DEFAULT_CHUNK_SIZE, connection=None):
+    """ Write the sales rows to path and return the number of rows written """
+    fmt = fmt or guess_format(path)
+    if fmt not in WRITERS:
+        raise ValueError('Unknown format {!r}, expected one of {}'.format(fmt, ', '.join(FORMATS)))
+    writer = WRITERS[fmt](path, fmt)
+    rows = 0
+    try:
+        for columns in read_chunks(connection or db.session, chunk_size):
+            writer.write(columns)
+            rows += len(columns['order_product_id'])
+    finally:
+        writer.close()
+    return rows
+
+
+def _arrow_aggregate(path, fmt, by):
+    pa = _pyarrow()
+    import pyarrow.compute as pc
+
+    key, label = GROUPINGS[by]
+    wanted = [column for column in (key, label) if column and column != 'day'] + list(MEASURES)
+    if by == 'day':
+        wanted.append('order_date')
+    if fmt == 'parquet':
+        table = pa.parquet.read_table(path, columns=wanted)
+    else:
+        with pa.memory_map(path) as source:
+            table = pa.ipc.open_file(source).read_all().select(wanted)
+    if by == 'day':
+        table = table.append_column('day', pc.cast(table['order_date'], pa.date32()))
+    keys = [column for column in (key, label) if column]
+    grouped = table.group_by(keys).aggregate([(measure, 'sum') for measure in MEASURES])
+    return grouped.rename_columns([
+        name[:-len('_sum')] if name.endswith('_sum') else name for name in grouped.column_names
+    ]).to_pylist()
+
+
+def _npz_aggregate(path, by):
+    import zipfile
+    np = _numpy()
+    key, label = GROUPINGS[by]
+    with zipfile.ZipFile(path) as archive:
+        chunks = json.loads(archive.read('meta.json'))['chunks']
+    totals = {}
+    labels = {}
+    with np.load(path, allow_pickle=False) as archive:
+        for number in range(chunks):
+            def column(name):
+                return archive['{}/{:06d}'.format(name, number)]
+            keys = column('order_date').astype('datetime64[D]') if by == 'day' else column(key)
+            unique, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+            # tolist() for plain Python floats, as the arrow formats return.
+            sums = [np.bincount(inverse, weights=column(measure), minlength=len(unique)).tolist()
+                    for measure in MEASURES]
+            if label:
+                names = column(label)[first]
+            # NaT, the day of an order without a date, comes back as None;
+            # however many NaT entries unique() keeps, they add to one group.
+            for position, value in enumerate(unique.tolist()):
+                total = totals.setdefault(value, [0.0] * len(MEASURES))
+                for index, measure_sums in enumerate(sums):
+                    total[index] += measure_sums[position]
+                if label:
+                    labels.setdefault(value, str(names[position]))
+
+    rows = []
+    for value, total in totals.items():
+        row = {key: value}
+        if label:
+            row[label] = labels[value]
+        row.update(zip(MEASURES, total))
+        row['quantity'] = int(row['quantity'])
+        rows.append(row)
+    return rows
+
+
+def aggregate(path, by, fmt=None):
+    """ Sum the measures of the exported file at path grouped by product,
+    category, day or state; rows come back sorted by the group key """
+    if by not in GROUPINGS:
+        raise ValueError('Unknown grouping {!r}, expected one of {}'.format(by, ', '.join(GROUPINGS)))
+    fmt = fmt or guess_format(path)
+    if fmt == 'npz':
+        rows = _npz_aggregate(path, by)
+    elif fmt in ('parquet', 'arrow'):
+        rows = _arrow_aggregate(path, fmt, by)
+    else:
+        raise ValueError('Unknown format {!r}, expected one of {}'.format(fmt, ', '.join(FORMATS)))
+    for row in rows:
+        for measure in MEASURES[1:]:
+            row[measure] = round(row[measure], 2)
+    key = GROUPINGS[by][0]
+    # Lines of orders without a date are grouped under day None, sorted last.
+    return sorted(rows, key=lambda row: (row[key] is None, row[key]))
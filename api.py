@@ -0,0 +1,210 @@
+""" Generic JSON resources for the versioned /api/v1 endpoints
+
+A Resource wraps one model with the same row validator the HTML forms and
+bulk imports use, and answers every request with a fixed number of
+statements however many rows it touches:
+
+    GET   /api/v1/products?fields=id,product_name&after=...&limit=50
+    GET   /api/v1/products?ids=3,1,2
+    GET   /api/v1/products/3
+    POST  /api/v1/products          one object, or a list of objects
+    PATCH /api/v1/products          a list of objects with their id
+    PATCH /api/v1/products/3        one object
+
+Only the requested fields are selected, id lists and reference checks go
+through IN batches, and writes are all or nothing: a batch with one
+invalid item is rejected with a per-item error list and nothing is
+written. PATCH merges the given fields over the stored row and runs the
+full validator on the result, so rules spanning fields (such as the price
+floor over cost) see the final values.
+"""
+
+from datetime import date, datetime
+from decimal import Decimal
+
+from bulk import LOOKUP_BATCH_SIZE, existing_keys
+from pagination import keyset_page
+
+
+class ApiError(Exception):
+    """ An error answered as {"error": message, "details": details} with status """
+
+    def __init__(self, status, message, details=None):
+        super(ApiError, self).__init__(message)
+        self.status = status
+        self.message = message
+        self.details = details
+
+    def as_dict(self):
+        body = {'error': self.message}
+        if self.details is not None:
+            body['details'] = self.details
+        return body
+
+
+def encode(value):
+    """ JSON-friendly form of a column value """
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+def parse_ids(value, maximum):
+    """ Read a comma separated id list, keeping the order and dropping repeats """
+    ids = []
+    seen = set()
+    try:
+        for part in value.split(','):
+            if part.strip():
+                id = int(part)
+                if id not in seen:
+                    seen.add(id)
+                    ids.append(id)
+    except ValueError:
+        raise ApiError(400, 'ids must be a comma separated list of integers')
+    if len(ids) > maximum:
+        raise ApiError(400, 'At most {} ids per request'.format(maximum))
+    return ids
+
+
+def _batches(values, size=LOOKUP_BATCH_SIZE):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+class Resource(object):
+    """ One model exposed through the API
+
+    validate(row) returns the values to store or raises ValueError, as for
+    bulk imports. references maps a validated field to the column it must
+    exist in. filters names the fields a listing can be narrowed by with
+    ?field=value. read_only fields are returned but rejected in writes.
+    after_write(objects, previous) runs in the transaction
+    after a write is flushed; previous holds the encoded rows as they were
+    before an update and is empty for an insert.
+    """
+
+    def __init__(self, model, validate, references=None, filters=(), read_only=(), after_write=None):
+        self.model = model
+        self.table = model.__table__
+        self.key = self.table.c.id
+        self.fields = [column.key for column in self.table.columns]
+        self.validate = validate
+        self.references = references or {}
+        self.filters = filters
+        self.read_only = read_only
+        self.after_write = after_write
+
+    def select_fields(self, value):
+        """ Field names from ?fields=, always led by id """
+        if not value:
+            return self.fields
+        wanted = ['id']
+        for field in value.split(','):
+            field = field.strip()
+            if field and field not in wanted:
+                wanted.append(field)
+        unknown = [field for field in wanted if field not in self.fields]
+        if unknown:
+            raise ApiError(400, 'Unknown fields: {}'.format(', '.join(unknown)))
+        return wanted
+
+    def dump(self, row, fields=None):
+        return {field: encode(getattr(row, field)) for field in fields or self.fields}
+
+    def _query(self, session, fields):
+        return session.query(*[self.table.c[field] for field in fields])
+
+    def list(self, session, fields, args, cursor=None, limit=50):
+        """ A keyset Page of rows, narrowed by the resource's filters found in args """
+        query = self._query(session, fields)
+        for field in self.filters:
+            if args.get(field):
+                try:
+                    query = query.filter(self.table.c[field] == int(args[field]))
+                except ValueError:
+                    raise ApiError(400, '{} must be an integer'.format(field))
+        try:
+            return keyset_page(query, [self.key], cursor, limit)
+        except ValueError:
+            raise ApiError(400, 'Invalid cursor')
+
+    def get(self, session, ids, fields):
+        """ (rows in the order of ids, ids that do not exist) """
+        found = {}
+        for batch in _batches(ids):
+            for row in self._query(session, fields).filter(self.key.in_(batch)):
+                found[row.id] = row
+        return [found[id] for id in ids if id in found], [id for id in ids if id not in found]
+
+    def _validate(self, session, items, current):
+        valid = []
+        errors = []
+        for index, (item, row) in enumerate(zip(items, current)):
+            unknown = sorted(set(item) - set(self.fields) - {'id'})
+            if unknown:
+                errors.append({'index': index, 'error': 'Unknown fields: {}'.format(', '.join(unknown))})
+                continue
+            read_only = sorted(set(item) & set(self.read_only))
+            if read_only:
+                errors.append({'index': index, 'error': 'Read only fields: {}'.format(', '.join(read_only))})
+                continue
+            merged = dict(row)
+            merged.update((field, value) for field, value in item.items() if field != 'id')
+            try:
+                valid.append((index, self.validate(merged)))
+            except (KeyError, TypeError, ValueError, ArithmeticError) as ex:
+                errors.append({'index': index, 'error': '{}: {}'.format(type(ex).__name__, ex)})
+
+        for field, column in self.references.items():
+            wanted = {row[field] for index, row in valid if row.get(field) is not None}
+            missing = wanted - existing_keys(session, column, wanted)
+            errors.extend({'index': index, 'error': 'unknown {} {}'.format(field, row[field])}
+                          for index, row in valid if row.get(field) in missing)
+        if errors:
+            raise ApiError(400, 'Validation failed, nothing was written',
+                           sorted(errors, key=lambda error: error['index']))
+        return [row for index, row in valid]
+
+    def create(self, session, items):
+        """ Insert every item or none; returns the new objects, flushed """
+        for index, item in enumerate(items):
+            if 'id' in item:
+                raise ApiError(400, 'Validation failed, nothing was written',
+                               [{'index': index, 'error': 'id is assigned by the server'}])
+        values = self._validate(session, items, [{}] * len(items))
+        objects = [self.model(**row) for row in values]
+        session.add_all(objects)
+        session.flush()
+        if self.after_write is not None:
+            self.after_write(objects, [])
+        return objects
+
+    def update(self, session, items):
+        """ Apply every partial item to the row named by its id, or none """
+        try:
+            ids = [int(item['id']) for item in items]
+        except (KeyError, TypeError, ValueError):
+            raise ApiError(400, 'Every item needs an integer id')
+        if len(set(ids)) != len(ids):
+            raise ApiError(400, 'An id may appear only once per request')
+
+        found = {}
+        for batch in _batches(ids):
+            for obj in session.query(self.model).filter(self.key.in_(batch)):
+                found[obj.id] = obj
+        missing = [id for id in ids if id not in found]
+        if missing:
+            raise ApiError(404, 'Unknown ids', missing)
+
+        objects = [found[id] for id in ids]
+        previous = [self.dump(obj) for obj in objects]
+        for obj, row in zip(objects, self._validate(session, items, previous)):
+            for field, value in row.items():
+                setattr(obj, field, value)
+        session.flush()
+        if self.after_write is not None:
+            self.after_write(objects, previous)
+        return objects
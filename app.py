@@ -1,27 +1,88 @@
-from flask import Flask, render_template, request, redirect, url_for, flash
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func
-from datetime import datetime
-from flask_login import UserMixin, LoginManager, login_user, login_required, logout_user, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
+import io
+import math
+import os
+import tempfile
+from functools import wraps
+
+import click
+from flask import Blueprint, Flask, Response, abort, current_app, jsonify, render_template, request, redirect, stream_with_context, url_for, flash
+from datetime import datetime, timedelta
+from flask_login import LoginManager, login_user, login_required, logout_user, current_user
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, BooleanField, SubmitField
-from wtforms.validators import DataRequired, ValidationError, Email
-
-
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///shop24.db'
-app.config['TEMPLATES_AUTO_RELOAD'] = True
-app.config['SECRET_KEY'] = "What is going on"
-db = SQLAlchemy(app)
+from wtforms.validators import DataRequired, Email
+
+import analytics
+import api
+import bulk
+import httpcache
+import inventory
+import jobs
+import migrations
+import pricing
+import queryplan
+import search
+import security
+from assets import Assets
+from cache import Cache
+from config import get_config
+from instrumentation import Instrumentation
+from models import (db, engine_options, configure_engine, eager, add_product_sales, refresh_product_sales,
+                    merge_order_lines, order_history_query,
+                    User, Product, Order, OrderProduct, ProductSales, Customer, Category, Job, PricingRule)
+from pagination import keyset_page, page_size
+
+
+main = Blueprint('main', __name__, cli_group=None)
+assets = Assets()
+cache = Cache()
+http_cache = httpcache.HttpCache()
+job_queue = jobs.JobQueue()
+instrumentation = Instrumentation()
+password_hasher = security.PasswordHasher()
+login_limiter = security.RateLimiter()
+user_cache = security.UserCache()
 login_manager = LoginManager()
-login_manager.init_app(app)
-login_manager.login_view = 'login'
+login_manager.login_view = 'main.login'
+
+
+def create_app(config=None):
+    """Build the shop24 application.
+
+    config is a config class or mapping applied over the environment
+    selected one, which is what tests and scripts use to point the app at
+    another database.
+    """
+    app = Flask(__name__)
+    app.config.from_object(get_config())
+    if isinstance(config, dict):
+        app.config.update(config)
+    elif config is not None:
+        app.config.from_object(config)
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config))
+    if not app.config.get('SECRET_KEY'):
+        raise RuntimeError('SECRET_KEY must be set to sign sessions')
+
+    db.init_app(app)
+    cache.init_app(app)
+    job_queue.init_app(app)
+    password_hasher.init_app(app)
+    login_limiter.init_app(app)
+    user_cache.init_app(app)
+    login_manager.init_app(app)
+    app.register_blueprint(main)
+    assets.init_app(app)
+
+    with app.app_context():
+        configure_engine(db.engine, app.config)
+        http_cache.init_app(app, db.engine, cache)
+        instrumentation.init_app(app, db.engine)
+    return app
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return user_cache.load(int(user_id))
 
 
 class Registration(FlaskForm):
@@ -30,15 +91,18 @@ class Registration(FlaskForm):
     password = PasswordField('Password', validators=[DataRequired()])
     submit = SubmitField('Register Account')
 
-    def validate_username(self, username):
-        user = User.query.filter_by(username=username.data).first()
-        if user is not None:
-            raise ValidationError('Username already taken. Choose another.')
-
-    def validate_email(self, email):
-        user = User.query.filter_by(email=email.data).first()
-        if user is not None:
-            raise ValidationError('Email already used.Choose another.')
+    def validate(self):
+        """Run the field validators, then check both unique columns in one query."""
+        if not super(Registration, self).validate():
+            return False
+        taken = db.session.query(User.username, User.email).filter(
+            (User.username == self.username.data) | (User.email == self.email.data)).all()
+        for username, email in taken:
+            if username == self.username.data:
+                self.username.errors.append('Username already taken. Choose another.')
+            if email == self.email.data:
+                self.email.errors.append('Email already used.Choose another.')
+        return not taken
 
 
 class LoginForm(FlaskForm):
@@ -48,124 +112,133 @@ class LoginForm(FlaskForm):
     submit = SubmitField('Sign In')
 
 
-class User(UserMixin, db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(30), unique=True)
-    email = db.Column(db.String(30), unique=True)
-    password_hash = db.Column(db.String(128))
-
-
-    def setPW(self, password):
-        self.password_hash = generate_password_hash(password)
+def all_categories():
+    """Every category as (id, category_name) dicts, cached until a category changes."""
+    return cache.get_or_set('categories', lambda: [
+        {'id': id, 'category_name': name}
+        for id, name in db.session.query(Category.id, Category.category_name).order_by(Category.id)
+    ])
 
-    def checkPW(self, password):
-        return check_password_hash(self.password_hash, password)
 
+def all_products():
+    """The product catalog used by pickers, cached until a product changes."""
+    return cache.get_or_set('products', lambda: [
+        {'id': id, 'product_name': name, 'product_price': price, 'product_cost': cost}
+        for id, name, price, cost in db.session.query(
+            Product.id, Product.product_name, Product.product_price, Product.product_cost
+        ).order_by(Product.id)
+    ])
 
-class Account(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(200), nullable=False)
-    password = db.Column(db.String(200), nullable=False)
-    email = db.Column(db.String(200), nullable=False)
-    street = db.Column(db.String(200), nullable=False)
-    city = db.Column(db.String(200), nullable=False)
 
-    def __repr__(self):
-        return '<Task %r>' % self.id
+def related(*relationships):
+    """Loader options for relationships using the configured EAGER_LOADING strategy."""
+    return eager(current_app.config['EAGER_LOADING'], *relationships)
 
 
-class Product(db.Model):
-    id =                    db.Column(db.Integer, primary_key=True)
-    product_name =          db.Column(db.String(200), nullable=False)
-    product_description =   db.Column(db.String(200), nullable=False)
-    product_price =         db.Column(db.Numeric(10, 2), nullable=False)
-    product_cost =          db.Column(db.Numeric(10, 2), nullable=False)
-    date_created =          db.Column(db.DateTime, default=datetime.utcnow)
-    category_id =           db.Column(db.Integer, db.ForeignKey('category.id'), nullable=False)
+def pricing_rules():
+    """The markup rules in force, cached until a rule changes."""
+    return cache.get_or_set('pricing_rules', lambda: pricing.load_rules(current_app.config['DEFAULT_MARKUP']))
 
-    def __repr__(self):
-        return '<Task %r>' % self.id
 
+def price_floor(price, cost, category_id=None):
+    """Raise price to at least the markup over cost of its category's pricing rule."""
+    return pricing.apply_floor(price, cost, pricing_rules().markup_for(category_id))
 
-class Order(db.Model):
-    id =                  db.Column(db.Integer, primary_key=True)
-    customer_id =          db.Column(db.Integer, db.ForeignKey('account.id'), nullable=False)
-    order_date =          db.Column(db.DateTime, default=datetime.utcnow)
-    shipment_priority =   db.Column(db.Integer)
 
-    def __repr__(self):
-        return '<Task %r>' % self.id
+def stock_level(values):
+    """Read an optional non-negative ?stock_on_hand=; blank means not tracked."""
+    stock = _optional_number(values, 'stock_on_hand', int)
+    if stock is not None and stock < 0:
+        abort(400)
+    return stock
 
 
-class OrderProduct(db.Model):
-    id =           db.Column(db.Integer, primary_key=True)
-    order_id =     db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False)
-    product_id =   db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
-    quantity =     db.Column(db.Integer, nullable=False)
-
-    def __repr__(self):
-        return '<Task %r>' % self.id
+def paginate(query, *columns, descending=False):
+    """Return the keyset Page of query selected by ?after= and ?limit=."""
+    limit = page_size(request.args, current_app.config['PAGE_SIZE'], current_app.config['MAX_PAGE_SIZE'])
+    try:
+        return keyset_page(query, columns, request.args.get('after'), limit, descending)
+    except ValueError:
+        abort(400)
 
-class Customer(db.Model):
-    id           = db.Column(db.Integer, primary_key=True)
-    first_name   = db.Column(db.String(50), nullable=False)
-    last_name	 = db.Column(db.String(50), nullable=False)
-    email	 = db.Column(db.String(100), nullable=False)
-    phone        = db.Column(db.String(10), nullable=True)
-    street_addr  = db.Column(db.String(50), nullable=True)
-    state        = db.Column(db.String(2), nullable=True)
-    zipcode      = db.Column(db.String(5), nullable=True)
-    city         = db.Column(db.String(100), nullable=True)
 
-    def __repr__(self):
-        return '<Customer {}>'.format(self.id)
+def date_range(values):
+    """Parse ISO ?from= and ?to= bounds; a date-only 'to' includes that whole day."""
+    start = values.get('from') or None
+    end = values.get('to') or None
+    try:
+        if start is not None:
+            start = datetime.fromisoformat(start)
+        if end is not None:
+            date_only = len(end) == 10
+            end = datetime.fromisoformat(end)
+            if date_only:
+                end += timedelta(days=1)
+    except ValueError:
+        abort(400)
+    return start, end
 
-class Category(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    category_name = db.Column(db.String(200), nullable=False)
 
-    def __repr__(self):
-        return '<Task %r>' % self.id
+def order_history_page(customer_id, values):
+    start, end = date_range(values)
+    return paginate(order_history_query(customer_id, start, end),
+                    Order.order_date, Order.id, descending=True)
 
 
-@app.route('/registration', methods=['GET', 'POST'])
+@main.route('/registration', methods=['GET', 'POST'])
 def register():
     form = Registration()
     if form.validate_on_submit():
         user = User(username=form.username.data, email=form.email.data)
-        user.setPW(form.password.data)
+        try:
+            user.setPW(form.password.data)
+        except security.HashingBusy:
+            return "Error: The server is busy, please try again shortly", 503, {'Retry-After': '1'}
         db.session.add(user)
         db.session.commit()
         flash('You were successfully registered, please log in!')
-        return redirect(url_for('login'))
-    if request.method == 'POST' and not form.validate():
+        return redirect(url_for('main.login'))
+    if request.method == 'POST':
         flash("Unable to register, either your email or username is already in use. Please try again!")
     return render_template('registration.html', title='Registration', form=form)
 
 
-@app.route('/login', methods=['GET', 'POST'])
+@main.route('/login', methods=['GET', 'POST'])
 def login():
     form = LoginForm()
     if form.validate_on_submit():
+        wait = login_limiter.login_attempt(request.remote_addr, form.username.data)
+        if wait:
+            wait = int(math.ceil(wait))
+            flash("Too many login attempts. Please try again in {} seconds.".format(wait))
+            return render_template('login.html', title='Sign In', form=form), 429, {'Retry-After': str(wait)}
         user = User.query.filter_by(username=form.username.data).first()
-        if user is None or not user.checkPW(form.password.data):
+        try:
+            valid = user is not None and user.checkPW(form.password.data)
+        except security.HashingBusy:
+            return "Error: The server is busy, please try again shortly", 503, {'Retry-After': '1'}
+        if not valid:
             flash("Unable to login, either your username or password were incorrect. Please try again!")
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
+        if db.session.is_modified(user):
+            # checkPW upgraded a hash made with old parameters.
+            db.session.commit()
         login_user(user, remember=form.remember_me.data)
         flash('You were successfully logged in')
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     return render_template('login.html', title='Sign In', form=form)
 
 
-@app.route('/logout')
+@main.route('/logout')
 def logout():
     logout_user()
     print('You are now logged out!')
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
 
 
-@app.route("/", methods=['POST', 'GET'])
+@main.route("/", methods=['POST', 'GET'])
 @login_required
+@http_cache.conditional('product', 'category')
 def index():
     if request.method == 'POST':
         name = request.form['product_name']
@@ -174,8 +247,7 @@ def index():
         price = request.form['product_price']
         category = request.form['category_id']
 
-        if float(price) < (1.3 * float(cost)):
-            price = round((1.3 * float(cost)), 2)
+        price = price_floor(price, cost, category)
 
 
         new_product = Product(
@@ -186,29 +258,38 @@ def index():
             category_id=category
         )
 
-        print("Product data:")
-        print(new_product.id)
-        print(new_product.product_name)
-        print(new_product.product_description)
-        print(new_product.product_price)
+        current_app.logger.debug('Product data: %s %s %s', new_product.product_name,
+                                 new_product.product_description, new_product.product_price)
 
+        stock = stock_level(request.form)
         try:
             db.session.add(new_product)
+            if stock is not None:
+                db.session.flush()
+                inventory.set_stock(new_product.id, stock)
             db.session.commit()
+            cache.invalidate('products')
             return redirect('/')
         except:
             return "Error: There was a problem adding the new product data"
     else:
-        tasks = Product.query.order_by(Product.date_created).all()
-        categories= Category.query.all()
-        return render_template("index.html", tasks = tasks, categories=categories)
-
-
-@app.route('/customers', methods=['POST', 'GET'])
+        product_table = http_cache.fragment(
+            'product_table', ('product', 'category'),
+            lambda: render_template('_product_table.html', tasks=paginate(
+                Product.query.options(*related(Product.category)), Product.date_created, Product.id)),
+            vary=request.query_string)
+        category_options = http_cache.fragment(
+            'category_options', ('category',),
+            lambda: render_template('_category_options.html', categories=all_categories()))
+        return render_template("index.html", product_table=product_table, category_options=category_options)
+
+
+@main.route('/customers', methods=['POST', 'GET'])
 @login_required
+@http_cache.conditional('customer')
 def customers():
-    customers = Customer.query.all()
     if request.method == 'GET':
+        customers = paginate(Customer.query, Customer.id)
         return render_template('customers.html', results = customers)
     elif request.method == 'POST':
         customer = Customer(first_name     = request.form['first_name'],
@@ -229,19 +310,22 @@ def customers():
         # return render_template('customers.html', results = customers)
 
 
-@app.route('/delete/<int:id>')
+@main.route('/delete/<int:id>')
 def delete(id):
     task_to_delete = Product.query.get_or_404(id)
 
     try:
         db.session.delete(task_to_delete)
+        db.session.flush()
+        refresh_product_sales(id)
         db.session.commit()
+        cache.invalidate('products')
         return redirect('/')
     except:
         return 'There was a problem deleting that task'
 
 
-@app.route('/update/<int:id>', methods=['GET', 'POST'])
+@main.route('/update/<int:id>', methods=['GET', 'POST'])
 def update(id):
     product = Product.query.get_or_404(id)
 
@@ -252,22 +336,34 @@ def update(id):
         product.product_cost = request.form['product_cost']
         product.category_id = request.form['category_id']
 
-        if float(product.product_price) < (1.3 * float(request.form['product_cost'])):
-            product.product_price = round((1.3 * float(request.form['product_cost'])), 2)
-            
+        product.product_price = price_floor(product.product_price, request.form['product_cost'],
+                                            request.form['category_id'])
+        stock = stock_level(request.form)
+        # The form is pre-filled with the level it was rendered with, so only
+        # a changed value is a new count; writing back an unchanged one would
+        # undo every reservation made since.
+        counted = ('stock_on_hand' in request.form
+                   and stock != _optional_number(request.form, 'stock_on_hand_shown', int))
+
         try:
+            db.session.flush()
+            if counted:
+                inventory.set_stock(id, stock)
+            refresh_product_sales(id)
             db.session.commit()
+            cache.invalidate('products')
             return redirect('/')
         except:
             return 'There was an issue updating your task'
 
     else:
-        categories= Category.query.all()
+        categories = all_categories()
         return render_template('update.html', product=product, categories=categories)
 
 
-@app.route("/orders", methods=['POST', 'GET'])
+@main.route("/orders", methods=['POST', 'GET'])
 @login_required
+@http_cache.conditional('order', 'customer')
 def orders():
     if request.method == 'POST':
         customerID = request.form['customer_id']
@@ -286,13 +382,24 @@ def orders():
             print("Error: ", ex)
             return "Error: There was a problem adding the new order data"
     else:
-        tasks = Order.query.order_by(Order.shipment_priority).all()
-        products = Product.query.all()
-        customers = Customer.query.all()
-        return render_template("orders.html", tasks = tasks, products=products, customers=customers)
-
-
-@app.route('/orders/delete/<int:id>')
+        # One joined query with only the columns the listing shows, so the
+        # template no longer has to scan every customer for every order.
+        tasks = paginate(db.session.query(
+            Order.id,
+            Order.shipment_priority,
+            Order.order_date,
+            Customer.first_name,
+            Customer.last_name,
+        ).outerjoin(Customer, Customer.id == Order.customer_id),
+            Order.shipment_priority, Order.id)
+        customer_options = http_cache.fragment(
+            'customer_options', ('customer',),
+            lambda: render_template('_customer_options.html', customers=db.session.query(
+                Customer.id, Customer.first_name, Customer.last_name).order_by(Customer.id)))
+        return render_template("orders.html", tasks = tasks, customer_options=customer_options)
+
+
+@main.route('/orders/delete/<int:id>')
 def ordersDelete(id):
     task_to_delete = Order.query.get_or_404(id)
 
@@ -304,7 +411,7 @@ def ordersDelete(id):
         return 'There was a problem deleting that task'
 
 
-@app.route('/orders/update/<int:id>', methods=['GET', 'POST'])
+@main.route('/orders/update/<int:id>', methods=['GET', 'POST'])
 def ordersUpdate(id):
     order = Order.query.get_or_404(id)
     customers= Customer.query.all()
@@ -313,8 +420,7 @@ def ordersUpdate(id):
         order.customer_id = request.form['customer_id']
         order.shipment_priority = request.form['shipment_priority']
 
-        print("order: ", order.customer_id)
-        print("order: ", order.shipment_priority)
+        current_app.logger.debug('order: %s %s', order.customer_id, order.shipment_priority)
 
         try:
             db.session.commit()
@@ -328,7 +434,7 @@ def ordersUpdate(id):
         return render_template('update_order.html', task=order, customers=customers)
 
 
-@app.route("/order_product", methods=['POST', 'GET'])
+@main.route("/order_product", methods=['POST', 'GET'])
 def orderproduct():
     if request.method == 'POST':
         if 'order_id' in request.form:
@@ -346,67 +452,222 @@ def orderproduct():
 
             try:
                 db.session.add(newOrderProduct)
+                db.session.flush()
+                inventory.reserve_lines([(newOrderProduct, None, 0)])
+                add_product_sales({productID: quantity})
                 db.session.commit()
                 # return render_template('orderproduct.html')
                 return redirect(url)
+            except inventory.OutOfStock as ex:
+                db.session.rollback()
+                return "Error: {}".format(ex), 409
             except Exception as ex:
                 print("Error: ", ex)
                 return "Error: There was a problem adding the new order data"
         elif 'id' in request.form:
-
-            orderID = request.form['id']
-            tasks = OrderProduct.query.filter(OrderProduct.order_id == orderID).order_by(OrderProduct.id).all()
-            return render_template("order_product.html",tasks=tasks, orderID = orderID)
+            return order_lines_page(request.form['id'])
     elif request.method == 'GET':
-        orderID = request.args['id']
-        tasks = OrderProduct.query.filter(OrderProduct.order_id == orderID).order_by(OrderProduct.id).all()
-        products = Product.query.all()
-        return render_template("order_product.html",tasks=tasks, orderID = orderID, products=products)
+        return order_lines_page(request.args['id'])
+
+
+def order_lines_page(orderID):
+    """Render an order's lines; their products come from one extra query at most."""
+    tasks = OrderProduct.query \
+        .options(*related(OrderProduct.product)) \
+        .filter(OrderProduct.order_id == orderID) \
+        .order_by(OrderProduct.id) \
+        .all()
+    product_options = http_cache.fragment(
+        'product_options', ('product',),
+        lambda: render_template('_product_options.html', products=all_products()))
+    return render_template("order_product.html", tasks=tasks, orderID=orderID, product_options=product_options)
+
+
+def basket_from_request():
+    """Read (order id, {product_id: quantity}) from a JSON or form basket.
+
+    JSON bodies look like {"order_id": 1, "lines": [{"product_id": 2,
+    "quantity": 3}, ...]}; forms repeat product_id/quantity fields and rows
+    with an empty quantity are skipped. Repeated products are summed.
+    """
+    if request.is_json:
+        data = request.get_json()
+        if not isinstance(data, dict) or not isinstance(data.get('lines'), list):
+            raise ValueError('Expected {"order_id": ..., "lines": [...]}')
+        order_id = data.get('order_id')
+        pairs = [(line.get('product_id'), line.get('quantity')) for line in data['lines']]
+    else:
+        order_id = request.form.get('order_id')
+        pairs = [(product_id, quantity) for product_id, quantity
+                 in zip(request.form.getlist('product_id'), request.form.getlist('quantity'))
+                 if quantity.strip()]
+
+    try:
+        order_id = int(order_id)
+        quantities = {}
+        for product_id, quantity in pairs:
+            product_id, quantity = int(product_id), int(quantity)
+            if quantity < 1:
+                raise ValueError('Quantities must be positive')
+            quantities[product_id] = quantities.get(product_id, 0) + quantity
+    except (TypeError, ValueError) as ex:
+        raise ValueError('Invalid basket: {}'.format(ex))
+
+    if not quantities:
+        raise ValueError('The basket is empty')
+    if len(quantities) > current_app.config['MAX_BASKET_LINES']:
+        raise ValueError('A basket may hold at most {} products'.format(current_app.config['MAX_BASKET_LINES']))
+    return order_id, quantities
+
+
+@main.route("/order_product/batch", methods=['POST'])
+def orderProductBatch():
+    """Add a whole basket of product/quantity pairs to one order in one transaction."""
+    try:
+        orderID, quantities = basket_from_request()
+    except ValueError as ex:
+        if request.is_json:
+            return jsonify(error=str(ex)), 400
+        return "Error: {}".format(ex), 400
+    Order.query.get_or_404(orderID)
+
+    try:
+        lines = merge_order_lines(orderID, quantities)
+        inventory.reserve_lines([(line, line.product_id, line.quantity - quantities[line.product_id])
+                                 for line in lines])
+        db.session.commit()
+    except inventory.OutOfStock as ex:
+        db.session.rollback()
+        if request.is_json:
+            return jsonify(error=str(ex), product_id=ex.product_id, available=ex.available), 409
+        return "Error: {}".format(ex), 409
+    except ValueError as ex:
+        db.session.rollback()
+        if request.is_json:
+            return jsonify(error=str(ex)), 400
+        return "Error: {}".format(ex), 400
+    except Exception:
+        db.session.rollback()
+        current_app.logger.exception("adding order lines to order %s failed", orderID)
+        return "Error: There was a problem adding the new order data", 500
+
+    if request.is_json:
+        return jsonify(order_id=orderID, lines=[
+            {'id': line.id, 'product_id': line.product_id, 'quantity': line.quantity}
+            for line in lines
+        ])
+    return redirect('/order_product?id=' + str(orderID))
+
+
+def units_sold(changes):
+    """{product_id: units} that [(line, previous_product_id, previous_quantity)] add to sales."""
+    units = {}
+    for line, previous_product_id, previous_quantity in changes:
+        # A line moved to another product takes its units back from the old one.
+        for product_id, change in inventory.line_moves(line, previous_product_id, previous_quantity):
+            units[product_id] = units.get(product_id, 0) - change
+    return units
+
+
+def _optional_number(values, name, convert=float):
+    value = values.get(name, '').strip()
+    if not value:
+        return None
+    try:
+        return convert(value)
+    except ValueError:
+        abort(400)
+
+
+@main.route('/search')
+@main.route('/search.json')
+@login_required
+def product_search():
+    """Ranked product search by name, description and category.
+
+    ?q= words match as prefixes; ?category=, ?min_price= and ?max_price=
+    filter; ?after= and ?limit= page through the results.
+    """
+    query = request.args.get('q', '')
+    category_id = _optional_number(request.args, 'category', int)
+    min_price = _optional_number(request.args, 'min_price')
+    max_price = _optional_number(request.args, 'max_price')
+    limit = page_size(request.args, current_app.config['PAGE_SIZE'], current_app.config['MAX_PAGE_SIZE'])
+    try:
+        results = search.search(query, category_id, min_price, max_price,
+                                request.args.get('after'), limit)
+    except (TypeError, ValueError):
+        abort(400)
+
+    if request.path.endswith('.json'):
+        return jsonify(
+            products=[{
+                'id': row.id,
+                'product_name': row.product_name,
+                'product_description': row.product_description,
+                'product_price': '{:.2f}'.format(row.product_price),
+                'category_id': row.category_id,
+                'category_name': row.category_name,
+            } for row in results],
+            next=results.next_cursor,
+        )
+    return render_template('search.html', results=results, query=query, categories=all_categories(),
+                           category_id=category_id, min_price=request.args.get('min_price', ''),
+                           max_price=request.args.get('max_price', ''))
 
 
-@app.route("/vendors")
+@main.route("/vendors")
 @login_required
 def vendors():
     return render_template("vendors.html")
 
 
-@app.route("/profile")
+@main.route("/profile")
 @login_required
 def profile():
     return render_template("profile.html")
 
 
-@app.route("/contact")
+@main.route("/contact")
 def contact():
     return render_template("contact.html")
 
 
-@app.route('/order_product/delete/<int:orderID>/<int:id>')
+@main.route('/order_product/delete/<int:orderID>/<int:id>')
 def orderProductDelete(orderID, id):
-    print("id: ", id)
     url = '/order_product?id=' + str(orderID)
-    print("url: ", url)
     task_to_delete = OrderProduct.query.get_or_404(id)
-    print("task_to_delete: ", task_to_delete)
+    current_app.logger.debug('Deleting %r from order %s', task_to_delete, orderID)
     try:
+        inventory.release_line(task_to_delete)
         db.session.delete(task_to_delete)
+        add_product_sales({task_to_delete.product_id: -task_to_delete.quantity})
         db.session.commit()
         return redirect(url)
     except:
         return 'There was a problem deleting that task'
 
 
-@app.route('/order_product/update/<int:orderID>/<int:id>')
+@main.route('/order_product/update/<int:orderID>/<int:id>', methods=['GET', 'POST'])
 def orderProductUpdate(orderID, id):
     url = '/order_product?id=' + str(orderID)
     order_product = OrderProduct.query.get_or_404(id)
     if request.method == 'POST':
+        previous_product_id = order_product.product_id
+        previous_quantity = order_product.quantity
         order_product.product_id = request.form['product_id']
         order_product.quantity = request.form['quantity']
 
         try:
+            db.session.flush()
+            changes = [(order_product, previous_product_id, previous_quantity)]
+            inventory.reserve_lines(changes)
+            add_product_sales(units_sold(changes))
             db.session.commit()
             return redirect(url)
+        except inventory.OutOfStock as ex:
+            db.session.rollback()
+            return "Error: {}".format(ex), 409
         except Exception as e:
             print(e)
             return 'There was an issue updating your task'
@@ -417,22 +678,52 @@ def orderProductUpdate(orderID, id):
         return render_template('update_order_product.html', orderID=orderID, id=id)
 
 
-@app.route('/metrics')
+@main.route('/metrics')
 @login_required
+@http_cache.conditional('product_sales')
 def metrics():
-    metrics = db.session.query(OrderProduct.product_id, func.sum(OrderProduct.quantity).label('quantity')).group_by(OrderProduct.product_id).all()
-    products = Product.query.all()
+    metrics_table = http_cache.fragment(
+        'metrics_table', ('product_sales',),
+        lambda: render_template('_metrics_table.html',
+                                tasks=ProductSales.query.order_by(ProductSales.product_id).all()))
     if request.method == 'GET':
-        return render_template('metrics.html', tasks=metrics, products=products)
+        return render_template('metrics.html', metrics_table=metrics_table)
+
+
+@main.route('/metrics/rebuild', methods=['POST'])
+@login_required
+def metrics_rebuild():
+    job = job_queue.enqueue('rebuild_metrics')
+    return redirect(url_for('main.job', id=job.id))
+
 
+# Keeps IN (...) lists under SQLite's bound parameter limit.
+JOB_CHUNK_SIZE = 500
 
-@app.route('/orderhistory', methods=['POST', 'GET'])
+
+@job_queue.task('rebuild_metrics')
+def rebuild_metrics_job(run):
+    """Rebuild the ProductSales rollup a chunk of products per transaction."""
+    ProductSales.query \
+        .filter(~ProductSales.product_id.in_(db.session.query(Product.id))) \
+        .delete(synchronize_session=False)
+    product_ids = [product_id for (product_id,) in db.session.query(Product.id).order_by(Product.id)]
+    run.progress(0, len(product_ids))
+    for start in range(0, len(product_ids), JOB_CHUNK_SIZE):
+        refresh_product_sales(*product_ids[start:start + JOB_CHUNK_SIZE])
+        run.progress(min(start + JOB_CHUNK_SIZE, len(product_ids)))
+    return {'products': len(product_ids)}
+
+
+@main.route('/orderhistory', methods=['POST', 'GET'])
 def orderHistory():
-    if request.method == 'POST':
-        accountID = request.form['searched_account_id']
-        tasks = Order.query.filter(Order.customer_id == accountID).order_by(Order.shipment_priority).all()
+    values = request.form if request.method == 'POST' else request.args
+    if values.get('searched_account_id'):
+        accountID = values['searched_account_id']
+        tasks = order_history_page(accountID, values)
         try:
-            return render_template('orderhistorydetails.html', tasks=tasks)
+            return render_template('orderhistorydetails.html', tasks=tasks, accountID=accountID,
+                                   date_from=values.get('from', ''), date_to=values.get('to', ''))
         except Exception as ex:
             print("Error: ", ex)
             return "Error: There was a problem viewing the order history"
@@ -440,8 +731,30 @@ def orderHistory():
         return render_template('orderhistory.html')
 
 
-@app.route("/category", methods=['POST', 'GET'])
+@main.route('/orderhistory/<int:customer_id>')
+def orderHistoryApi(customer_id):
+    """One page of a customer's orders with line counts and totals, as JSON.
+
+    Supports ?from=/?to= ISO date bounds and ?after=/?limit= pagination.
+    """
+    page = order_history_page(customer_id, request.args)
+    return jsonify(
+        customer_id=customer_id,
+        orders=[{
+            'id': order.id,
+            'order_date': order.order_date.isoformat() if order.order_date else None,
+            'shipment_priority': order.shipment_priority,
+            'line_count': order.line_count,
+            'units': order.units,
+            'total': '{:.2f}'.format(order.total),
+        } for order in page],
+        next=page.next_cursor,
+    )
+
+
+@main.route("/category", methods=['POST', 'GET'])
 @login_required
+@http_cache.conditional('category')
 def category():
     if request.method == 'POST':
         category_name = request.form['category_name']
@@ -453,15 +766,16 @@ def category():
         try:
             db.session.add(new_category)
             db.session.commit()
+            cache.invalidate('categories')
             return redirect('/category')
         except:
             return "Error: There was a problem adding the new category"
     else:
-        categories = Category.query.all()
+        categories = paginate(Category.query, Category.id)
         return render_template("category.html", categories=categories)
 
 
-@app.route('/category/update/<int:id>', methods=['GET', 'POST'])
+@main.route('/category/update/<int:id>', methods=['GET', 'POST'])
 def category_update(id):
     category = Category.query.get_or_404(id)
 
@@ -470,28 +784,654 @@ def category_update(id):
 
         try:
             db.session.commit()
+            cache.invalidate('categories')
             return redirect('/category')
         except:
             return 'There was an issue updating your task'
 
     else:
-        categories = Category.query.all()
         return render_template('update_category.html', category=category)
 
 
-@app.route('/category/delete/<int:id>')
+@main.route('/category/delete/<int:id>')
 def category_delete(id):
     category_to_delete = Category.query.get_or_404(id)
 
     try:
-        db.session.delete(category_to_delete)
-        db.session.commit()
-        return redirect('/category')
+        job = job_queue.enqueue('delete_category', category_id=category_to_delete.id)
+        return redirect(url_for('main.job', id=job.id))
     except:
         return 'There was a problem deleting that task'
 
 
+@job_queue.task('delete_category')
+def delete_category_job(run, category_id):
+    """Delete a category with its products, their order lines and sales rows.
+
+    Products are removed a chunk per transaction, so the write lock is
+    released between chunks and a crash leaves a consistent, resumable
+    state.
+    """
+    products = db.session.query(Product.id).filter(Product.category_id == category_id)
+    run.progress(0, products.count())
+    deleted = lines = 0
+    while True:
+        chunk = [product_id for (product_id,) in products.order_by(Product.id).limit(JOB_CHUNK_SIZE)]
+        if not chunk:
+            break
+        lines += OrderProduct.query.filter(OrderProduct.product_id.in_(chunk)).delete(synchronize_session=False)
+        ProductSales.query.filter(ProductSales.product_id.in_(chunk)).delete(synchronize_session=False)
+        deleted += Product.query.filter(Product.id.in_(chunk)).delete(synchronize_session=False)
+        run.progress(deleted)
+    PricingRule.query.filter_by(category_id=category_id).delete()
+    Category.query.filter_by(id=category_id).delete()
+    db.session.commit()
+    cache.invalidate('categories')
+    cache.invalidate('products')
+    cache.invalidate('pricing_rules')
+    return {'products': deleted, 'order_lines': lines}
+
+
+@main.route('/pricing', methods=['GET', 'POST'])
+@login_required
+def pricing_rules_page():
+    if request.method == 'POST':
+        category_id = request.form.get('category_id') or None
+        markup = request.form.get('markup', '').strip() or None
+        try:
+            pricing.set_rule(int(category_id) if category_id else None, markup)
+            db.session.commit()
+        except (ArithmeticError, ValueError) as ex:
+            db.session.rollback()
+            flash('Invalid markup: {}'.format(ex))
+            return redirect(url_for('main.pricing_rules_page'))
+        cache.invalidate('pricing_rules')
+        flash('Pricing rule saved. Reprice the catalog to apply it to existing products.')
+        return redirect(url_for('main.pricing_rules_page'))
+
+    preview = None
+    if request.args.get('preview'):
+        preview = pricing.summarize(pricing.reprice(
+            pricing_rules(), dry_run=True, chunk_size=current_app.config['REPRICE_CHUNK_SIZE']))
+    return render_template('pricing.html', rules=pricing_rules(), preview=preview,
+                           categories=all_categories(),
+                           category_names={category['id']: category['category_name']
+                                           for category in all_categories()})
+
+
+@main.route('/pricing/diff.csv')
+@login_required
+def pricing_diff():
+    """Every price a reprice would change, as CSV, without changing anything."""
+    changes = pricing.reprice(pricing_rules(), dry_run=True, chunk_size=current_app.config['REPRICE_CHUNK_SIZE'])
+    return Response(stream_with_context(bulk.export_rows(changes, pricing.Change._fields, 'csv',
+                                                         current_app.config['EXPORT_BATCH_SIZE'])),
+                    mimetype='text/csv',
+                    headers={'Content-Disposition': 'attachment; filename=reprice-diff.csv'})
+
+
+@main.route('/pricing/reprice', methods=['POST'])
+@login_required
+def pricing_reprice():
+    job = job_queue.enqueue('reprice')
+    return redirect(url_for('main.job', id=job.id))
+
+
+@job_queue.task('reprice')
+def reprice_job(run):
+    """Apply the pricing rules to every product, a range of ids per transaction."""
+    run.progress(0, Product.query.count())
+    report = pricing.summarize(pricing.reprice(
+        pricing_rules(), chunk_size=current_app.config['REPRICE_CHUNK_SIZE'], progress=run.progress), sample=0)
+    cache.invalidate('products')
+    return {'products': report['products'], 'increase': str(report['increase'])}
+
+
+def _required(row, field):
+    value = row.get(field)
+    if value is None or str(value).strip() == '':
+        raise ValueError('{} is required'.format(field))
+    return value
+
+
+def _optional(row, field, convert=str):
+    value = row.get(field)
+    if value is None or str(value).strip() == '':
+        return None
+    return convert(value)
+
+
+def validate_product(row):
+    cost = float(_required(row, 'product_cost'))
+    price = float(_required(row, 'product_price'))
+    category_id = int(_required(row, 'category_id'))
+    return {
+        'product_name': str(_required(row, 'product_name')),
+        'product_description': str(_required(row, 'product_description')),
+        'product_cost': cost,
+        'product_price': float(price_floor(price, cost, category_id)),
+        'category_id': category_id,
+    }
+
+
+def validate_customer(row):
+    return {
+        'first_name': str(_required(row, 'first_name')),
+        'last_name': str(_required(row, 'last_name')),
+        'email': str(_required(row, 'email')),
+        'phone': _optional(row, 'phone'),
+        'street_addr': _optional(row, 'street_addr'),
+        'state': _optional(row, 'state'),
+        'zipcode': _optional(row, 'zipcode'),
+        'city': _optional(row, 'city'),
+    }
+
+
+def validate_category(row):
+    return {'category_name': str(_required(row, 'category_name'))}
+
+
+def validate_order_line(row):
+    quantity = int(_required(row, 'quantity'))
+    if quantity < 1:
+        raise ValueError('quantity must be positive')
+    return {
+        'order_id': int(_required(row, 'order_id')),
+        'product_id': int(_required(row, 'product_id')),
+        'quantity': quantity,
+    }
+
+
+def validate_order(row):
+    # executemany takes its column list from the first row, so every row
+    # carries order_date rather than relying on the column default.
+    return {
+        'customer_id': int(_required(row, 'customer_id')),
+        'shipment_priority': _optional(row, 'shipment_priority', int),
+        'order_date': _optional(row, 'order_date', datetime.fromisoformat) or datetime.utcnow(),
+    }
+
+
+# name: (model, row validator, {validated field: column it must exist in})
+IMPORTS = {
+    'products': (Product, validate_product, {'category_id': Category.__table__.c.id}),
+    'customers': (Customer, validate_customer, {}),
+    'orders': (Order, validate_order, {'customer_id': Customer.__table__.c.id}),
+}
+
+EXPORTS = {
+    'products': Product,
+    'customers': Customer,
+    'orders': Order,
+    'categories': Category,
+}
+
+
+def run_import(name, stream, fmt, chunk_size=bulk.DEFAULT_CHUNK_SIZE, progress=None):
+    model, validate, references = IMPORTS[name]
+    try:
+        return bulk.import_rows(db.session, model.__table__, stream, fmt, validate,
+                                references=references, chunk_size=chunk_size, progress=progress)
+    finally:
+        # Chunks are committed as they go, so even a failed run may have
+        # added rows.
+        if model is Product:
+            cache.invalidate('products')
+
+
+def export_query(model):
+    table = model.__table__
+    columns = [column.key for column in table.columns]
+    query = db.session.query(*table.columns) \
+        .order_by(*table.primary_key.columns) \
+        .yield_per(current_app.config['EXPORT_BATCH_SIZE'])
+    return columns, query
+
+
+@main.route('/import/<name>', methods=['POST'])
+@login_required
+def import_data(name):
+    """Load an uploaded CSV or JSON Lines file in batched transactions.
+
+    With ?background=1 the file is saved and imported by a job instead, and
+    the response is 202 with the job's status URL.
+    """
+    if name not in IMPORTS or 'file' not in request.files:
+        abort(404 if name not in IMPORTS else 400)
+    upload = request.files['file']
+    fmt = request.args.get('format') or bulk.guess_format(upload.filename)
+    if fmt not in bulk.FORMATS:
+        abort(400)
+    if request.args.get('background'):
+        directory = os.path.join(current_app.instance_path, 'imports')
+        os.makedirs(directory, exist_ok=True)
+        handle, path = tempfile.mkstemp(suffix='.' + fmt, dir=directory)
+        os.close(handle)
+        upload.save(path)
+        job = job_queue.enqueue('import_data', table=name, path=path, fmt=fmt)
+        status_url = url_for('main.job_json', id=job.id)
+        return jsonify(job=jobs.describe(job), status_url=status_url), 202, {'Location': status_url}
+    stream = io.TextIOWrapper(upload.stream, encoding='utf-8', newline='')
+    try:
+        report = run_import(name, stream, fmt)
+    except Exception:
+        db.session.rollback()
+        current_app.logger.exception("import of %s failed", name)
+        return "Error: There was a problem importing the {} data".format(name), 500
+    return jsonify(report.as_dict())
+
+
+@job_queue.task('import_data')
+def import_data_job(run, table, path, fmt):
+    def progress(report):
+        run.progress(report.inserted + report.rejected, message=str(report))
+
+    try:
+        with open(path, encoding='utf-8', newline='') as stream:
+            report = run_import(table, stream, fmt, progress=progress)
+    finally:
+        os.remove(path)
+    progress(report)
+    return report.as_dict()
+
+
+@main.route('/export/<name>.<fmt>')
+@login_required
+def export(name, fmt):
+    """Stream a whole table as CSV or JSON Lines without loading it into memory."""
+    model = EXPORTS.get(name)
+    if model is None or fmt not in bulk.FORMATS:
+        abort(404)
+    columns, query = export_query(model)
+    chunks = bulk.export_rows(query, columns, fmt, current_app.config['EXPORT_BATCH_SIZE'])
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
+    response.headers['Content-Disposition'] = 'attachment; filename={}.{}'.format(name, fmt)
+    return response
+
+
+def api_products_written(products, previous):
+    if previous:
+        refresh_product_sales(*[product.id for product in products])
+
+
+def api_lines_written(lines, previous):
+    changes = [
+        (line, row['product_id'], row['quantity']) if row else (line, None, 0)
+        for line, row in zip(lines, previous or [None] * len(lines))
+    ]
+    inventory.reserve_lines(changes)
+    add_product_sales(units_sold(changes))
+
+
+API_RESOURCES = {
+    'products': api.Resource(Product, validate_product, {'category_id': Category.__table__.c.id},
+                             filters=('category_id',), read_only=('stock_on_hand',),
+                             after_write=api_products_written),
+    'categories': api.Resource(Category, validate_category),
+    'customers': api.Resource(Customer, validate_customer),
+    'orders': api.Resource(Order, validate_order, {'customer_id': Customer.__table__.c.id},
+                           filters=('customer_id',)),
+    'order_lines': api.Resource(OrderProduct, validate_order_line,
+                                {'order_id': Order.__table__.c.id, 'product_id': Product.__table__.c.id},
+                                filters=('order_id', 'product_id'), after_write=api_lines_written),
+}
+
+# Cached reference data each API resource's writes make stale.
+API_CACHE_KEYS = {
+    'products': ('products',),
+    'categories': ('categories',),
+}
+
+
+def api_login_required(view):
+    """login_required for JSON endpoints: 401 instead of a redirect to the login form."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not current_user.is_authenticated:
+            raise api.ApiError(401, 'Authentication required')
+        return view(*args, **kwargs)
+    return wrapper
+
+
+@main.errorhandler(api.ApiError)
+def api_error(error):
+    return jsonify(error.as_dict()), error.status
+
+
+def api_resource(name):
+    resource = API_RESOURCES.get(name)
+    if resource is None:
+        raise api.ApiError(404, 'Unknown resource {!r}'.format(name))
+    return resource
+
+
+def api_items():
+    """The JSON body as (list of objects, whether a single object was sent)."""
+    data = request.get_json(silent=True)
+    single = isinstance(data, dict)
+    items = [data] if single else data
+    if not isinstance(items, list) or not items or not all(isinstance(item, dict) for item in items):
+        raise api.ApiError(400, 'Expected a JSON object or a non-empty list of objects')
+    if len(items) > current_app.config['API_MAX_BATCH']:
+        raise api.ApiError(400, 'At most {} items per request'.format(current_app.config['API_MAX_BATCH']))
+    return items, single
+
+
+def api_write(name, write, items, single, status=200):
+    """Run a create or update in one transaction and answer with the stored rows."""
+    resource = API_RESOURCES[name]
+    fields = resource.select_fields(request.args.get('fields'))
+    try:
+        ids = [obj.id for obj in write(db.session, items)]
+        db.session.commit()
+    except inventory.OutOfStock as ex:
+        db.session.rollback()
+        raise api.ApiError(409, str(ex), {'product_id': ex.product_id, 'available': ex.available})
+    except Exception:
+        db.session.rollback()
+        raise
+    cache.invalidate(*API_CACHE_KEYS.get(name, ()))
+    # Committed objects are expired; one IN query reloads them all.
+    rows, missing = resource.get(db.session, ids, fields)
+    data = [resource.dump(row, fields) for row in rows]
+    return jsonify(data=data[0] if single else data), status
+
+
+@main.route('/api/v1/<name>', methods=['GET', 'POST', 'PATCH'])
+@api_login_required
+def api_collection(name):
+    """List, batch-get, bulk-create or bulk-update one resource, see api.py.
+
+    GET takes ?fields=, and either ?ids= or ?after=/?limit= plus the
+    resource's filters.
+    """
+    resource = api_resource(name)
+    if request.method == 'POST':
+        items, single = api_items()
+        return api_write(name, resource.create, items, single, 201)
+    if request.method == 'PATCH':
+        items, single = api_items()
+        return api_write(name, resource.update, items, single)
+
+    fields = resource.select_fields(request.args.get('fields'))
+    if 'ids' in request.args:
+        rows, missing = resource.get(db.session, api.parse_ids(request.args['ids'],
+                                                               current_app.config['API_MAX_BATCH']), fields)
+        return jsonify(data=[resource.dump(row, fields) for row in rows], missing=missing)
+    limit = page_size(request.args, current_app.config['PAGE_SIZE'], current_app.config['MAX_PAGE_SIZE'])
+    page = resource.list(db.session, fields, request.args, request.args.get('after'), limit)
+    return jsonify(data=[resource.dump(row, fields) for row in page], next=page.next_cursor)
+
+
+@main.route('/api/v1/<name>/<int:id>', methods=['GET', 'PATCH'])
+@api_login_required
+def api_item(name, id):
+    resource = api_resource(name)
+    if request.method == 'PATCH':
+        item = request.get_json(silent=True)
+        if not isinstance(item, dict):
+            raise api.ApiError(400, 'Expected a JSON object')
+        return api_write(name, resource.update, [dict(item, id=id)], True)
+
+    fields = resource.select_fields(request.args.get('fields'))
+    rows, missing = resource.get(db.session, [id], fields)
+    if missing:
+        raise api.ApiError(404, 'No {} with id {}'.format(name, id))
+    return jsonify(data=resource.dump(rows[0], fields))
+
+
+@main.route('/cache/stats')
+@login_required
+def cache_stats():
+    return jsonify(cache.stats())
+
+
+@main.cli.command('import-data')
+@click.argument('name', type=click.Choice(sorted(IMPORTS)))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(bulk.FORMATS), help='Defaults to the file extension.')
+@click.option('--chunk-size', default=bulk.DEFAULT_CHUNK_SIZE, show_default=True)
+def import_data_command(name, path, fmt, chunk_size):
+    """Bulk load products, customers or orders from a CSV or JSONL file."""
+    with open(path, encoding='utf-8', newline='') as stream:
+        report = run_import(name, stream, fmt or bulk.guess_format(path), chunk_size)
+    print(report)
+    for error in report.errors:
+        print('  line {line}: {error}'.format(**error))
+
+
+@main.cli.command('export-data')
+@click.argument('name', type=click.Choice(sorted(EXPORTS)))
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+@click.option('--format', 'fmt', type=click.Choice(bulk.FORMATS), help='Defaults to the file extension.')
+def export_data_command(name, path, fmt):
+    """Write a whole table to a CSV or JSONL file."""
+    columns, query = export_query(EXPORTS[name])
+    with open(path, 'w', encoding='utf-8', newline='') as out:
+        for chunk in bulk.export_rows(query, columns, fmt or bulk.guess_format(path),
+                                      current_app.config['EXPORT_BATCH_SIZE']):
+            out.write(chunk)
+
+
+@main.cli.command('export-analytics')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+@click.option('--format', 'fmt', type=click.Choice(analytics.FORMATS), help='Defaults to the file extension.')
+@click.option('--chunk-size', default=analytics.DEFAULT_CHUNK_SIZE, show_default=True)
+def export_analytics_command(path, fmt, chunk_size):
+    """Write every order line with its product, order and customer to a columnar file."""
+    started = datetime.utcnow()
+    rows = analytics.export(path, fmt, chunk_size)
+    print('Exported {} order lines to {} in {:.1f}s.'.format(
+        rows, path, (datetime.utcnow() - started).total_seconds()))
+
+
+@main.cli.command('analytics-summary')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--by', type=click.Choice(sorted(analytics.GROUPINGS)), default='category', show_default=True)
+@click.option('--format', 'fmt', type=click.Choice(analytics.FORMATS), help='Defaults to the file extension.')
+def analytics_summary_command(path, by, fmt):
+    """Print quantity, revenue, cost and margin totals from an exported file."""
+    for row in analytics.aggregate(path, by, fmt):
+        print('\t'.join(str(value) for value in row.values()))
+
+
+@main.route('/jobs')
+@login_required
+def job_list():
+    page = paginate(Job.query, Job.id, descending=True)
+    return render_template('jobs.html', jobs=page)
+
+
+@main.route('/jobs/<int:id>')
+@login_required
+def job(id):
+    return render_template('job.html', job=Job.query.get_or_404(id), finished=jobs.FINISHED)
+
+
+@main.route('/jobs/<int:id>.json')
+@login_required
+def job_json(id):
+    """Status and progress of one job, for polling."""
+    return jsonify(jobs.describe(Job.query.get_or_404(id)))
+
+
+@main.cli.command('worker')
+@click.option('--threads', default=1, show_default=True, help='Jobs run concurrently.')
+@click.option('--burst', is_flag=True, help='Exit once the queue is empty.')
+def worker_command(threads, burst):
+    """Run queued background jobs until interrupted."""
+    if burst:
+        job_queue.requeue_stale()
+        job_queue.work(jobs.worker_name(), burst=True)
+        return
+    worker = job_queue.start_worker(current_app._get_current_object(), threads)
+    print('Running jobs with {} threads, Ctrl-C to stop.'.format(threads))
+    try:
+        while not worker.stopping.wait(1):
+            pass
+    except KeyboardInterrupt:
+        worker.stop()
+
+
+def upgrade_schema(target=None):
+    try:
+        applied = migrations.upgrade(db.engine, target)
+    except ValueError as ex:
+        raise click.ClickException(str(ex))
+    for id in applied:
+        print('Applied migration {}'.format(id))
+    return applied
+
+
+@main.cli.command('init-db')
+def init_db():
+    """Create the database, or bring an existing one up to date, and seed it."""
+    upgrade_schema()
+    http_cache.seed()
+    if search.install(db.engine):
+        search.rebuild(db.engine)
+    print('Database initialized.')
+
+
+@main.cli.command('db-upgrade')
+@click.option('--to', 'target', help='Stop after this migration.')
+def db_upgrade(target):
+    """Apply the schema migrations the database does not have yet."""
+    if not upgrade_schema(target):
+        print('Nothing to apply.')
+
+
+@main.cli.command('db-downgrade')
+@click.argument('target')
+def db_downgrade(target):
+    """Undo the schema migrations after TARGET."""
+    try:
+        undone = migrations.downgrade(db.engine, target)
+    except ValueError as ex:
+        raise click.ClickException(str(ex))
+    for id in undone:
+        print('Undid migration {}'.format(id))
+
+
+@main.cli.command('db-status')
+def db_status():
+    """List the schema migrations and when each was applied."""
+    applied = migrations.applied(db.engine)
+    for migration in migrations.MIGRATIONS:
+        print('{} {:<19} {}'.format(migration.id, str(applied.get(migration.id, 'pending'))[:19],
+                                   migration.description))
+
+
+@main.cli.command('search-index')
+def search_index():
+    """Create the product search index and refill it from the catalog."""
+    if not search.supported(db.engine):
+        print('Full-text search needs SQLite with FTS5.')
+        return
+    search.install(db.engine)
+    search.rebuild(db.engine)
+    print('Search index rebuilt.')
+
+
+@main.cli.command('rebuild-metrics')
+def rebuild_metrics():
+    """Rebuild the ProductSales rollup from every order line."""
+    refresh_product_sales()
+    db.session.commit()
+    print('Rebuilt sales metrics for {} products.'.format(ProductSales.query.count()))
+
+
+# Pages checked by `flask check-query-plans`: every GET route that only reads,
+# except exports, which read whole tables by design.
+QUERY_PLAN_URLS = [
+    '/login', '/registration', '/vendors', '/profile', '/contact', '/cache/stats',
+    '/', '/?limit=500', '/update/1', '/customers', '/orders', '/orders/update/1',
+    '/order_product?id=1', '/order_product/update/1/1',
+    '/search?q=drum', '/search.json?q=drum&category=1&min_price=1',
+    '/metrics', '/orderhistory?searched_account_id=1', '/orderhistory/1',
+    '/orderhistory/1?from=2020-01-01&to=2020-12-31',
+    '/category', '/category/update/1', '/pricing', '/jobs', '/jobs/1', '/jobs/1.json',
+    '/api/v1/products', '/api/v1/products?category_id=1', '/api/v1/products?ids=1,2,3',
+    '/api/v1/products/1', '/api/v1/categories', '/api/v1/customers', '/api/v1/orders',
+    '/api/v1/orders?customer_id=1', '/api/v1/order_lines?order_id=1', '/api/v1/order_lines?product_id=1',
+]
+
+# Whole-table reads the pages do on purpose, as (url, table): reason.
+QUERY_PLAN_ALLOWED_SCANS = {
+    ('/', 'category'): 'the category picker lists every category (cached)',
+    ('/orders', 'customer'): 'the new order form picks from every customer',
+    ('/orders/update/1', 'customer'): 'the order edit form picks from every customer',
+    ('/order_product?id=1', 'product'): 'the new order line form picks from every product (cached)',
+    ('/metrics', 'product_sales'): 'the metrics page shows the rollup of every product',
+    ('/pricing', 'pricing_rule'): 'every rule is loaded into one cached Rules object',
+}
+
+
+@main.cli.command('check-query-plans')
+@click.option('--max-rows', default=1000, show_default=True,
+              help='Largest table a query may scan in full.')
+@click.option('--verbose', is_flag=True, help='List every page checked.')
+def check_query_plans(max_rows, verbose):
+    """Fail when a page's queries scan a whole table larger than --max-rows.
+
+    Scans listed in QUERY_PLAN_ALLOWED_SCANS are reported but do not fail.
+    """
+    if not queryplan.supported(db.engine):
+        raise click.ClickException('EXPLAIN QUERY PLAN needs SQLite.')
+    checked = set()
+    for url in QUERY_PLAN_URLS:
+        checked.add(current_app.url_map.bind('').match(url.split('?')[0])[0])
+    unchecked = sorted(rule.rule for rule in current_app.url_map.iter_rules()
+                       if 'GET' in rule.methods and rule.endpoint not in checked)
+    visited, problems = queryplan.check(current_app._get_current_object(), db.engine, db.metadata.sorted_tables,
+                                        QUERY_PLAN_URLS, max_rows, db.session.query(db.func.min(User.id)).scalar(),
+                                        db.session)
+    for url, status, statements in visited:
+        if verbose or status >= 500:
+            print('{} {} ({} queries)'.format(status, url, statements))
+    failures = []
+    for problem in problems:
+        reason = QUERY_PLAN_ALLOWED_SCANS.get((problem.url, problem.table))
+        if reason is None:
+            failures.append(problem)
+            print('{}: scans {} ({} rows)\n  {}\n  {}'.format(
+                problem.url, problem.table, problem.rows, ' '.join(problem.statement.split()),
+                '\n  '.join(problem.plan)))
+        elif verbose:
+            print('{}: scans {} ({} rows), allowed: {}'.format(problem.url, problem.table, problem.rows, reason))
+    if verbose:
+        print('Not checked: ' + ', '.join(unchecked))
+    print('{} pages, {} full scans over {} rows, {} of them allowed.'.format(
+        len(visited), len(problems), max_rows, len(problems) - len(failures)))
+    if failures or any(status >= 500 for url, status, statements in visited):
+        raise SystemExit(1)
+
+
+@main.cli.command('reprice')
+@click.option('--dry-run', is_flag=True, help='Report the changes without making them.')
+@click.option('--chunk-size', default=pricing.DEFAULT_CHUNK_SIZE, show_default=True)
+@click.option('--diff', 'diff_path', type=click.Path(dir_okay=False, writable=True),
+              help='Also write every change to this CSV file.')
+def reprice_command(dry_run, chunk_size, diff_path):
+    """Raise every price below the floor of its pricing rule."""
+    started = datetime.utcnow()
+    changes = pricing.reprice(pricing_rules(), dry_run, chunk_size)
+    if diff_path:
+        with open(diff_path, 'w', encoding='utf-8', newline='') as out:
+            changes = list(changes)
+            for chunk in bulk.export_rows(changes, pricing.Change._fields, 'csv'):
+                out.write(chunk)
+    report = pricing.summarize(changes, sample=10)
+    if not dry_run:
+        cache.invalidate('products')
+    for change in report['sample']:
+        print('  {0.id} {0.product_name}: {0.old_price} -> {0.new_price}'.format(change))
+    print('{} {} products, total increase {}, in {:.1f}s.'.format(
+        'Would reprice' if dry_run else 'Repriced', report['products'], report['increase'],
+        (datetime.utcnow() - started).total_seconds()))
+
 
 if __name__ == "__main__":
     # app.run(host="0.0.0.0", port=8080)   # This didn't work for me, so I set it to the line under
-    app.run(debug=True)
+    create_app().run(debug=True)
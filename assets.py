@@ -0,0 +1,114 @@
+""" Precompiled templates and content-hashed static files
+
+In production every template is compiled once when the app is built, with
+Jinja's bytecode kept on disk so the next worker to start skips parsing
+and code generation, and auto reload off so a render never stats the
+template files. Static files are served under names carrying a hash of
+their content:
+
+    url_for('static', filename='css/main.css')  ->  /static/css/main.1a2b3c4d5e.css
+
+A hashed URL changes whenever the file does, so it is sent with a one year
+public, immutable Cache-Control and browsers stop revalidating it. The
+plain URL keeps working with the default short max age.
+
+Config:
+    TEMPLATES_PRECOMPILE         compile every template in init_app
+    TEMPLATE_BYTECODE_CACHE      keep compiled templates on disk
+    TEMPLATE_BYTECODE_CACHE_DIR  defaults to <instance>/jinja-cache
+    STATIC_HASHED_URLS           rewrite static URLs to hashed names
+    STATIC_HASHED_MAX_AGE        seconds hashed files may be cached
+"""
+
+import hashlib
+import os
+
+from flask import current_app, send_from_directory
+from jinja2 import FileSystemBytecodeCache
+
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as source:
+        for block in iter(lambda: source.read(65536), b''):
+            digest.update(block)
+    return digest.hexdigest()[:10]
+
+
+def hashed_name(filename, digest):
+    """ css/main.css -> css/main.<digest>.css """
+    root, extension = os.path.splitext(filename)
+    return '{}.{}{}'.format(root, digest, extension)
+
+
+def build_manifest(folder):
+    """ {filename: hashed filename} for every file under folder, with / separators """
+    manifest = {}
+    for directory, subdirectories, filenames in os.walk(folder):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            name = os.path.relpath(path, folder).replace(os.sep, '/')
+            manifest[name] = hashed_name(name, file_hash(path))
+    return manifest
+
+
+def precompile_templates(app):
+    """ Load every template into the environment's cache; returns the count """
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+class StaticFiles(object):
+    """ One app's hashed static names and the max age they are sent with """
+
+    def __init__(self, manifest, max_age):
+        self.manifest = manifest
+        self.originals = {hashed: name for name, hashed in manifest.items()}
+        self.max_age = max_age
+
+
+class Assets(object):
+    """ Flask extension for template precompilation and hashed static URLs
+
+    Each app keeps its own StaticFiles in app.extensions['assets'].
+    """
+
+    def init_app(self, app):
+        app.config.setdefault('TEMPLATES_PRECOMPILE', False)
+        app.config.setdefault('TEMPLATE_BYTECODE_CACHE', False)
+        app.config.setdefault('TEMPLATE_BYTECODE_CACHE_DIR', None)
+        app.config.setdefault('STATIC_HASHED_URLS', False)
+        app.config.setdefault('STATIC_HASHED_MAX_AGE', 31536000)
+        app.extensions['assets'] = StaticFiles({}, app.config['STATIC_HASHED_MAX_AGE'])
+
+        if app.config['TEMPLATE_BYTECODE_CACHE']:
+            directory = (app.config['TEMPLATE_BYTECODE_CACHE_DIR']
+                         or os.path.join(app.instance_path, 'jinja-cache'))
+            os.makedirs(directory, exist_ok=True)
+            app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+        if app.config['TEMPLATES_PRECOMPILE']:
+            precompile_templates(app)
+
+        if app.config['STATIC_HASHED_URLS'] and app.has_static_folder:
+            app.extensions['assets'] = StaticFiles(build_manifest(app.static_folder),
+                                                   app.config['STATIC_HASHED_MAX_AGE'])
+            app.url_defaults(self._hash_static_url)
+            app.view_functions['static'] = self.send_static_file
+
+    def _hash_static_url(self, endpoint, values):
+        if endpoint == 'static' and 'filename' in values:
+            manifest = current_app.extensions['assets'].manifest
+            values['filename'] = manifest.get(values['filename'], values['filename'])
+
+    def send_static_file(self, filename):
+        static = current_app.extensions['assets']
+        original = static.originals.get(filename)
+        if original is None:
+            return current_app.send_static_file(filename)
+        response = send_from_directory(current_app.static_folder, original, cache_timeout=static.max_age)
+        response.cache_control.public = True
+        # werkzeug's ResponseCacheControl has no immutable attribute yet.
+        response.headers['Cache-Control'] += ', immutable'
+        return response
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+""" Generate a synthetic shop24 database for benchmarking
+
+The dataset is sized by the number of order lines; the other tables are
+derived from it so that every scale has the same shape:
+
+    $ python3 bench/dataset.py --scale 100k --path /tmp/shop24-100k.db
+
+Rows are generated from a fixed seed and inserted with executemany in
+chunks, so a 1M line dataset builds in well under a minute.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import migrations  # noqa: E402
+import search  # noqa: E402
+from app import create_app  # noqa: E402
+from models import (db, refresh_product_sales, User, Category, Product,  # noqa: E402
+                    Customer, Order, OrderProduct)
+
+
+SCALES = {
+    '1k': 1000,
+    '10k': 10000,
+    '100k': 100000,
+    '1m': 1000000,
+}
+CHUNK_SIZE = 10000
+BENCH_USER = 'bench'
+BENCH_PASSWORD = 'bench'
+STATES = ('CA', 'NY', 'TX', 'OR', 'WA', 'FL', 'IL', 'SC', 'MA', 'CO')
+WORDS = ('piano', 'guitar', 'violin', 'drum', 'amp', 'cable', 'stand', 'case',
+         'string', 'pedal', 'bow', 'reed', 'mic', 'speaker', 'mixer', 'tuner')
+
+
+def parse_scale(value):
+    """ Accept a named scale (1k, 100k, 1m) or a plain number of order lines """
+    value = value.lower()
+    if value in SCALES:
+        return SCALES[value]
+    return int(value)
+
+
+def shape(lines):
+    """ Row counts per table for a given number of order lines """
+    return {
+        'categories': 20,
+        'products': max(50, lines // 20),
+        'customers': max(20, lines // 50),
+        'orders': max(10, lines // 5),
+        'order_lines': lines,
+    }
+
+
+def _insert(table, rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= CHUNK_SIZE:
+            db.session.execute(table.insert(), chunk)
+            chunk = []
+    if chunk:
+        db.session.execute(table.insert(), chunk)
+    db.session.commit()
+
+
+def generate(path, lines, seed=24):
+    """ Build a fresh database at path and return its row counts """
+    if os.path.exists(path):
+        os.remove(path)
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.abspath(path),
+        'INSTRUMENTATION_ENABLED': False,
+    })
+    counts = shape(lines)
+    rng = random.Random(seed)
+    # Stock levels come from their own generator so adding them did not
+    # change any other generated value.
+    stock_rng = random.Random(seed + 1)
+    start = datetime(2020, 1, 1)
+
+    with app.app_context():
+        migrations.upgrade(db.engine)
+
+        user = User(username=BENCH_USER, email='bench@example.com')
+        user.setPW(BENCH_PASSWORD)
+        db.session.add(user)
+
+        _insert(Category.__table__, (
+            {'id': number, 'category_name': 'Category {}'.format(number)}
+            for number in range(1, counts['categories'] + 1)))
+
+        def products():
+            for number in range(1, counts['products'] + 1):
+                cost = round(rng.uniform(1, 500), 2)
+                yield {
+                    'id': number,
+                    'product_name': '{} {} {}'.format(rng.choice(WORDS), rng.choice(WORDS), number),
+                    'product_description': ' '.join(rng.choice(WORDS) for _ in range(8)),
+                    'product_cost': cost,
+                    'product_price': round(cost * rng.uniform(1.3, 2.0), 2),
+                    'date_created': start + timedelta(minutes=number),
+                    'category_id': rng.randint(1, counts['categories']),
+                    'stock_on_hand': stock_rng.randint(0, 1000),
+                }
+        _insert(Product.__table__, products())
+
+        _insert(Customer.__table__, (
+            {
+                'id': number,
+                'first_name': 'First{}'.format(number),
+                'last_name': 'Last{}'.format(number),
+                'email': 'customer{}@example.com'.format(number),
+                'phone': '555{:07d}'.format(number % 10000000),
+                'street_addr': '{} Main St'.format(number),
+                'state': rng.choice(STATES),
+                'zipcode': '{:05d}'.format(number % 100000),
+                'city': 'City{}'.format(number % 500),
+            }
+            for number in range(1, counts['customers'] + 1)))
+
+        _insert(Order.__table__, (
+            {
+                'id': number,
+                'customer_id': rng.randint(1, counts['customers']),
+                'order_date': start + timedelta(seconds=rng.randint(0, 365 * 24 * 3600)),
+                'shipment_priority': rng.randint(1, 5),
+            }
+            for number in range(1, counts['orders'] + 1)))
+
+        _insert(OrderProduct.__table__, (
+            {
+                'id': number,
+                'order_id': rng.randint(1, counts['orders']),
+                'product_id': rng.randint(1, counts['products']),
+                'quantity': rng.randint(1, 10),
+            }
+            for number in range(1, counts['order_lines'] + 1)))
+
+        refresh_product_sales()
+        db.session.commit()
+        if search.install(db.engine):
+            search.rebuild(db.engine)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--scale', default='1k', help='1k, 10k, 100k, 1m or a number of order lines')
+    parser.add_argument('--path', default=None, help='database file (default bench/shop24-<scale>.db)')
+    parser.add_argument('--seed', type=int, default=24)
+    args = parser.parse_args()
+
+    lines = parse_scale(args.scale)
+    path = args.path or os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                     'shop24-{}.db'.format(args.scale.lower()))
+    started = time.perf_counter()
+    counts = generate(path, lines, args.seed)
+    print('Generated {} in {:.1f}s: {}'.format(
+        path, time.perf_counter() - started,
+        ', '.join('{} {}'.format(count, name) for name, count in counts.items())))
+
+
+if __name__ == '__main__':
+    main()
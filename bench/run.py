@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+""" Drive shop24 routes and report throughput and latency percentiles
+
+Run against a synthetic dataset through the Flask test client:
+
+    $ python3 bench/dataset.py --scale 100k
+    $ python3 bench/run.py --db bench/shop24-100k.db --requests 200 --out before.json
+
+or against a running server with a small threaded HTTP load generator:
+
+    $ python3 bench/run.py --url http://127.0.0.1:8000 --concurrency 8
+
+Reports are JSON so two runs can be compared:
+
+    $ python3 bench/run.py compare before.json after.json
+"""
+
+import argparse
+import http.cookiejar
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from dataset import BENCH_PASSWORD, BENCH_USER, WORDS  # noqa: E402
+
+
+class Scenario(object):
+    """ One request shape; path and data may depend on a random generator
+
+    Any status other than expect counts as an error, so a lost session
+    (a redirect to /login) does not pass for a fast page.
+    """
+
+    def __init__(self, name, method, path, data=None, expect=200):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.data = data
+        self.expect = expect
+
+    def build(self, rng, sizes):
+        path = self.path(rng, sizes) if callable(self.path) else self.path
+        data = self.data(rng, sizes) if callable(self.data) else self.data
+        return path, data
+
+
+SEARCH_TERMS = WORDS + tuple(word[:2] for word in WORDS) + tuple(
+    '{} {}'.format(first, second) for first, second in zip(WORDS, WORDS[1:]))
+
+SCENARIOS = [
+    Scenario('products', 'GET', '/'),
+    Scenario('orders', 'GET', '/orders'),
+    Scenario('metrics', 'GET', '/metrics'),
+    Scenario('order_product', 'GET',
+             lambda rng, sizes: '/order_product?id={}'.format(rng.randint(1, sizes['orders']))),
+    Scenario('orderhistory', 'POST', '/orderhistory',
+             lambda rng, sizes: {'searched_account_id': rng.randint(1, sizes['customers'])}),
+    Scenario('search', 'GET',
+             lambda rng, sizes: '/search?q={}'.format(rng.choice(SEARCH_TERMS))),
+    Scenario('login', 'POST', '/login',
+             {'username': BENCH_USER, 'password': BENCH_PASSWORD}, expect=302),
+]
+
+
+class FlaskClientTarget(object):
+    """ Sends requests through the in-process Flask test client """
+
+    def __init__(self, db_path):
+        from app import create_app
+        self.app = create_app({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.abspath(db_path),
+            'WTF_CSRF_ENABLED': False,
+            'SLOW_REQUEST_SECONDS': float('inf'),
+            # The login scenario is a throughput test, not an attack.
+            'LOGIN_RATE_LIMIT_ENABLED': False,
+        })
+        self.app.logger.disabled = True
+
+    def session(self):
+        client = self.app.test_client()
+        client.post('/login', data={'username': BENCH_USER, 'password': BENCH_PASSWORD})
+
+        def send(method, path, data):
+            response = client.open(path, method=method, data=data)
+            response.close()
+            return response.status_code
+        return send
+
+    def sizes(self):
+        from models import Customer, Order
+        with self.app.app_context():
+            return {'customers': Customer.query.count(), 'orders': Order.query.count()}
+
+
+class HttpTarget(object):
+    """ Sends requests over HTTP to a running server, one cookie jar per thread """
+
+    def __init__(self, url, customers, orders):
+        self.url = url.rstrip('/')
+        self._sizes = {'customers': customers, 'orders': orders}
+
+    def session(self):
+        opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+            _NoRedirect())
+
+        def send(method, path, data):
+            body = None
+            if data is not None:
+                data = dict(data)
+                if path == '/login':
+                    data['csrf_token'] = self._csrf_token(opener)
+                body = urllib.parse.urlencode(data).encode('ascii')
+            request = urllib.request.Request(self.url + path, data=body, method=method)
+            try:
+                with opener.open(request) as response:
+                    response.read()
+                    return response.status
+            except urllib.error.HTTPError as ex:
+                ex.read()
+                return ex.code
+
+        send('POST', '/login', {'username': BENCH_USER, 'password': BENCH_PASSWORD})
+        return send
+
+    def _csrf_token(self, opener):
+        with opener.open(self.url + '/login') as response:
+            page = response.read().decode('utf-8')
+        match = re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', page)
+        return match.group(1) if match else ''
+
+    def sizes(self):
+        return self._sizes
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def percentile(sorted_values, fraction):
+    """ Nearest-rank percentile of an already sorted list """
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(fraction * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def run_scenario(target, scenario, requests, concurrency, sizes, seed):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    per_thread = [requests // concurrency + (1 if n < requests % concurrency else 0)
+                  for n in range(concurrency)]
+
+    def worker(number, count):
+        send = target.session()
+        rng = random.Random(seed + number)
+        mine = []
+        failed = 0
+        for _ in range(count):
+            path, data = scenario.build(rng, sizes)
+            started = time.perf_counter()
+            status = send(scenario.method, path, data)
+            mine.append(time.perf_counter() - started)
+            if status != scenario.expect:
+                failed += 1
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=worker, args=(number, count))
+               for number, count in enumerate(per_thread) if count]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'seconds': round(elapsed, 4),
+        'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'mean_ms': round(1000 * sum(latencies) / len(latencies), 3) if latencies else 0.0,
+        'p50_ms': round(1000 * percentile(latencies, 0.50), 3),
+        'p95_ms': round(1000 * percentile(latencies, 0.95), 3),
+        'p99_ms': round(1000 * percentile(latencies, 0.99), 3),
+    }
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(args):
+    if args.url:
+        target = HttpTarget(args.url, args.customers, args.orders)
+    else:
+        target = FlaskClientTarget(args.db)
+    sizes = target.sizes()
+    wanted = set(args.only.split(',')) if args.only else None
+
+    report = {
+        'meta': {
+            'timestamp': datetime.utcnow().isoformat() + 'Z',
+            'revision': _git_revision(),
+            'python': platform.python_version(),
+            'target': args.url or os.path.abspath(args.db),
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'sizes': sizes,
+        },
+        'results': {},
+    }
+    for scenario in SCENARIOS:
+        if wanted and scenario.name not in wanted:
+            continue
+        if args.warmup:
+            run_scenario(target, scenario, args.warmup, 1, sizes, args.seed)
+        result = run_scenario(target, scenario, args.requests, args.concurrency, sizes, args.seed)
+        report['results'][scenario.name] = result
+        print('{:<14} {:>8.1f} req/s  p50 {:>8.2f}ms  p95 {:>8.2f}ms  p99 {:>8.2f}ms  errors {}'.format(
+            scenario.name, result['throughput_rps'], result['p50_ms'], result['p95_ms'],
+            result['p99_ms'], result['errors']), file=sys.stderr)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.out:
+        with open(args.out, 'w') as out:
+            out.write(output + '\n')
+    else:
+        print(output)
+
+
+def compare(args):
+    with open(args.before) as before_file, open(args.after) as after_file:
+        before = json.load(before_file)['results']
+        after = json.load(after_file)['results']
+    print('{:<14} {:>24} {:>24} {:>24}'.format('scenario', 'req/s', 'p50 ms', 'p99 ms'))
+    for name in sorted(set(before) & set(after)):
+        cells = []
+        for key in ('throughput_rps', 'p50_ms', 'p99_ms'):
+            old, new = before[name][key], after[name][key]
+            change = (new - old) / old * 100 if old else 0.0
+            cells.append('{:>9.2f} -> {:>9.2f} {:>+4.0f}%'.format(old, new, change))
+        print('{:<14} {}'.format(name, ' '.join(cells)))
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'compare':
+        parser = argparse.ArgumentParser(prog='run.py compare')
+        parser.add_argument('before')
+        parser.add_argument('after')
+        compare(parser.parse_args(sys.argv[2:]))
+        return
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--db', default=os.path.join(BENCH_DIR, 'shop24-1k.db'),
+                        help='dataset built by bench/dataset.py (test client mode)')
+    parser.add_argument('--url', help='benchmark a running server instead of the test client')
+    parser.add_argument('--customers', type=int, default=20, help='customer count on --url')
+    parser.add_argument('--orders', type=int, default=200, help='order count on --url')
+    parser.add_argument('--requests', type=int, default=100, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--warmup', type=int, default=5, help='unmeasured requests per scenario')
+    parser.add_argument('--only', help='comma separated scenario names')
+    parser.add_argument('--seed', type=int, default=24)
+    parser.add_argument('--out', help='write the JSON report here instead of stdout')
+    benchmark(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
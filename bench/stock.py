@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+""" Parallel order submissions against a few stock-limited products
+
+Copies a dataset, gives --products products --stock units each, then runs
+--workers processes that each post --orders random baskets of those
+products to /order_product/batch through their own app and connection
+pool, all against the one WAL-mode SQLite file:
+
+    $ python3 bench/dataset.py --scale 10k
+    $ python3 bench/stock.py --db bench/shop24-10k.db --workers 8 --orders 200
+
+Prints throughput, latency percentiles and how many baskets were accepted
+or refused for lack of stock, then checks the books: no product may go
+below zero, and the units taken from each product must equal both the
+units on the accepted baskets and the reservations in the ledger.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from dataset import BENCH_PASSWORD, BENCH_USER  # noqa: E402
+from run import percentile  # noqa: E402
+
+
+def make_app(db_path):
+    from app import create_app
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + db_path,
+        'WTF_CSRF_ENABLED': False,
+        'SLOW_REQUEST_SECONDS': float('inf'),
+        'LOGIN_RATE_LIMIT_ENABLED': False,
+        'JOB_WORKER_THREADS': 0,
+    })
+    app.logger.disabled = True
+    return app
+
+
+def prepare(db_path, products, stock):
+    """ Set the stock of the first products; returns (product ids, order count, last ledger id) """
+    import inventory
+    from models import db, Order, Product, StockMovement
+    app = make_app(db_path)
+    with app.app_context():
+        ids = [id for (id,) in db.session.query(Product.id).order_by(Product.id).limit(products)]
+        for id in ids:
+            inventory.set_stock(id, stock)
+        db.session.commit()
+        orders = Order.query.count()
+        last_movement = db.session.query(db.func.max(StockMovement.id)).scalar() or 0
+        db.engine.dispose()
+    return ids, orders, last_movement
+
+
+def submit(job):
+    """ Worker process: post baskets; returns ([(status, seconds, {product: units})], finish time) """
+    db_path, number, count, product_ids, orders, start_at, seed = job
+    app = make_app(db_path)
+    client = app.test_client()
+    client.post('/login', data={'username': BENCH_USER, 'password': BENCH_PASSWORD})
+    rng = random.Random(seed + number)
+    results = []
+    # Start together so the submissions really overlap.
+    time.sleep(max(0.0, start_at - time.time()))
+    for _ in range(count):
+        basket = {product_id: rng.randint(1, 3)
+                  for product_id in rng.sample(product_ids, rng.randint(1, min(3, len(product_ids))))}
+        body = {'order_id': rng.randint(1, orders),
+                'lines': [{'product_id': product_id, 'quantity': quantity}
+                          for product_id, quantity in basket.items()]}
+        started = time.perf_counter()
+        response = client.post('/order_product/batch', json=body)
+        seconds = time.perf_counter() - started
+        response.close()
+        results.append((response.status_code, seconds, basket))
+    return results, time.time()
+
+
+def check(db_path, product_ids, stock, last_movement, accepted):
+    from models import db, Product, StockMovement
+    app = make_app(db_path)
+    problems = []
+    with app.app_context():
+        levels = dict(db.session.query(Product.id, Product.stock_on_hand).filter(Product.id.in_(product_ids)))
+        ledger = dict(db.session.query(StockMovement.product_id, db.func.sum(StockMovement.change))
+                      .filter(StockMovement.id > last_movement, StockMovement.product_id.in_(product_ids))
+                      .group_by(StockMovement.product_id))
+    for product_id in product_ids:
+        taken = stock - levels[product_id]
+        if levels[product_id] < 0:
+            problems.append('product {} oversold: stock {}'.format(product_id, levels[product_id]))
+        if taken != accepted.get(product_id, 0):
+            problems.append('product {}: {} units taken, {} on accepted baskets'.format(
+                product_id, taken, accepted.get(product_id, 0)))
+        if -ledger.get(product_id, 0) != taken:
+            problems.append('product {}: {} units taken, ledger says {}'.format(
+                product_id, taken, -ledger.get(product_id, 0)))
+    return levels, problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--db', default=os.path.join(BENCH_DIR, 'shop24-1k.db'),
+                        help='dataset built by bench/dataset.py; it is copied, not modified')
+    parser.add_argument('--workers', type=int, default=8, help='parallel processes')
+    parser.add_argument('--orders', type=int, default=100, help='baskets per worker')
+    parser.add_argument('--products', type=int, default=5, help='stock-limited products in play')
+    parser.add_argument('--stock', type=int, default=500, help='starting units per product')
+    parser.add_argument('--seed', type=int, default=24)
+    parser.add_argument('--out', help='also write the JSON report here')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='shop24-stock-')
+    db_path = os.path.join(directory, 'shop24.db')
+    try:
+        shutil.copy(args.db, db_path)
+        product_ids, orders, last_movement = prepare(db_path, args.products, args.stock)
+
+        start_at = time.time() + 2.0
+        jobs = [(db_path, number, args.orders, product_ids, orders, start_at, args.seed)
+                for number in range(args.workers)]
+        with multiprocessing.get_context('spawn').Pool(args.workers) as pool:
+            finished = pool.map(submit, jobs)
+        per_worker = [results for results, finished_at in finished]
+        elapsed = max(finished_at for results, finished_at in finished) - start_at
+
+        latencies = sorted(seconds for results in per_worker for status, seconds, basket in results)
+        statuses = {}
+        accepted = {}
+        for results in per_worker:
+            for status, seconds, basket in results:
+                statuses[status] = statuses.get(status, 0) + 1
+                if status == 200:
+                    for product_id, quantity in basket.items():
+                        accepted[product_id] = accepted.get(product_id, 0) + quantity
+        levels, problems = check(db_path, product_ids, args.stock, last_movement, accepted)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    report = {
+        'workers': args.workers,
+        'baskets': len(latencies),
+        'seconds': round(elapsed, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'p50_ms': round(1000 * percentile(latencies, 0.50), 3),
+        'p95_ms': round(1000 * percentile(latencies, 0.95), 3),
+        'p99_ms': round(1000 * percentile(latencies, 0.99), 3),
+        'accepted': statuses.get(200, 0),
+        'out_of_stock': statuses.get(409, 0),
+        'errors': sum(count for status, count in statuses.items() if status not in (200, 409)),
+        'units_sold': sum(accepted.values()),
+        'stock_left': {str(product_id): level for product_id, level in levels.items()},
+        'problems': problems,
+    }
+    print('{workers} workers, {baskets} baskets in {seconds}s: {throughput_rps} req/s, '
+          'p50 {p50_ms}ms p95 {p95_ms}ms p99 {p99_ms}ms; {accepted} accepted, '
+          '{out_of_stock} out of stock, {errors} errors, {units_sold} units sold'.format(**report),
+          file=sys.stderr)
+    for problem in problems:
+        print('  ' + problem, file=sys.stderr)
+    if args.out:
+        with open(args.out, 'w') as out:
+            out.write(json.dumps(report, indent=2, sort_keys=True) + '\n')
+    sys.exit(1 if problems or report['errors'] else 0)
+
+
+if __name__ == '__main__':
+    main()
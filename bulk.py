@@ -0,0 +1,195 @@
+""" Bulk import and export of table rows as CSV or JSON Lines
+
+Imports are streamed: the input is parsed one row at a time, validated and
+inserted in chunks with a single executemany INSERT per chunk, and committed
+every few chunks. Exports are generators of text blocks so a whole table can
+be written to a file or an HTTP response without being held in memory.
+"""
+
+import csv
+import io
+import json
+import time
+from datetime import date, datetime
+from decimal import Decimal
+from itertools import islice
+
+from sqlalchemy import select
+
+
+FORMATS = ('csv', 'jsonl')
+DEFAULT_CHUNK_SIZE = 5000
+DEFAULT_CHUNKS_PER_COMMIT = 10
+# Keeps IN (...) lists under SQLite's bound parameter limit.
+LOOKUP_BATCH_SIZE = 500
+MAX_REPORTED_ERRORS = 100
+
+
+class ImportReport(object):
+    """ Counts and timing of one import run """
+
+    def __init__(self):
+        self.inserted = 0
+        self.rejected = 0
+        self.errors = []
+        self.seconds = 0.0
+
+    @property
+    def rows_per_second(self):
+        if not self.seconds:
+            return 0.0
+        return self.inserted / self.seconds
+
+    def reject(self, line, message):
+        self.rejected += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line, 'error': message})
+
+    def as_dict(self):
+        return {
+            'inserted': self.inserted,
+            'rejected': self.rejected,
+            'errors': self.errors,
+            'seconds': round(self.seconds, 3),
+            'rows_per_second': round(self.rows_per_second, 1),
+        }
+
+    def __str__(self):
+        return 'Imported {} rows ({} rejected) in {:.2f}s, {:.0f} rows/s'.format(
+            self.inserted, self.rejected, self.seconds, self.rows_per_second)
+
+
+def guess_format(filename):
+    """ Pick csv or jsonl from a file name, defaulting to csv """
+    if filename and filename.lower().endswith(('.jsonl', '.ndjson', '.json')):
+        return 'jsonl'
+    return 'csv'
+
+
+def read_rows(stream, fmt):
+    """ Yield (line number, dict) pairs from a text stream """
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+    elif fmt == 'jsonl':
+        for number, line in enumerate(stream, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as ex:
+                yield number, ex
+                continue
+            yield number, row
+    else:
+        raise ValueError('Unknown format {!r}, expected one of {}'.format(fmt, ', '.join(FORMATS)))
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def existing_keys(session, column, keys):
+    """ The subset of keys present in column, looked up in IN batches """
+    found = set()
+    keys = list(keys)
+    for start in range(0, len(keys), LOOKUP_BATCH_SIZE):
+        batch = keys[start:start + LOOKUP_BATCH_SIZE]
+        found.update(key for (key,) in session.execute(select([column]).where(column.in_(batch))))
+    return found
+
+
+def import_rows(session, table, stream, fmt, validate, references=None,
+                chunk_size=DEFAULT_CHUNK_SIZE, chunks_per_commit=DEFAULT_CHUNKS_PER_COMMIT, progress=None):
+    """ Stream rows from stream into table and return an ImportReport
+
+    validate(row) receives each parsed row as a dict and returns the values
+    to insert, or raises ValueError to reject the row. references maps a
+    field of the validated values to the column it must exist in; each
+    chunk is checked with one IN query per reference. Each chunk of valid
+    rows is sent as one executemany INSERT and the transaction is committed
+    every chunks_per_commit chunks, after which progress(report) is called
+    if given.
+    """
+    report = ImportReport()
+    started = time.perf_counter()
+    insert = table.insert()
+    pending = 0
+
+    for chunk in _chunks(read_rows(stream, fmt), chunk_size):
+        valid = []
+        for line, row in chunk:
+            if isinstance(row, Exception):
+                report.reject(line, str(row))
+                continue
+            if not isinstance(row, dict):
+                report.reject(line, 'expected an object')
+                continue
+            try:
+                valid.append((line, validate(row)))
+            except (KeyError, TypeError, ValueError, ArithmeticError) as ex:
+                report.reject(line, '{}: {}'.format(type(ex).__name__, ex))
+
+        for field, column in (references or {}).items():
+            wanted = {row[field] for line, row in valid if row.get(field) is not None}
+            found = existing_keys(session, column, wanted)
+            checked = []
+            for line, row in valid:
+                if row.get(field) is not None and row[field] not in found:
+                    report.reject(line, 'unknown {} {}'.format(field, row[field]))
+                else:
+                    checked.append((line, row))
+            valid = checked
+
+        values = [row for line, row in valid]
+        if values:
+            session.execute(insert, values)
+            report.inserted += len(values)
+            pending += 1
+        if pending >= chunks_per_commit:
+            session.commit()
+            pending = 0
+            if progress is not None:
+                progress(report)
+
+    session.commit()
+    report.seconds = time.perf_counter() - started
+    return report
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError('Cannot serialize %r' % (value,))
+
+
+def export_rows(rows, columns, fmt, batch_size=DEFAULT_CHUNK_SIZE):
+    """ Yield blocks of CSV or JSON Lines text for an iterable of row tuples """
+    buffer = io.StringIO()
+    if fmt == 'csv':
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        write = writer.writerow
+    elif fmt == 'jsonl':
+        def write(row):
+            buffer.write(json.dumps(dict(zip(columns, row)), default=_json_default))
+            buffer.write('\n')
+    else:
+        raise ValueError('Unknown format {!r}, expected one of {}'.format(fmt, ', '.join(FORMATS)))
+
+    for number, row in enumerate(rows, 1):
+        write(row)
+        if number % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
@@ -0,0 +1,237 @@
+""" Read-through cache for rarely changing reference data
+
+Values are loaded on a miss, kept for a TTL and dropped early by explicit
+invalidation from the routes that change them. The storage backend is
+pluggable: SimpleBackend keeps values in this process, RedisBackend shares
+them between worker processes through any client that speaks the redis-py
+get/set/delete API (a local Redis, or a stand-in such as fakeredis).
+
+    cache = Cache()
+    cache.init_app(app)
+    categories = cache.get_or_set('categories', load_categories)
+    cache.invalidate('categories')
+"""
+
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+
+
+class SimpleBackend(object):
+    """ In-process dictionary with per-key expiry """
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                return False, None
+            expires, value = entry
+            if expires is not None and expires < time.monotonic():
+                del self._values[key]
+                return False, None
+            return True, value
+
+    def set(self, key, value, ttl):
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._values[key] = (expires, value)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._values.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class LRUBackend(object):
+    """ In-process dictionary holding at most max_entries, least recently used first out """
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                return False, None
+            expires, value = entry
+            if expires is not None and expires < time.monotonic():
+                del self._values[key]
+                return False, None
+            self._values.move_to_end(key)
+            return True, value
+
+    def set(self, key, value, ttl):
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._values[key] = (expires, value)
+            self._values.move_to_end(key)
+            while len(self._values) > self.max_entries:
+                self._values.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._values.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class NullBackend(object):
+    """ Caches nothing; every lookup is a miss """
+
+    def get(self, key):
+        return False, None
+
+    def set(self, key, value, ttl):
+        pass
+
+    def delete(self, *keys):
+        pass
+
+    def clear(self):
+        pass
+
+
+class RedisBackend(object):
+    """ Stores pickled values in Redis so every worker shares them """
+
+    def __init__(self, client=None, url='redis://localhost:6379/0', prefix='shop24:'):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        if raw is None:
+            return False, None
+        return True, pickle.loads(raw)
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=ttl or None)
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+
+BACKENDS = {
+    'simple': SimpleBackend,
+    'null': NullBackend,
+    'lru': LRUBackend,
+    'redis': RedisBackend,
+}
+
+
+class CacheState(object):
+    """ One app's backend and hit/miss counters """
+
+    def __init__(self, backend, default_ttl):
+        self.backend = backend
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+
+class Cache(object):
+    """ Flask extension wrapping a backend with hit/miss counters
+
+    The backend and counters belong to each app, in app.extensions['cache'],
+    so apps built in the same process do not share them.
+
+    Config:
+        CACHE_BACKEND      'simple', 'lru', 'null', 'redis' or a backend instance
+        CACHE_DEFAULT_TTL  seconds a value lives without invalidation
+        CACHE_REDIS_URL    used by the redis backend
+        CACHE_KEY_PREFIX   namespace for keys in a shared backend
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('CACHE_BACKEND', 'simple')
+        app.config.setdefault('CACHE_DEFAULT_TTL', 300)
+        app.config.setdefault('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+        app.config.setdefault('CACHE_KEY_PREFIX', 'shop24:')
+
+        backend = app.config['CACHE_BACKEND']
+        if backend == 'redis':
+            backend = RedisBackend(url=app.config['CACHE_REDIS_URL'],
+                                   prefix=app.config['CACHE_KEY_PREFIX'])
+        elif isinstance(backend, str):
+            backend = BACKENDS[backend]()
+        app.extensions['cache'] = CacheState(backend, app.config['CACHE_DEFAULT_TTL'])
+
+    @property
+    def state(self):
+        return current_app.extensions['cache']
+
+    @property
+    def backend(self):
+        return self.state.backend
+
+    def _count(self, hit):
+        state = self.state
+        with state.lock:
+            if hit:
+                state.hits += 1
+            else:
+                state.misses += 1
+
+    def get(self, key, default=None):
+        found, value = self.backend.get(key)
+        self._count(found)
+        return value if found else default
+
+    def set(self, key, value, ttl=None):
+        self.backend.set(key, value, self.state.default_ttl if ttl is None else ttl)
+
+    def get_or_set(self, key, loader, ttl=None):
+        """ Return the cached value for key, calling loader() on a miss """
+        found, value = self.backend.get(key)
+        self._count(found)
+        if not found:
+            value = loader()
+            self.set(key, value, ttl)
+        return value
+
+    def invalidate(self, *keys):
+        self.backend.delete(*keys)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        state = self.state
+        with state.lock:
+            hits, misses = state.hits, state.misses
+        lookups = hits + misses
+        return {
+            'backend': type(self.backend).__name__,
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': round(hits / lookups, 4) if lookups else 0.0,
+        }
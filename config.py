@@ -0,0 +1,122 @@
+""" Configuration for shop24, read from the environment
+
+Pick a configuration with SHOP24_ENV (development or production) and
+override individual settings with the variables below, e.g.
+
+    SHOP24_ENV=production
+    SQLALCHEMY_DATABASE_URI=postgresql://shop24@db/shop24
+    SECRET_KEY=...
+"""
+
+import os
+
+
+def env_bool(name, default):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def env_int(name, default):
+    value = os.environ.get(name)
+    if value is None or value.strip() == '':
+        return default
+    return int(value)
+
+
+class Config(object):
+    SECRET_KEY = os.environ.get('SECRET_KEY', "What is going on")
+
+    # DATABASE_URL is what most hosting platforms export.
+    SQLALCHEMY_DATABASE_URI = (os.environ.get('SQLALCHEMY_DATABASE_URI')
+                               or os.environ.get('DATABASE_URL')
+                               or 'sqlite:///shop24.db')
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # Connection pool, per worker process.
+    DB_POOL_SIZE = env_int('DB_POOL_SIZE', 5)
+    DB_MAX_OVERFLOW = env_int('DB_MAX_OVERFLOW', 10)
+    DB_POOL_TIMEOUT = env_int('DB_POOL_TIMEOUT', 30)
+    DB_POOL_RECYCLE = env_int('DB_POOL_RECYCLE', 1800)
+
+    # Applied to every SQLite connection, see models.configure_engine().
+    SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')
+    SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+    SQLITE_BUSY_TIMEOUT = env_int('SQLITE_BUSY_TIMEOUT', 5000)  # milliseconds
+
+    TEMPLATES_AUTO_RELOAD = env_bool('TEMPLATES_AUTO_RELOAD', True)
+    # Template precompilation and hashed static URLs, see assets.py.
+    TEMPLATES_PRECOMPILE = env_bool('TEMPLATES_PRECOMPILE', False)
+    TEMPLATE_BYTECODE_CACHE = env_bool('TEMPLATE_BYTECODE_CACHE', False)
+    TEMPLATE_BYTECODE_CACHE_DIR = os.environ.get('TEMPLATE_BYTECODE_CACHE_DIR')
+    STATIC_HASHED_URLS = env_bool('STATIC_HASHED_URLS', False)
+    STATIC_HASHED_MAX_AGE = env_int('STATIC_HASHED_MAX_AGE', 31536000)
+
+    PAGE_SIZE = env_int('PAGE_SIZE', 50)
+    MAX_PAGE_SIZE = env_int('MAX_PAGE_SIZE', 500)
+    EXPORT_BATCH_SIZE = env_int('EXPORT_BATCH_SIZE', 1000)
+    # How views load related rows: selectin, joined, subquery or lazy.
+    EAGER_LOADING = os.environ.get('EAGER_LOADING', 'selectin')
+    MAX_BASKET_LINES = env_int('MAX_BASKET_LINES', 200)
+    # Items per /api/v1 bulk write or ?ids= read.
+    API_MAX_BATCH = env_int('API_MAX_BATCH', 500)
+    # Markup over cost when no pricing rule applies, see pricing.py.
+    DEFAULT_MARKUP = os.environ.get('DEFAULT_MARKUP', '1.3')
+    REPRICE_CHUNK_SIZE = env_int('REPRICE_CHUNK_SIZE', 5000)
+
+    CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'simple')
+    CACHE_DEFAULT_TTL = env_int('CACHE_DEFAULT_TTL', 300)
+    CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+
+    # Background jobs, see jobs.py.
+    JOB_WORKER_THREADS = env_int('JOB_WORKER_THREADS', 1)
+    JOB_POLL_SECONDS = float(os.environ.get('JOB_POLL_SECONDS', 1.0))
+    JOB_STALE_SECONDS = env_int('JOB_STALE_SECONDS', 600)
+    JOB_MAX_ATTEMPTS = env_int('JOB_MAX_ATTEMPTS', 3)
+
+    # Password hashing and login throttling, see security.py.
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:150000')
+    PASSWORD_SALT_LENGTH = env_int('PASSWORD_SALT_LENGTH', 8)
+    PASSWORD_HASH_POOL = os.environ.get('PASSWORD_HASH_POOL', 'thread')
+    PASSWORD_HASH_WORKERS = env_int('PASSWORD_HASH_WORKERS', 2)
+    PASSWORD_HASH_TIMEOUT = float(os.environ.get('PASSWORD_HASH_TIMEOUT', 5))
+    LOGIN_RATE_LIMIT_ENABLED = env_bool('LOGIN_RATE_LIMIT_ENABLED', True)
+    LOGIN_IP_BURST = env_int('LOGIN_IP_BURST', 20)
+    LOGIN_IP_PER_MINUTE = env_int('LOGIN_IP_PER_MINUTE', 20)
+    LOGIN_USERNAME_BURST = env_int('LOGIN_USERNAME_BURST', 5)
+    LOGIN_USERNAME_PER_MINUTE = env_int('LOGIN_USERNAME_PER_MINUTE', 5)
+    USER_CACHE_SIZE = env_int('USER_CACHE_SIZE', 1000)
+    USER_CACHE_TTL = env_int('USER_CACHE_TTL', 60)
+
+    SLOW_REQUEST_SECONDS = float(os.environ.get('SLOW_REQUEST_SECONDS', 0.5))
+    PROFILING_ENABLED = env_bool('PROFILING_ENABLED', False)
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+
+class DevelopmentConfig(Config):
+    DEBUG = True
+
+
+class ProductionConfig(Config):
+    DEBUG = False
+    # No default: the development one is public. create_app() refuses to
+    # start without a key.
+    SECRET_KEY = os.environ.get('SECRET_KEY')
+    TEMPLATES_AUTO_RELOAD = env_bool('TEMPLATES_AUTO_RELOAD', False)
+    TEMPLATES_PRECOMPILE = env_bool('TEMPLATES_PRECOMPILE', True)
+    TEMPLATE_BYTECODE_CACHE = env_bool('TEMPLATE_BYTECODE_CACHE', True)
+    STATIC_HASHED_URLS = env_bool('STATIC_HASHED_URLS', True)
+    # Run `flask worker` next to the web processes instead.
+    JOB_WORKER_THREADS = env_int('JOB_WORKER_THREADS', 0)
+
+
+configs = {
+    'development': DevelopmentConfig,
+    'production': ProductionConfig,
+}
+
+
+def get_config(name=None):
+    """ Return the config class for name, or for SHOP24_ENV """
+    return configs[name or os.environ.get('SHOP24_ENV', 'development')]
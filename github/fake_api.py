@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+""" A local stand-in for the GitHub issues API, for trying report_stories.py
+
+Serves GET /repos/<owner>/<name>/issues with the parameters, Link headers,
+ETags and 304 answers report_stories.py relies on, over --issues generated
+issues (every tenth one a pull request):
+
+$ python3 github/fake_api.py --issues 500 --latency 0.05 &
+$ python3 github/report_stories.py --api-url http://127.0.0.1:8765
+
+POST /touch/<number> marks an issue as updated now, and closes it with
+?state=closed, to see an incremental run pick up the change. Every request
+is logged to standard error.
+"""
+
+import argparse
+import hashlib
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+LABELS = ["user story", "priority 1", "priority 2", "bug"]
+
+
+def make_issues(count):
+    start = datetime(2020, 1, 1)
+    issues = {}
+    for number in range(1, count + 1):
+        issue = {
+            "number": number,
+            "title": "Story {}".format(number),
+            "state": "closed" if number % 7 == 0 else "open",
+            "labels": [{"name": name} for index, name in enumerate(LABELS) if number % (index + 2) == 0],
+            "html_url": "https://github.example/issues/{}".format(number),
+            "updated_at": (start + timedelta(hours=number)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "body": "As a shopper I want feature {}.".format(number),
+        }
+        if number % 10 == 0:
+            issue["pull_request"] = {"url": "https://github.example/pulls/{}".format(number)}
+        issues[number] = issue
+    return issues
+
+
+class FakeGithub(BaseHTTPRequestHandler):
+    issues = {}
+    latency = 0.0
+    lock = threading.Lock()
+
+    def _send(self, status, body=None, headers=()):
+        data = json.dumps(body).encode("utf-8") if body is not None else b""
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        if len(parts) != 4 or parts[0] != "repos" or parts[3] != "issues":
+            return self._send(404, {"message": "Not Found"})
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        state = params.get("state", "open")
+        since = params.get("since")
+        per_page = min(int(params.get("per_page", 30)), 100)
+        page = int(params.get("page", 1))
+
+        with self.lock:
+            issues = [
+                issue for issue in self.issues.values()
+                if (state == "all" or issue["state"] == state) and (not since or issue["updated_at"] >= since)
+            ]
+        issues.sort(key=lambda issue: (issue["updated_at"], issue["number"]),
+                    reverse=params.get("direction", "desc") == "desc")
+        body = issues[(page - 1) * per_page:page * per_page]
+
+        etag = '"{}"'.format(hashlib.sha1(json.dumps(body, sort_keys=True).encode("utf-8")).hexdigest())
+        if self.headers.get("If-None-Match") == etag:
+            return self._send(304, headers=[("ETag", etag)])
+        last = max(1, -(-len(issues) // per_page))
+        headers = [("ETag", etag)]
+        if last > 1:
+            headers.append(("Link", '<{}?{}>; rel="last"'.format(
+                url.path, urlencode(dict(params, page=last)))))
+        self._send(200, body, headers)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        if len(parts) != 2 or parts[0] != "touch" or int(parts[1]) not in self.issues:
+            return self._send(404, {"message": "Not Found"})
+        with self.lock:
+            issue = self.issues[int(parts[1])]
+            issue["state"] = parse_qs(url.query).get("state", [issue["state"]])[-1]
+            issue["updated_at"] = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+        self._send(200, issue)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--issues", type=int, default=250)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every GET")
+    args = parser.parse_args()
+
+    FakeGithub.issues = make_issues(args.issues)
+    FakeGithub.latency = args.latency
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), FakeGithub)
+    print("Serving {} issues on http://127.0.0.1:{}".format(args.issues, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
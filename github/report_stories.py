@@ -1,91 +1,247 @@
 #!/usr/bin/env python3
 """ Script to report issues from github repository
-Depends on PyGithub and requires an exported env var
-for Github API access.
 
-Create a virtual environment in the root directory of shop24:
+Prints the open issues labelled "user story" as Markdown or JSON, for
+pasting into the submission doc. Uses only the standard library; a token
+is optional for public repositories but raises the rate limit:
 
-$ python3 -m venv venv
-$ source venv/bin/activate
-(venv) $ export GITHUB_TOKEN="f41...a9"
-(venv) $ python3 github/report_stories.py
+$ export GITHUB_TOKEN="f41...a9"
+$ python3 github/report_stories.py
+$ python3 github/report_stories.py --format json --out stories.json
+$ python3 github/report_stories.py --label "user story" --label "priority 1"
 
+Obtain a token at https://github.com/settings/tokens and save it
+somewhere securely, as github will not display it again.
+
+Every response is cached on disk with its ETag and the next request for
+the same URL is sent with If-None-Match, so an unchanged page costs a 304
+and no rate limit. Issues are kept between runs too: after the first run
+only issues updated since the newest one already seen are fetched (closed
+ones included, so they drop out of the report). Pages are fetched
+concurrently once the first page says how many there are.
+
+--api-url points the script at another server, such as GitHub Enterprise
+or the fake API in github/fake_api.py:
+
+$ python3 github/fake_api.py --issues 500 &
+$ python3 github/report_stories.py --api-url http://127.0.0.1:8765
 """
 
+import argparse
+import hashlib
+import json
 import os
-from github import Github
-
-
-def export_issues():
-    """ Function to export issues as formatted text
-
-        Obtain token at github https://github.com/settings/tokens
-        Save somewhere securely as github will not display it again
-
-        Export token as environment variabe.
-        On Linux:
-        export GITHUB_TOKEN="f41...a9"
-        Then run this script using python 3
-
-        Example of issue API access follows
-        customize the format string to taste.
-
-        Try to paste format into submission doc without manual formatting
-        use monospace font (defined style exists)
-
-        >>> import os
-        >>> from github import Github
-        >>> g = Github(os.getenv("GITHUB_TOKEN"))  # access token
-        >>> repo = g.get_repo("kowalczj/shop24")
-        >>> label_user_story = repo.get_label("user story")
-        >>> label_priority_1 = repo.get_label("priority 1")
-        >>> issues = repo.get_issues()
-        >>> issue = issues[0]
-        >>> issue.
-        issue.CHECK_AFTER_INIT_FLAG issue.get_timeline(
-        issue.active_lock_reason    issue.html_url
-        issue.add_to_assignees(     issue.id
-        issue.add_to_labels(        issue.labels
-        issue.as_pull_request(      issue.labels_url
-        issue.assignee              issue.last_modified
-        issue.assignees             issue.lock(
-        issue.body                  issue.locked
-        issue.closed_at             issue.milestone
-        issue.closed_by             issue.number
-        issue.comments              issue.pull_request
-        issue.comments_url          issue.raw_data
-        issue.create_comment(       issue.raw_headers
-        issue.create_reaction(      issue.remove_from_assignees(
-        issue.created_at            issue.remove_from_labels(
-        issue.delete_labels(        issue.repository
-        issue.edit(                 issue.setCheckAfterInitFlag(
-        issue.etag                  issue.set_labels(
-        issue.events_url            issue.state
-        issue.get__repr__(          issue.title
-        issue.get_comment(          issue.unlock(
-        issue.get_comments(         issue.update(
-        issue.get_events(           issue.updated_at
-        issue.get_labels(           issue.url
-        issue.get_reactions(        issue.user
-        """
-    g = Github(os.getenv("GITHUB_TOKEN"))  # access token
-
-    repo = g.get_repo("kowalczj/shop24")
-
-    label_user_story = repo.get_label("user story")
-    label_priority_1 = repo.get_label("priority 1")
-
-    for issue in repo.get_issues(
-        state="open", direction="desc", labels=[label_user_story,]
-    ):
-        print(
-            "#{}: {}\n{}\n{}\n\n".format(
-                issue.number,
-                issue.title,
-                ", ".join([label.name for label in issue.labels]),
-                issue.body,
-            )
+import re
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.parse import parse_qs, quote, urlencode, urlparse
+from urllib.request import Request, urlopen
+
+API_URL = os.environ.get("GITHUB_API_URL", "https://api.github.com")
+# An empty GITHUB_CACHE_DIR falls back to the default too.
+CACHE_DIR = os.environ.get("GITHUB_CACHE_DIR") or os.path.join(
+    os.path.expanduser("~"), ".cache", "shop24-github"
+)
+PER_PAGE = 100
+LINK_LAST = re.compile(r'<([^>]+)>;\s*rel="last"')
+
+
+class GithubError(Exception):
+    """ A request the API refused or answered with an error """
+
+
+class Client(object):
+    """ GET requests against the API with an on-disk ETag cache """
+
+    def __init__(self, api_url=API_URL, token=None, cache_dir=CACHE_DIR, timeout=30):
+        self.api_url = api_url.rstrip("/")
+        self.token = token
+        self.cache_dir = cache_dir
+        self.timeout = timeout
+        self.requests = 0
+        self.not_modified = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _cache_path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".json")
+
+    def _read_cache(self, url):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._cache_path(url), encoding="utf-8") as cached:
+                return json.load(cached)
+        except (OSError, ValueError):
+            return None
+
+    def _write_cache(self, url, entry):
+        if self.cache_dir:
+            write_json(self._cache_path(url), entry)
+
+    def get(self, path, params=None):
+        """ (decoded body, Link header) of path, from the cache when unchanged """
+        url = self.api_url + path
+        if params:
+            url += "?" + urlencode(params)
+        headers = {"Accept": "application/vnd.github.v3+json", "User-Agent": "shop24-report-stories"}
+        if self.token:
+            headers["Authorization"] = "token " + self.token
+        cached = self._read_cache(url)
+        if cached and cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+
+        self.requests += 1
+        try:
+            with urlopen(Request(url, headers=headers), timeout=self.timeout) as response:
+                entry = {
+                    "etag": response.headers.get("ETag"),
+                    "link": response.headers.get("Link"),
+                    "body": json.loads(response.read().decode("utf-8")),
+                }
+        except HTTPError as ex:
+            if ex.code == 304 and cached:
+                self.not_modified += 1
+                return cached["body"], cached.get("link")
+            if ex.code in (403, 429) and ex.headers.get("X-RateLimit-Remaining") == "0":
+                reset = int(ex.headers.get("X-RateLimit-Reset", 0))
+                raise GithubError("Rate limit exceeded until {}; set GITHUB_TOKEN for a higher limit".format(
+                    time.strftime("%H:%M:%S", time.localtime(reset))))
+            raise GithubError("GET {} failed: {} {}".format(url, ex.code, ex.reason))
+        self._write_cache(url, entry)
+        return entry["body"], entry["link"]
+
+
+def write_json(path, value):
+    """ Replace path atomically, so concurrent or interrupted runs never leave half a file """
+    directory = os.path.dirname(path) or "."
+    handle, temporary = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(handle, "w", encoding="utf-8") as out:
+        json.dump(value, out)
+    os.replace(temporary, path)
+
+
+def last_page(link):
+    """ The page number of the rel="last" link, 1 when there is none """
+    match = LINK_LAST.search(link or "")
+    if not match:
+        return 1
+    return int(parse_qs(urlparse(match.group(1)).query).get("page", ["1"])[0])
+
+
+def fetch_issues(client, repo, since=None, workers=8):
+    """ Every issue of repo, open or closed, updated at or after since
+
+    The first page is fetched alone for its Link header; the remaining
+    pages are fetched by workers threads.
+    """
+    path = "/repos/{}/issues".format(quote(repo))
+    params = {"state": "all", "sort": "updated", "direction": "asc", "per_page": PER_PAGE}
+    if since:
+        params["since"] = since
+    first, link = client.get(path, dict(params, page=1))
+    pages = range(2, last_page(link) + 1)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        rest = pool.map(lambda page: client.get(path, dict(params, page=page))[0], pages)
+        issues = list(first)
+        for body in rest:
+            issues.extend(body)
+    # The issues endpoint lists pull requests too.
+    return [issue for issue in issues if "pull_request" not in issue]
+
+
+def sync_issues(client, repo, workers=8):
+    """ {number: issue} for repo, read from the last run and brought up to date """
+    if not client.cache_dir:
+        # The state file would land in the working directory instead.
+        raise ValueError("sync_issues needs a client with a cache directory")
+    state_path = os.path.join(client.cache_dir, "issues-{}.json".format(
+        hashlib.sha1((client.api_url + "/" + repo).encode("utf-8")).hexdigest()))
+    try:
+        with open(state_path, encoding="utf-8") as saved:
+            state = json.load(saved)
+    except (OSError, ValueError):
+        state = {"since": None, "issues": {}}
+
+    for issue in fetch_issues(client, repo, state["since"], workers):
+        state["issues"][str(issue["number"])] = issue
+        if state["since"] is None or issue["updated_at"] > state["since"]:
+            state["since"] = issue["updated_at"]
+    write_json(state_path, state)
+    return state["issues"]
+
+
+def select_stories(issues, labels, state="open"):
+    """ Issues in state carrying every one of labels, newest first """
+    wanted = set(labels)
+    stories = [
+        issue for issue in issues.values()
+        if (state == "all" or issue["state"] == state)
+        and wanted <= {label["name"] for label in issue["labels"]}
+    ]
+    return sorted(stories, key=lambda issue: issue["number"], reverse=True)
+
+
+def story(issue):
+    return {
+        "number": issue["number"],
+        "title": issue["title"],
+        "state": issue["state"],
+        "labels": [label["name"] for label in issue["labels"]],
+        "url": issue.get("html_url"),
+        "updated_at": issue["updated_at"],
+        "body": issue.get("body") or "",
+    }
+
+
+def to_markdown(stories):
+    return "".join(
+        "#{}: {}\n{}\n{}\n\n".format(
+            issue["number"], issue["title"], ", ".join(issue["labels"]), issue["body"]
         )
+        for issue in stories
+    )
+
+
+def export_issues(argv=None):
+    """ Function to export issues as formatted text """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--repo", default="kowalczj/shop24", help="owner/name")
+    parser.add_argument("--label", action="append", dest="labels",
+                        help='only issues with this label, may repeat (default: "user story")')
+    parser.add_argument("--state", choices=("open", "closed", "all"), default="open")
+    parser.add_argument("--format", dest="fmt", choices=("markdown", "json"), default="markdown")
+    parser.add_argument("--out", help="write here instead of standard output")
+    parser.add_argument("--api-url", default=API_URL)
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    parser.add_argument("--workers", type=int, default=8, help="pages fetched at once")
+    args = parser.parse_args(argv)
+    if not args.cache_dir:
+        parser.error("--cache-dir must not be empty")
+
+    client = Client(args.api_url, os.getenv("GITHUB_TOKEN"), args.cache_dir)
+    started = time.perf_counter()
+    try:
+        issues = sync_issues(client, args.repo, args.workers)
+    except (GithubError, OSError) as ex:
+        sys.exit("error: {}".format(ex))
+    stories = [story(issue) for issue in select_stories(issues, args.labels or ["user story"], args.state)]
+
+    if args.fmt == "json":
+        text = json.dumps(stories, indent=2) + "\n"
+    else:
+        text = to_markdown(stories)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as out:
+            out.write(text)
+    else:
+        sys.stdout.write(text)
+    print("{} stories of {} issues; {} requests, {} not modified, {:.2f}s".format(
+        len(stories), len(issues), client.requests, client.not_modified,
+        time.perf_counter() - started), file=sys.stderr)
 
 
 if __name__ == "__main__":
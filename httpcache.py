@@ -0,0 +1,177 @@
+""" Conditional GETs and rendered-fragment caching keyed on table versions
+
+Every INSERT, UPDATE or DELETE sent through the engine (ORM flushes, bulk
+executemany, query.delete(), Core statements) bumps a per-table counter in
+table_version inside the same transaction. A page that only depends on a
+few tables can then be validated with one primary key lookup:
+
+    @main.route('/category')
+    @login_required
+    @http_cache.conditional('category')
+    def category():
+        ...
+
+The response gets a weak ETag and Last-Modified derived from the counters,
+and a request presenting the current ETag is answered 304 Not Modified
+without running the view. Parts of a page can be cached the same way:
+
+    rows = http_cache.fragment('product_table', ('product', 'category'),
+                               lambda: render_template('_product_table.html', ...),
+                               vary=request.query_string)
+
+Fragment keys embed the versions, so a write makes the old entry
+unreachable and it ages out of the cache by its TTL.
+
+Config:
+    HTTP_CACHE_ENABLED  answer conditional requests and cache fragments
+                        (default True)
+    ETAG_SALT           mixed into every ETag and fragment key; defaults to
+                        a hash of the templates so a deploy with changed
+                        markup does not serve old pages as fresh
+"""
+
+import hashlib
+import os
+from datetime import datetime
+from functools import wraps
+
+from flask import current_app, g, make_response, request, session
+from flask_login import current_user
+from markupsafe import Markup
+from sqlalchemy import event
+from sqlalchemy.sql.dml import UpdateBase
+
+from models import db, TableVersion
+
+
+def template_fingerprint(app):
+    """ Short hash of every template's path and content """
+    digest = hashlib.sha1()
+    root = os.path.join(app.root_path, app.template_folder)
+    for directory, subdirectories, filenames in os.walk(root):
+        subdirectories.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(directory, filename)
+            digest.update(os.path.relpath(path, root).encode('utf-8'))
+            with open(path, 'rb') as template:
+                digest.update(template.read())
+    return digest.hexdigest()[:12]
+
+
+def bump(connection, table_name):
+    """ Increment table_name's version on connection, in its transaction """
+    table = TableVersion.__table__
+    now = datetime.utcnow()
+    updated = connection.execute(
+        table.update()
+        .where(table.c.table_name == table_name)
+        .values(version=table.c.version + 1, changed_at=now)).rowcount
+    if not updated:
+        connection.execute(table.insert().values(table_name=table_name, version=1, changed_at=now))
+
+
+def _after_execute(connection, clauseelement, multiparams, params, result):
+    # rowcount is -1 where the driver cannot tell, which still bumps.
+    if isinstance(clauseelement, UpdateBase) and result.rowcount != 0:
+        table_name = clauseelement.table.name
+        # Readers only see committed versions, so one bump per table per
+        # transaction is enough and keeps write transactions short.
+        bumped = connection.info.setdefault('bumped_tables', set())
+        if table_name != TableVersion.__table__.name and table_name not in bumped:
+            bump(connection, table_name)
+            bumped.add(table_name)
+
+
+def _end_transaction(connection, *args):
+    connection.info.pop('bumped_tables', None)
+
+
+def listen(engine):
+    """ Bump table versions for the writes sent through engine; listening twice is a no-op """
+    for name, listener in (('after_execute', _after_execute),
+                           ('commit', _end_transaction),
+                           ('rollback', _end_transaction),
+                           ('rollback_savepoint', _end_transaction)):
+        if not event.contains(engine, name, listener):
+            event.listen(engine, name, listener)
+
+
+class HttpCache(object):
+    """ Flask extension for version-stamped conditional responses and fragments
+
+    Each app keeps the cache its fragments go to in app.extensions['http_cache'].
+    """
+
+    def init_app(self, app, engine, cache):
+        app.config.setdefault('HTTP_CACHE_ENABLED', True)
+        if not app.config.get('ETAG_SALT'):
+            app.config['ETAG_SALT'] = template_fingerprint(app)
+        app.extensions['http_cache'] = cache
+        listen(engine)
+
+    def seed(self):
+        """ Create a version row for every table that lacks one """
+        table = TableVersion.__table__
+        existing = {name for (name,) in db.session.query(TableVersion.table_name)}
+        rows = [{'table_name': name, 'version': 0, 'changed_at': datetime.utcnow()}
+                for name in db.metadata.tables if name not in existing and name != table.name]
+        if rows:
+            db.session.execute(table.insert(), rows)
+        db.session.commit()
+
+    def versions(self, *tables):
+        """ [(table, version, changed_at)], read at most once per table per request """
+        known = g.setdefault('table_versions', {})
+        missing = [table for table in tables if table not in known]
+        if missing:
+            for name, version, changed_at in db.session.query(
+                    TableVersion.table_name, TableVersion.version, TableVersion.changed_at
+            ).filter(TableVersion.table_name.in_(missing)):
+                known[name] = (version, changed_at)
+            for name in missing:
+                known.setdefault(name, (0, None))
+        return [(table,) + known[table] for table in tables]
+
+    def _digest(self, *parts):
+        return hashlib.sha1(repr((current_app.config['ETAG_SALT'],) + parts).encode('utf-8')).hexdigest()
+
+    def conditional(self, *tables):
+        """ Decorate a view whose GET output only changes when tables do """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                # Pending flash messages are rendered into the page once, so
+                # such a response must neither be skipped nor revalidated.
+                if (request.method not in ('GET', 'HEAD') or '_flashes' in session
+                        or not current_app.config['HTTP_CACHE_ENABLED']):
+                    return view(*args, **kwargs)
+
+                stamps = self.versions(*tables)
+                etag = self._digest(request.full_path, current_user.get_id(),
+                                    [(name, version) for name, version, changed_at in stamps])
+                changed = [changed_at for name, version, changed_at in stamps if changed_at]
+                last_modified = max(changed).replace(microsecond=0) if changed else None
+
+                if request.if_none_match:
+                    fresh = request.if_none_match.contains_weak(etag)
+                else:
+                    fresh = bool(last_modified and request.if_modified_since
+                                 and last_modified <= request.if_modified_since)
+                response = make_response(('', 304) if fresh else view(*args, **kwargs))
+                if response.status_code in (200, 304):
+                    response.set_etag(etag, weak=True)
+                    response.last_modified = last_modified
+                    response.cache_control.private = True
+                    response.cache_control.no_cache = True
+                    response.vary.add('Cookie')
+                return response
+            return wrapper
+        return decorator
+
+    def fragment(self, name, tables, render, vary=''):
+        """ HTML from render(), cached until one of tables is written to """
+        if not current_app.config['HTTP_CACHE_ENABLED']:
+            return Markup(render())
+        stamps = [(table, version) for table, version, changed_at in self.versions(*tables)]
+        key = 'fragment:{}:{}'.format(name, self._digest(vary, stamps))
+        return Markup(current_app.extensions['http_cache'].get_or_set(key, lambda: str(render())))
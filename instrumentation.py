@@ -0,0 +1,245 @@
+""" Per-request timing, SQL counting and opt-in profiling
+
+For every request this records the wall time, the SQL statements run (via
+SQLAlchemy cursor events) with their total time, and the template render
+time. The numbers feed Prometheus-style histograms per endpoint, are
+returned in a Server-Timing header, and requests slower than
+SLOW_REQUEST_SECONDS are logged together with their queries.
+
+With PROFILING_ENABLED set, adding ?profile=1 to a URL returns a cProfile
+report for that request instead of the page (?profile=pyinstrument uses
+pyinstrument when it is installed).
+
+Config:
+    INSTRUMENTATION_ENABLED  record anything at all (default True)
+    SLOW_REQUEST_SECONDS     log requests slower than this (default 0.5)
+    PROFILING_ENABLED        allow ?profile= (default False)
+    METRICS_TOKEN            bearer token accepted by /admin/metrics
+"""
+
+import io
+import threading
+import time
+
+from flask import Blueprint, Response, abort, current_app, g, has_request_context, request
+from flask import before_render_template, template_rendered
+from flask_login import current_user
+from sqlalchemy import event
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class Histogram(object):
+    """ Cumulative-bucket histogram keyed by a label value """
+
+    def __init__(self, name, documentation, label, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [[0] * len(self.buckets), 0.0, 0]
+            counts = series[0]
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[position] += 1
+            series[1] += value
+            series[2] += 1
+
+    def expose(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} histogram'.format(self.name),
+        ]
+        with self._lock:
+            series = sorted((key, list(counts), total, count)
+                            for key, (counts, total, count) in self._series.items())
+        for label_value, counts, total, count in series:
+            label = '{}="{}"'.format(self.label, label_value)
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(self.name, label, bound, bucket_count))
+            lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(self.name, label, count))
+            lines.append('{}_sum{{{}}} {}'.format(self.name, label, total))
+            lines.append('{}_count{{{}}} {}'.format(self.name, label, count))
+        return '\n'.join(lines)
+
+
+class RequestStats(object):
+    """ What one request spent its time on """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = []
+        self.sql_seconds = 0.0
+        self.render_seconds = 0.0
+        self._render_started = None
+
+    def add_query(self, statement, parameters, seconds):
+        self.queries.append((statement, parameters, seconds))
+        self.sql_seconds += seconds
+
+
+def _current_stats():
+    if has_request_context():
+        return g.get('request_stats')
+    return None
+
+
+class RequestMetrics(object):
+    """ One app's request histograms """
+
+    def __init__(self):
+        self.request_seconds = Histogram(
+            'shop24_request_duration_seconds', 'Wall time per request.', 'endpoint')
+        self.sql_seconds = Histogram(
+            'shop24_request_sql_seconds', 'Time spent in SQL per request.', 'endpoint')
+        self.sql_queries = Histogram(
+            'shop24_request_sql_queries', 'SQL statements per request.', 'endpoint', QUERY_BUCKETS)
+        self.render_seconds = Histogram(
+            'shop24_request_render_seconds', 'Template render time per request.', 'endpoint')
+
+    @property
+    def histograms(self):
+        return (self.request_seconds, self.sql_seconds, self.sql_queries, self.render_seconds)
+
+    def observe(self, endpoint, seconds, stats):
+        self.request_seconds.observe(endpoint, seconds)
+        self.sql_seconds.observe(endpoint, stats.sql_seconds)
+        self.sql_queries.observe(endpoint, len(stats.queries))
+        self.render_seconds.observe(endpoint, stats.render_seconds)
+
+    def expose(self):
+        return '\n'.join(histogram.expose() for histogram in self.histograms) + '\n'
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info['query_started'].pop()
+    stats = _current_stats()
+    if stats is not None:
+        stats.add_query(statement, parameters, seconds)
+
+
+def listen(engine):
+    """ Time the statements run on engine; listening twice is a no-op """
+    for name, listener in (('before_cursor_execute', _before_cursor_execute),
+                           ('after_cursor_execute', _after_cursor_execute)):
+        if not event.contains(engine, name, listener):
+            event.listen(engine, name, listener)
+
+
+class Instrumentation(object):
+    """ Flask extension collecting per-request statistics
+
+    Each app keeps its own RequestMetrics in app.extensions['instrumentation'].
+    """
+
+    def init_app(self, app, engine):
+        app.config.setdefault('INSTRUMENTATION_ENABLED', True)
+        app.config.setdefault('SLOW_REQUEST_SECONDS', 0.5)
+        app.config.setdefault('PROFILING_ENABLED', False)
+        app.config.setdefault('METRICS_TOKEN', None)
+        app.extensions['instrumentation'] = RequestMetrics()
+
+        if not app.config['INSTRUMENTATION_ENABLED']:
+            return
+        listen(engine)
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        before_render_template.connect(self._before_render, app)
+        template_rendered.connect(self._after_render, app)
+        app.register_blueprint(admin)
+
+    def _before_request(self):
+        g.request_stats = RequestStats()
+        if current_app.config['PROFILING_ENABLED'] and request.args.get('profile'):
+            g.profiler = _start_profiler(request.args['profile'])
+
+    def _before_render(self, sender, template, context, **extra):
+        stats = _current_stats()
+        if stats is not None:
+            stats._render_started = time.perf_counter()
+
+    def _after_render(self, sender, template, context, **extra):
+        stats = _current_stats()
+        if stats is not None and stats._render_started is not None:
+            stats.render_seconds += time.perf_counter() - stats._render_started
+            stats._render_started = None
+
+    def _after_request(self, response):
+        stats = g.pop('request_stats', None)
+        if stats is None:
+            return response
+        seconds = time.perf_counter() - stats.started
+        endpoint = request.endpoint or 'unmatched'
+
+        current_app.extensions['instrumentation'].observe(endpoint, seconds, stats)
+        response.headers['Server-Timing'] = 'db;dur={:.1f}, render;dur={:.1f}, total;dur={:.1f}'.format(
+            stats.sql_seconds * 1000, stats.render_seconds * 1000, seconds * 1000)
+
+        if seconds >= current_app.config['SLOW_REQUEST_SECONDS']:
+            current_app.logger.warning(
+                'Slow request %s %s: %.3fs, %d queries in %.3fs, render %.3fs\n%s',
+                request.method, request.full_path.rstrip('?'), seconds, len(stats.queries),
+                stats.sql_seconds, stats.render_seconds,
+                '\n'.join('  {:.4f}s {}'.format(query_seconds, ' '.join(statement.split()))
+                          for statement, parameters, query_seconds in stats.queries))
+
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            return _profile_response(profiler)
+        return response
+
+
+def _start_profiler(kind):
+    if kind == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            Profiler = None
+        if Profiler is not None:
+            profiler = Profiler()
+            profiler.start()
+            return profiler
+
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def _profile_response(profiler):
+    if hasattr(profiler, 'output_html'):
+        profiler.stop()
+        return Response(profiler.output_html(), mimetype='text/html')
+
+    import pstats
+    profiler.disable()
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(60)
+    return Response(out.getvalue(), mimetype='text/plain')
+
+
+admin = Blueprint('admin', __name__, url_prefix='/admin')
+
+
+@admin.route('/metrics')
+def metrics():
+    """Prometheus text exposition of the request histograms."""
+    token = current_app.config['METRICS_TOKEN']
+    authorized = token and request.headers.get('Authorization') == 'Bearer ' + token
+    if not authorized and not current_user.is_authenticated:
+        abort(401)
+    body = current_app.extensions['instrumentation'].expose()
+    return Response(body, mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,137 @@
+""" Stock reservation for order lines
+
+Adding, growing, shrinking, moving or deleting an order line moves units
+between the line and its product's stock_on_hand. Each move is a single
+conditional UPDATE:
+
+    UPDATE product SET stock_on_hand = stock_on_hand - :units
+    WHERE id = :id AND (stock_on_hand IS NULL OR stock_on_hand >= :units)
+
+so the check and the decrement are one atomic step in the database and
+two workers can never both take the last unit, whatever they read before.
+When no row matches, OutOfStock is raised and the caller rolls back the
+whole transaction, its order line included. Every move is also written to
+the stock_movement ledger in the same transaction.
+
+Products whose stock_on_hand is NULL are not tracked: reservations always
+succeed, their product row is not written, and only the ledger records
+them.
+"""
+
+from sqlalchemy import and_
+
+from models import db, Product, StockMovement
+
+
+RESERVE = 'reserve'
+RELEASE = 'release'
+COUNT = 'count'
+
+
+class OutOfStock(Exception):
+    """ A reservation needed more units than a product had on hand """
+
+    def __init__(self, product_id, wanted, available):
+        super(OutOfStock, self).__init__(
+            'Only {} left of product {}, {} wanted'.format(available, product_id, wanted))
+        self.product_id = product_id
+        self.wanted = wanted
+        self.available = available
+
+
+def line_moves(line, previous_product_id=None, previous_quantity=0):
+    """ (product_id, change) pairs taking a line from its previous state to its current one
+
+    Pass no previous state for a new line, and a quantity of 0 for the
+    current state of a deleted one.
+    """
+    # Form handlers assign the submitted strings to the line as they are.
+    product_id, quantity = int(line.product_id), int(line.quantity)
+    moves = []
+    if previous_product_id is not None and int(previous_product_id) != product_id:
+        moves.append((int(previous_product_id), previous_quantity))
+        previous_quantity = 0
+    change = previous_quantity - quantity
+    if change:
+        moves.append((product_id, change))
+    return moves
+
+
+def _take(totals, session):
+    """ Apply {product_id: change}, reservations in product id order
+
+    The fixed order means concurrent multi-line orders lock product rows in
+    the same order on databases with row locks.
+    """
+    table = Product.__table__
+    for product_id in sorted(totals):
+        change = totals[product_id]
+        # Untracked products are left alone: a no-op write would still count
+        # as a change to the product table and expire its cached pages.
+        condition = and_(table.c.id == product_id, table.c.stock_on_hand.isnot(None))
+        if change < 0:
+            condition = and_(condition, table.c.stock_on_hand >= -change)
+        updated = session.execute(table.update().where(condition)
+                                  .values(stock_on_hand=table.c.stock_on_hand + change)).rowcount
+        if not updated and change < 0:
+            found = session.query(Product.stock_on_hand).filter(Product.id == product_id).first()
+            if found is None or found.stock_on_hand is not None:
+                raise OutOfStock(product_id, -change, found.stock_on_hand if found else 0)
+
+
+def move(lines, session=None):
+    """ Apply [(order_id, order_product_id, [(product_id, change)])] and record it
+
+    All lines are applied together: one UPDATE per product and one ledger
+    INSERT, which keeps the write transaction short under contention.
+    """
+    session = session or db.session
+    totals = {}
+    ledger = []
+    for order_id, order_product_id, moves in lines:
+        changes = {}
+        for product_id, change in moves:
+            changes[int(product_id)] = changes.get(int(product_id), 0) + int(change)
+        for product_id, change in sorted(changes.items()):
+            if change:
+                totals[product_id] = totals.get(product_id, 0) + change
+                ledger.append({
+                    'product_id': product_id,
+                    'order_id': order_id,
+                    'order_product_id': order_product_id,
+                    'change': change,
+                    'reason': RESERVE if change < 0 else RELEASE,
+                })
+    _take({product_id: change for product_id, change in totals.items() if change}, session)
+    if ledger:
+        session.execute(StockMovement.__table__.insert(), ledger)
+
+
+def reserve_lines(changes, session=None):
+    """ Apply [(line, previous_product_id, previous_quantity)] for flushed lines """
+    move([(line.order_id, line.id, line_moves(line, previous_product_id, previous_quantity))
+          for line, previous_product_id, previous_quantity in changes], session)
+
+
+def release_line(line, session=None):
+    """ Return a deleted line's units to stock """
+    move([(line.order_id, line.id, [(line.product_id, int(line.quantity))])], session)
+
+
+def set_stock(product_id, level, session=None):
+    """ Set a product's stock after a count; None stops tracking it
+
+    The product row is locked by a no-op UPDATE before its level is read,
+    so the recorded change cannot miss a reservation made in between.
+    """
+    session = session or db.session
+    table = Product.__table__
+    if not session.execute(table.update().where(table.c.id == product_id)
+                           .values(stock_on_hand=table.c.stock_on_hand)).rowcount:
+        raise LookupError('No product {}'.format(product_id))
+    previous = session.query(Product.stock_on_hand).filter(Product.id == product_id).scalar()
+    if level == previous:
+        return
+    session.execute(table.update().where(table.c.id == product_id).values(stock_on_hand=level))
+    session.execute(StockMovement.__table__.insert().values(
+        product_id=product_id, change=(level or 0) - (previous or 0), reason=COUNT))
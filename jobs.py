@@ -0,0 +1,251 @@
+""" Background jobs stored in the application database
+
+Slow admin work (cascading deletes, rollup rebuilds, large imports) is
+enqueued as a row in the job table and picked up by a worker, so the
+request that asked for it returns at once and the page polls the job's
+status and progress instead.
+
+    job_queue = JobQueue()
+    job_queue.init_app(app)
+
+    @job_queue.task('rebuild_metrics')
+    def rebuild_metrics(run):
+        ...
+        run.progress(done, total)
+
+    job = job_queue.enqueue('rebuild_metrics')
+
+Workers claim the oldest queued job with a conditional UPDATE, so any
+number of threads and processes can share one queue. The web process runs
+JOB_WORKER_THREADS worker threads of its own once it serves its first
+request; `flask worker` runs a standalone pool.
+
+Config:
+    JOB_WORKER_THREADS   worker threads inside the web process (0 disables)
+    JOB_POLL_SECONDS     how often an idle worker looks for new jobs
+    JOB_STALE_SECONDS    a running job without progress for this long is
+                         assumed lost with its worker and is requeued
+    JOB_MAX_ATTEMPTS     lost jobs are requeued at most this many times
+"""
+
+import json
+import os
+import socket
+import threading
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+from models import db, Job
+
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+FINISHED = (DONE, FAILED)
+
+
+class Run(object):
+    """ Handle a task uses to report on the job it is running """
+
+    def __init__(self, job):
+        self.job = job
+
+    def progress(self, done, total=None, message=None):
+        """ Record progress and commit, which also commits the task's work so far """
+        self.job.progress = done
+        if total is not None:
+            self.job.total = total
+        if message is not None:
+            self.job.message = message[:200]
+        self.job.updated_at = datetime.utcnow()
+        db.session.commit()
+
+
+class JobQueue(object):
+    """ Flask extension holding the task registry and the in-process workers """
+
+    def __init__(self):
+        self.tasks = {}
+        self._wakeup = threading.Condition()
+        self._worker_lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('JOB_WORKER_THREADS', 1)
+        app.config.setdefault('JOB_POLL_SECONDS', 1.0)
+        app.config.setdefault('JOB_STALE_SECONDS', 600)
+        app.config.setdefault('JOB_MAX_ATTEMPTS', 3)
+        app.extensions['jobs'] = self
+
+        if app.config['JOB_WORKER_THREADS']:
+            # Not at import time: CLI commands such as init-db build the app
+            # too and must not start consuming the queue.
+            app.before_first_request(lambda: self.start_worker(app))
+
+    def task(self, name):
+        """ Register the decorated function as the task called name """
+        def register(function):
+            self.tasks[name] = function
+            return function
+        return register
+
+    def enqueue(self, name, **arguments):
+        """ Queue a task by name; arguments must be JSON serializable """
+        if name not in self.tasks:
+            raise KeyError('unknown task {!r}'.format(name))
+        job = Job(name=name, arguments=json.dumps(arguments), status=QUEUED)
+        db.session.add(job)
+        db.session.commit()
+        with self._wakeup:
+            self._wakeup.notify()
+        return job
+
+    def start_worker(self, app, threads=None):
+        with self._worker_lock:
+            # One worker per app, each with the app's own config.
+            worker = app.extensions.get('job_worker')
+            if worker is None:
+                worker = Worker(app, self, threads or app.config['JOB_WORKER_THREADS'])
+                app.extensions['job_worker'] = worker
+                worker.start()
+            return worker
+
+    def wait(self, seconds):
+        with self._wakeup:
+            self._wakeup.wait(seconds)
+
+    def requeue_stale(self):
+        """ Requeue running jobs whose worker stopped reporting; returns the count """
+        table = Job.__table__
+        config = current_app.config
+        cutoff = datetime.utcnow() - timedelta(seconds=config['JOB_STALE_SECONDS'])
+        stale = (table.c.status == RUNNING) & (table.c.updated_at < cutoff)
+        db.session.execute(table.update()
+                           .where(stale & (table.c.attempts >= config['JOB_MAX_ATTEMPTS']))
+                           .values(status=FAILED, error='Worker lost too many times',
+                                   finished_at=datetime.utcnow()))
+        requeued = db.session.execute(table.update().where(stale).values(status=QUEUED)).rowcount
+        db.session.commit()
+        return requeued
+
+    def claim(self, worker):
+        """ Mark the oldest queued job as running for worker and return it, or None """
+        table = Job.__table__
+        while True:
+            candidate = db.session.query(Job.id) \
+                .filter(Job.status == QUEUED) \
+                .order_by(Job.id) \
+                .limit(1) \
+                .scalar()
+            if candidate is None:
+                db.session.commit()
+                return None
+            now = datetime.utcnow()
+            claimed = db.session.execute(
+                table.update()
+                .where((table.c.id == candidate) & (table.c.status == QUEUED))
+                .values(status=RUNNING, worker=worker, attempts=table.c.attempts + 1,
+                        started_at=now, updated_at=now)).rowcount
+            db.session.commit()
+            # No row updated means another worker got there first; try the next.
+            if claimed:
+                return Job.query.get(candidate)
+
+    def run(self, job):
+        """ Execute a claimed job and record its outcome """
+        try:
+            task = self.tasks.get(job.name)
+            if task is None:
+                raise LookupError('unknown task {!r}'.format(job.name))
+            result = task(Run(job), **json.loads(job.arguments))
+        except Exception as ex:
+            db.session.rollback()
+            current_app.logger.exception('Job %s (%s) failed', job.id, job.name)
+            job.status = FAILED
+            job.error = '{}: {}'.format(type(ex).__name__, ex)
+        else:
+            job.status = DONE
+            job.result = json.dumps(result)
+            if job.total is not None:
+                job.progress = job.total
+        job.finished_at = job.updated_at = datetime.utcnow()
+        db.session.commit()
+
+    def work(self, worker, burst=False, stopping=None):
+        """ Claim and run jobs until stopping is set, or the queue is empty with burst """
+        poll = current_app.config['JOB_POLL_SECONDS']
+        while stopping is None or not stopping.is_set():
+            job = self.claim(worker)
+            if job is not None:
+                self.run(job)
+                db.session.remove()
+            elif burst:
+                return
+            else:
+                self.wait(poll)
+
+
+class Worker(object):
+    """ A pool of daemon threads running JobQueue.work() for one app """
+
+    def __init__(self, app, queue, threads):
+        self.app = app
+        self.queue = queue
+        self.threads = threads
+        self.name = worker_name()
+        self.stopping = threading.Event()
+        self._threads = []
+
+    def start(self):
+        with self.app.app_context():
+            self.queue.requeue_stale()
+        for number in range(self.threads):
+            thread = threading.Thread(target=self._loop, args=('{}/{}'.format(self.name, number),),
+                                      name='job-worker-{}'.format(number), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _loop(self, name):
+        with self.app.app_context():
+            while not self.stopping.is_set():
+                try:
+                    self.queue.work(name, stopping=self.stopping)
+                except Exception:
+                    # Most likely the database went away; back off and retry.
+                    db.session.remove()
+                    self.app.logger.exception('Job worker %s crashed, restarting', name)
+                    self.stopping.wait(self.app.config['JOB_POLL_SECONDS'])
+
+    def stop(self, timeout=None):
+        self.stopping.set()
+        with self.queue._wakeup:
+            self.queue._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+
+def worker_name():
+    """ host:pid, recorded on the jobs a process claims """
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def describe(job):
+    """ JSON-friendly view of a job for the status endpoints """
+    def iso(value):
+        return value.isoformat() if value else None
+    return {
+        'id': job.id,
+        'name': job.name,
+        'arguments': json.loads(job.arguments),
+        'status': job.status,
+        'progress': job.progress,
+        'total': job.total,
+        'message': job.message,
+        'result': json.loads(job.result) if job.result else None,
+        'error': job.error,
+        'attempts': job.attempts,
+        'created_at': iso(job.created_at),
+        'started_at': iso(job.started_at),
+        'finished_at': iso(job.finished_at),
+    }
@@ -0,0 +1,197 @@
+""" Versioned schema migrations
+
+The models are the definition of a new database. Databases made by an
+older version of the app are brought up to date by the migrations in
+MIGRATIONS, run in id order and each recorded in the schema_migration
+table once it has been applied:
+
+    $ flask db-status              which migrations a database has
+    $ flask db-upgrade             apply the pending ones
+    $ flask db-downgrade 0001      undo the ones after 0001
+
+A database with none of the models' tables is created from the models in
+one go and stamped with every migration, since the models already
+include them. Migrations therefore check before they change anything
+(add a column only if it is missing, and so on), so running one against
+a database that already has its change only records it.
+
+SQLite can add columns and indexes but not alter or drop columns, so
+changes of that kind need a migration that copies the table.
+"""
+
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, MetaData, String, Table, inspect
+
+from models import db
+
+
+# upgrade(connection) and downgrade(connection); downgrade None means it cannot be undone.
+Migration = namedtuple('Migration', 'id description upgrade downgrade')
+
+migration_table = Table(
+    'schema_migration', MetaData(),
+    Column('id', String(40), primary_key=True),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+
+def add_column(connection, table, column):
+    """ ALTER TABLE an existing table to add a column declared on its model """
+    if not column.nullable and column.server_default is None:
+        raise ValueError('Cannot add NOT NULL column {} to existing table {}'.format(column.name, table.name))
+    dialect = connection.dialect
+    specification = dialect.ddl_compiler(dialect, None).get_column_specification(column)
+    connection.execute('ALTER TABLE {} ADD COLUMN {}'.format(
+        dialect.identifier_preparer.format_table(table), specification))
+
+
+def create_missing(metadata):
+    """ Upgrade creating the tables and adding the nullable columns metadata has and the database lacks """
+    def upgrade(connection):
+        metadata.create_all(connection)
+        inspector = inspect(connection)
+        for table in metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    add_column(connection, table, column)
+    return upgrade
+
+
+def _indexes(metadata, names):
+    indexes = {index.name: index for table in metadata.tables.values() for index in table.indexes}
+    return [indexes[name] for name in names]
+
+
+def _existing_indexes(connection, table):
+    return {index['name'] for index in inspect(connection).get_indexes(table.name)}
+
+
+def create_indexes(metadata, *names):
+    """ Upgrade creating the named indexes of metadata that do not exist yet """
+    def upgrade(connection):
+        for index in _indexes(metadata, names):
+            if index.name not in _existing_indexes(connection, index.table):
+                index.create(connection)
+    return upgrade
+
+
+def drop_indexes(metadata, *names):
+    """ Downgrade of create_indexes """
+    def downgrade(connection):
+        for index in _indexes(metadata, names):
+            if index.name in _existing_indexes(connection, index.table):
+                index.drop(connection)
+    return downgrade
+
+
+def change_type(metadata, table_name, column_name, type_):
+    """ Upgrade or downgrade setting the type of a column of metadata's table
+
+    SQLite cannot alter a column, so there the table is copied to a new
+    one with the column's new type, which then replaces it.
+    """
+    def change(connection):
+        table = metadata.tables[table_name]
+        dialect = connection.dialect
+        preparer = dialect.identifier_preparer
+        if dialect.name != 'sqlite':
+            column = table.c[column_name].copy()
+            column.type = type_
+            if dialect.name == 'mysql':
+                specification = dialect.ddl_compiler(dialect, None).get_column_specification(column)
+                alter = 'ALTER TABLE {} MODIFY {}'.format(preparer.format_table(table), specification)
+            else:
+                alter = 'ALTER TABLE {} ALTER COLUMN {} TYPE {}'.format(
+                    preparer.format_table(table), preparer.format_column(column), type_.compile(dialect=dialect))
+            connection.execute(alter)
+            return
+
+        replacement = table.tometadata(MetaData(), name='{}_new'.format(table_name))
+        # The table's own indexes keep their names, so they are made again
+        # once the old table and its indexes are gone.
+        replacement.indexes.clear()
+        replacement.c[column_name].type = type_
+        replacement.create(connection)
+        existing = {column['name'] for column in inspect(connection).get_columns(table_name)}
+        columns = ', '.join(preparer.format_column(column) for column in replacement.columns
+                            if column.name in existing)
+        connection.execute('INSERT INTO {} ({}) SELECT {} FROM {}'.format(
+            preparer.format_table(replacement), columns, columns, preparer.format_table(table)))
+        connection.execute('DROP TABLE {}'.format(preparer.format_table(table)))
+        connection.execute('ALTER TABLE {} RENAME TO {}'.format(
+            preparer.format_table(replacement), preparer.format_table(table)))
+        for index in table.indexes:
+            index.create(connection)
+    return change
+
+
+def applied(engine):
+    """ {migration id: applied at} recorded in the database """
+    migration_table.create(engine, checkfirst=True)
+    with engine.connect() as connection:
+        return dict(connection.execute(migration_table.select()).fetchall())
+
+
+def upgrade(engine, target=None, metadata=db.metadata):
+    """ Apply the pending migrations up to target; returns the ids applied """
+    done = applied(engine)
+    pending = [migration for migration in MIGRATIONS
+               if migration.id not in done and (target is None or migration.id <= target)]
+    tables = set(inspect(engine).get_table_names())
+    if not tables & set(metadata.tables):
+        # A new database: the models already include every migration.
+        metadata.create_all(engine)
+        stamped = [migration.id for migration in MIGRATIONS if migration.id not in done]
+        with engine.begin() as connection:
+            connection.execute(migration_table.insert(), [
+                {'id': id, 'applied_at': datetime.utcnow()} for id in stamped])
+        return stamped
+
+    for migration in pending:
+        with engine.begin() as connection:
+            migration.upgrade(connection)
+            connection.execute(migration_table.insert().values(id=migration.id, applied_at=datetime.utcnow()))
+    return [migration.id for migration in pending]
+
+
+def downgrade(engine, target):
+    """ Undo the applied migrations after target, newest first; returns the ids undone """
+    done = applied(engine)
+    undo = [migration for migration in reversed(MIGRATIONS) if migration.id in done and migration.id > target]
+    irreversible = [migration.id for migration in undo if migration.downgrade is None]
+    if irreversible:
+        raise ValueError('Migration {} cannot be undone'.format(irreversible[0]))
+    for migration in undo:
+        with engine.begin() as connection:
+            migration.downgrade(connection)
+            connection.execute(migration_table.delete().where(migration_table.c.id == migration.id))
+    return [migration.id for migration in undo]
+
+
+# Foreign keys and the columns pages sort or filter by. Declared on the
+# models since they were added, but databases made before that have none.
+INDEXES = (
+    'ix_product_category_id',
+    'ix_product_date_created',
+    'ix_order_customer_id_order_date',
+    'ix_order_shipment_priority',
+    'ix_order_product_order_id',
+    'ix_order_product_product_id',
+    'ix_stock_movement_product_id',
+    'ix_stock_movement_order_product_id',
+    'ix_job_status_id',
+)
+
+MIGRATIONS = [
+    # Everything `flask init-db` used to do before migrations existed.
+    Migration('0001', 'Tables and nullable columns of the models', create_missing(db.metadata), None),
+    Migration('0002', 'Indexes on foreign keys and sort columns',
+              create_indexes(db.metadata, *INDEXES), drop_indexes(db.metadata, *INDEXES)),
+    # Room for hashes with longer method strings and salts than pbkdf2's.
+    Migration('0003', 'Wider user.password_hash',
+              change_type(db.metadata, 'user', 'password_hash', String(256)),
+              change_type(db.metadata, 'user', 'password_hash', String(128))),
+]
@@ -0,0 +1,461 @@
+""" Database models for shop24
+
+The SQLAlchemy extension is created unbound here and attached to the Flask
+application in app.create_app().
+"""
+
+from datetime import datetime
+
+from flask import current_app
+from flask_login import UserMixin
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import and_, event, func, literal, select
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import joinedload, lazyload, selectinload, subqueryload
+from sqlalchemy.pool import QueuePool
+
+
+db = SQLAlchemy()
+
+
+def engine_options(config):
+    """Build SQLALCHEMY_ENGINE_OPTIONS for the configured database.
+
+    File-backed SQLite gets a real connection pool shared between threads
+    (SQLAlchemy otherwise opens a new connection per checkout), other
+    databases get the usual pool sizing and pre-ping.
+    """
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    pool = {
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+    }
+    if url.drivername.startswith('sqlite'):
+        if url.database in (None, '', ':memory:'):
+            return {}
+        pool.update({
+            'poolclass': QueuePool,
+            'connect_args': {
+                'check_same_thread': False,
+                'timeout': config['SQLITE_BUSY_TIMEOUT'] / 1000.0,
+            },
+        })
+        return pool
+    pool.update({
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': True,
+    })
+    return pool
+
+
+def configure_engine(engine, config):
+    """Apply per-connection SQLite settings to every new connection.
+
+    WAL lets readers carry on while a writer commits, busy_timeout makes
+    writers wait for the lock instead of failing with "database is locked",
+    and synchronous=NORMAL is durable enough under WAL at a fraction of the
+    fsync cost.
+    """
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode={}'.format(config['SQLITE_JOURNAL_MODE']))
+        cursor.execute('PRAGMA busy_timeout={:d}'.format(config['SQLITE_BUSY_TIMEOUT']))
+        cursor.execute('PRAGMA synchronous={}'.format(config['SQLITE_SYNCHRONOUS']))
+        cursor.close()
+
+
+class User(UserMixin, db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(30), unique=True)
+    email = db.Column(db.String(30), unique=True)
+    password_hash = db.Column(db.String(256))
+
+
+    def setPW(self, password):
+        self.password_hash = _password_hasher().hash(password)
+
+    def checkPW(self, password):
+        """Verify password, upgrading a hash made with old parameters.
+
+        An upgraded hash is left in the session for the caller to commit.
+        """
+        hasher = _password_hasher()
+        if not hasher.verify(self.password_hash, password):
+            return False
+        if hasher.needs_rehash(self.password_hash):
+            self.setPW(password)
+        return True
+
+
+def _password_hasher():
+    return current_app.extensions['password_hasher']
+
+
+class Account(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(200), nullable=False)
+    password = db.Column(db.String(200), nullable=False)
+    email = db.Column(db.String(200), nullable=False)
+    street = db.Column(db.String(200), nullable=False)
+    city = db.Column(db.String(200), nullable=False)
+
+    def __repr__(self):
+        return '<Task %r>' % self.id
+
+
+class Product(db.Model):
+    id =                    db.Column(db.Integer, primary_key=True)
+    product_name =          db.Column(db.String(200), nullable=False)
+    product_description =   db.Column(db.String(200), nullable=False)
+    product_price =         db.Column(db.Numeric(10, 2), nullable=False)
+    product_cost =          db.Column(db.Numeric(10, 2), nullable=False)
+    date_created =          db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    category_id =           db.Column(db.Integer, db.ForeignKey('category.id'), nullable=False, index=True)
+    # Units available to new order lines; NULL means stock is not tracked.
+    # Only changed through inventory.py so every change is in the ledger.
+    stock_on_hand =         db.Column(db.Integer, nullable=True)
+
+    category = db.relationship('Category', back_populates='products')
+
+    def __repr__(self):
+        return '<Task %r>' % self.id
+
+
+class Order(db.Model):
+    # Covers both "orders of a customer" and "... between two dates".
+    __table_args__ = (
+        db.Index('ix_order_customer_id_order_date', 'customer_id', 'order_date'),
+    )
+
+    id =                  db.Column(db.Integer, primary_key=True)
+    customer_id =          db.Column(db.Integer, db.ForeignKey('account.id'), nullable=False)
+    order_date =          db.Column(db.DateTime, default=datetime.utcnow)
+    shipment_priority =   db.Column(db.Integer, index=True)
+
+    # customer_id's foreign key names the unused account table, so the join
+    # to customer is spelled out.
+    customer = db.relationship('Customer', back_populates='orders',
+                               primaryjoin='foreign(Order.customer_id) == Customer.id')
+    # passive_deletes: deleting an order leaves its lines to the caller
+    # instead of loading them to null out order_id.
+    lines = db.relationship('OrderProduct', back_populates='order', order_by='OrderProduct.id',
+                            passive_deletes=True)
+
+    def __repr__(self):
+        return '<Task %r>' % self.id
+
+
+class OrderProduct(db.Model):
+    id =           db.Column(db.Integer, primary_key=True)
+    order_id =     db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False, index=True)
+    product_id =   db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False, index=True)
+    quantity =     db.Column(db.Integer, nullable=False)
+
+    order = db.relationship('Order', back_populates='lines')
+    product = db.relationship('Product')
+
+    def __repr__(self):
+        return '<Task %r>' % self.id
+
+class StockMovement(db.Model):
+    """Ledger of every change to a product's stock_on_hand.
+
+    change is negative when an order line reserves units and positive when
+    one releases them or stock is counted up. Lines and orders are not
+    foreign keys so the history outlives them.
+    """
+    id =                db.Column(db.Integer, primary_key=True)
+    product_id =        db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False, index=True)
+    order_id =          db.Column(db.Integer)
+    order_product_id =  db.Column(db.Integer, index=True)
+    change =            db.Column(db.Integer, nullable=False)
+    reason =            db.Column(db.String(20), nullable=False)
+    created_at =        db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return '<StockMovement {} {:+d}>'.format(self.product_id, self.change)
+
+
+class PricingRule(db.Model):
+    """Minimum markup over cost for one category, or for all when category_id is NULL.
+
+    See pricing.py; markup 1.3 means price >= cost * 1.3.
+    """
+    id =           db.Column(db.Integer, primary_key=True)
+    category_id =  db.Column(db.Integer, db.ForeignKey('category.id'), unique=True)
+    markup =       db.Column(db.Numeric(6, 4), nullable=False)
+    updated_at =   db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return '<PricingRule {} {}>'.format(self.category_id, self.markup)
+
+
+class ProductSales(db.Model):
+    """Per-product sales rollup read by /metrics.
+
+    Rows are derived from order_product and product. Order line writes add
+    their units with add_product_sales(); product changes and the
+    rebuild_metrics job recompute rows with refresh_product_sales().
+    """
+    product_id =     db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    product_name =   db.Column(db.String(200), nullable=False)
+    product_price =  db.Column(db.Numeric(10, 2), nullable=False)
+    product_cost =   db.Column(db.Numeric(10, 2), nullable=False)
+    quantity =       db.Column(db.Integer, nullable=False)
+    revenue =        db.Column(db.Numeric(12, 2), nullable=False)
+    cost =           db.Column(db.Numeric(12, 2), nullable=False)
+    margin =         db.Column(db.Numeric(12, 2), nullable=False)
+
+    def __repr__(self):
+        return '<ProductSales %r>' % self.product_id
+
+
+# Values of EAGER_LOADING, see eager().
+LOADERS = {
+    'selectin': selectinload,
+    'joined': joinedload,
+    'subquery': subqueryload,
+    'lazy': lazyload,
+}
+
+
+def eager(strategy, *relationships):
+    """Query options loading each relationship with the named strategy.
+
+    'selectin' adds one IN query per relationship however many rows were
+    loaded, 'joined' folds many-to-one relationships into the main query,
+    and 'lazy' keeps the per-row lookups, which is mostly useful to measure
+    the others against.
+    """
+    loader = LOADERS[strategy]
+    return [loader(relationship) for relationship in relationships]
+
+
+def refresh_product_sales(*product_ids):
+    """Recompute the ProductSales rows for the given products.
+
+    With no ids every row is rebuilt. This sums every order line of the
+    products, so it is for changes to the products themselves and for
+    rebuilds; order line writes use add_product_sales(). The statements
+    run in the current session transaction, so callers commit them
+    together with the change that made the rollup stale.
+    """
+    table = ProductSales.__table__
+    totals = db.session.query(
+        OrderProduct.product_id.label('product_id'),
+        func.sum(OrderProduct.quantity).label('quantity'),
+    ).group_by(OrderProduct.product_id)
+    delete = table.delete()
+
+    if product_ids:
+        product_ids = {int(product_id) for product_id in product_ids}
+        totals = totals.filter(OrderProduct.product_id.in_(product_ids))
+        delete = delete.where(table.c.product_id.in_(product_ids))
+
+    totals = totals.subquery()
+    rows = select([
+        Product.id,
+        Product.product_name,
+        Product.product_price,
+        Product.product_cost,
+        totals.c.quantity,
+        Product.product_price * totals.c.quantity,
+        Product.product_cost * totals.c.quantity,
+        (Product.product_price - Product.product_cost) * totals.c.quantity,
+    ]).select_from(Product.__table__.join(totals, totals.c.product_id == Product.id))
+
+    db.session.execute(delete)
+    db.session.execute(table.insert().from_select([
+        table.c.product_id,
+        table.c.product_name,
+        table.c.product_price,
+        table.c.product_cost,
+        table.c.quantity,
+        table.c.revenue,
+        table.c.cost,
+        table.c.margin,
+    ], rows))
+
+
+def add_product_sales(quantities):
+    """Add {product_id: units sold} to the ProductSales rollup.
+
+    Negative units take back sales of changed or deleted lines. Each
+    product costs one UPDATE of its rollup row, or an INSERT of the first
+    one, however many order lines it has; rows left with no units are
+    removed, as a rebuild would leave them out.
+    """
+    table = ProductSales.__table__
+    product = Product.__table__
+    for product_id, units in sorted(quantities.items()):
+        product_id, units = int(product_id), int(units)
+        if not units:
+            continue
+        row = table.c.product_id == product_id
+        updated = db.session.execute(table.update().where(row).values(
+            quantity=table.c.quantity + units,
+            revenue=table.c.revenue + table.c.product_price * units,
+            cost=table.c.cost + table.c.product_cost * units,
+            margin=table.c.margin + (table.c.product_price - table.c.product_cost) * units,
+        )).rowcount
+        if not updated:
+            db.session.execute(table.insert().from_select([
+                table.c.product_id,
+                table.c.product_name,
+                table.c.product_price,
+                table.c.product_cost,
+                table.c.quantity,
+                table.c.revenue,
+                table.c.cost,
+                table.c.margin,
+            ], select([
+                product.c.id,
+                product.c.product_name,
+                product.c.product_price,
+                product.c.product_cost,
+                literal(units),
+                product.c.product_price * units,
+                product.c.product_cost * units,
+                (product.c.product_price - product.c.product_cost) * units,
+            ]).where(product.c.id == product_id)))
+        elif units < 0:
+            db.session.execute(table.delete().where(and_(row, table.c.quantity <= 0)))
+
+
+def merge_order_lines(order_id, quantities):
+    """Add {product_id: quantity} to an order in one pass.
+
+    Product ids are checked with a single IN query and ValueError is raised
+    before anything is written if any are unknown. Quantities for products
+    already on the order are added to the existing line instead of creating
+    a duplicate. Returns the affected lines; the caller commits.
+    """
+    product_ids = set(quantities)
+    known = {id for (id,) in db.session.query(Product.id).filter(Product.id.in_(product_ids))}
+    missing = product_ids - known
+    if missing:
+        raise ValueError('Unknown product ids: {}'.format(', '.join(str(id) for id in sorted(missing))))
+
+    existing = {}
+    for line in OrderProduct.query.filter(
+            OrderProduct.order_id == order_id,
+            OrderProduct.product_id.in_(product_ids)).order_by(OrderProduct.id):
+        existing.setdefault(line.product_id, line)
+
+    lines = []
+    for product_id, quantity in quantities.items():
+        line = existing.get(product_id)
+        if line is None:
+            line = OrderProduct(order_id=order_id, product_id=product_id, quantity=quantity)
+            db.session.add(line)
+        else:
+            line.quantity = line.quantity + quantity
+        lines.append(line)
+
+    db.session.flush()
+    add_product_sales(quantities)
+    return lines
+
+
+def order_history_query(customer_id, start=None, end=None):
+    """Orders of one customer with their line count, units and total.
+
+    The aggregates are computed in the same query with a grouped outer
+    join, so a page of history is one statement however many orders or
+    lines it covers. start is inclusive and end exclusive.
+    """
+    query = db.session.query(
+        Order.id.label('id'),
+        Order.order_date.label('order_date'),
+        Order.shipment_priority.label('shipment_priority'),
+        func.count(OrderProduct.id).label('line_count'),
+        func.coalesce(func.sum(OrderProduct.quantity), 0).label('units'),
+        # Typed as Numeric so the total comes back a Decimal of cents, not a float.
+        func.coalesce(func.sum(OrderProduct.quantity * Product.product_price), 0,
+                      type_=db.Numeric(12, 2)).label('total'),
+    ).outerjoin(OrderProduct, OrderProduct.order_id == Order.id) \
+     .outerjoin(Product, Product.id == OrderProduct.product_id) \
+     .filter(Order.customer_id == customer_id) \
+     .group_by(Order.id, Order.order_date, Order.shipment_priority)
+    if start is not None:
+        query = query.filter(Order.order_date >= start)
+    if end is not None:
+        query = query.filter(Order.order_date < end)
+    return query
+
+
+class Customer(db.Model):
+    id           = db.Column(db.Integer, primary_key=True)
+    first_name   = db.Column(db.String(50), nullable=False)
+    last_name	 = db.Column(db.String(50), nullable=False)
+    email	 = db.Column(db.String(100), nullable=False)
+    phone        = db.Column(db.String(10), nullable=True)
+    street_addr  = db.Column(db.String(50), nullable=True)
+    state        = db.Column(db.String(2), nullable=True)
+    zipcode      = db.Column(db.String(5), nullable=True)
+    city         = db.Column(db.String(100), nullable=True)
+
+    orders = db.relationship('Order', back_populates='customer',
+                             primaryjoin='foreign(Order.customer_id) == Customer.id', passive_deletes=True)
+
+    def __repr__(self):
+        return '<Customer {}>'.format(self.id)
+
+class Category(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    category_name = db.Column(db.String(200), nullable=False)
+
+    products = db.relationship('Product', back_populates='category', passive_deletes=True)
+
+    def __repr__(self):
+        return '<Task %r>' % self.id
+
+
+class Job(db.Model):
+    """A unit of background work, see jobs.py.
+
+    arguments and result hold JSON. updated_at doubles as the heartbeat of
+    a running job, so jobs whose worker died can be found and requeued.
+    """
+    __table_args__ = (
+        # The worker's "oldest queued job" lookup.
+        db.Index('ix_job_status_id', 'status', 'id'),
+    )
+
+    id =            db.Column(db.Integer, primary_key=True)
+    name =          db.Column(db.String(50), nullable=False)
+    arguments =     db.Column(db.Text, nullable=False, default='{}')
+    status =        db.Column(db.String(10), nullable=False, default='queued')
+    progress =      db.Column(db.Integer, nullable=False, default=0)
+    total =         db.Column(db.Integer)
+    message =       db.Column(db.String(200))
+    result =        db.Column(db.Text)
+    error =         db.Column(db.Text)
+    attempts =      db.Column(db.Integer, nullable=False, default=0)
+    worker =        db.Column(db.String(100))
+    created_at =    db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at =    db.Column(db.DateTime)
+    updated_at =    db.Column(db.DateTime)
+    finished_at =   db.Column(db.DateTime)
+
+    def __repr__(self):
+        return '<Job {} {}>'.format(self.id, self.name)
+
+
+class TableVersion(db.Model):
+    """Write counter per table, bumped in the writing transaction.
+
+    See httpcache.py; the counters turn "has anything on this page changed"
+    into a primary key lookup.
+    """
+    table_name =    db.Column(db.String(50), primary_key=True)
+    version =       db.Column(db.Integer, nullable=False, default=0)
+    changed_at =    db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return '<TableVersion {} {}>'.format(self.table_name, self.version)
@@ -0,0 +1,119 @@
+""" Keyset (cursor) pagination helpers
+
+A page is selected with "WHERE (sort key) > (last key seen)" instead of an
+OFFSET, so every page costs one indexed range scan no matter how deep
+into the table it is. The last key of a page is handed back to the client
+as an opaque cursor string.
+
+NULL sort values are treated as smaller than everything else, which is how
+SQLite orders them.
+"""
+
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from sqlalchemy import and_, false, or_
+
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+class Page(object):
+    """ One page of results plus the cursor of the page that follows it """
+
+    def __init__(self, items, next_cursor, limit):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.limit = limit
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {'dt': value.isoformat()}
+    raise TypeError('Cannot encode %r in a cursor' % (value,))
+
+
+def _decode_value(value):
+    if 'dt' in value:
+        return datetime.fromisoformat(value['dt'])
+    return value
+
+
+def encode_cursor(values):
+    """ Pack a tuple of sort key values into a URL-safe token """
+    raw = json.dumps(list(values), default=_encode_value, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """ Reverse encode_cursor(). Raises ValueError for a malformed token. """
+    padded = token + '=' * (-len(token) % 4)
+    try:
+        raw = base64.urlsafe_b64decode(padded.encode('ascii'))
+        values = json.loads(raw.decode('utf-8'), object_hook=_decode_value)
+    except (binascii.Error, UnicodeError, ValueError) as ex:
+        raise ValueError('Invalid cursor: {}'.format(ex))
+    if not isinstance(values, list):
+        raise ValueError('Invalid cursor')
+    return values
+
+
+def page_size(args, default=DEFAULT_PAGE_SIZE, maximum=MAX_PAGE_SIZE):
+    """ Read ?limit= from request args, clamped to 1..maximum """
+    try:
+        limit = int(args.get('limit', default))
+    except (TypeError, ValueError):
+        limit = default
+    return max(1, min(limit, maximum))
+
+
+def _later(column, value, descending):
+    if descending:
+        # NULLs sort last when descending, so nothing follows a NULL.
+        return false() if value is None else or_(column < value, column.is_(None))
+    return column.isnot(None) if value is None else column > value
+
+
+def _after(columns, values, descending=False):
+    """ Build the "row sorts after values" condition """
+    clauses = []
+    for position, (column, value) in enumerate(zip(columns, values)):
+        equal = [
+            previous.is_(None) if previous_value is None else previous == previous_value
+            for previous, previous_value in zip(columns[:position], values[:position])
+        ]
+        clauses.append(and_(*(equal + [_later(column, value, descending)])))
+    return or_(*clauses)
+
+
+def keyset_page(query, columns, cursor=None, limit=DEFAULT_PAGE_SIZE, descending=False):
+    """ Return one Page of query ordered by columns, starting after cursor
+
+    columns must end with a unique column (normally the primary key) so the
+    ordering is total, and all of them sort the same way. Items may be
+    model instances or column rows; the cursor is built from the attributes
+    named after each column.
+    """
+    query = query.order_by(*[column.desc() if descending else column for column in columns])
+    if cursor:
+        values = decode_cursor(cursor)
+        if len(values) != len(columns):
+            raise ValueError('Invalid cursor')
+        query = query.filter(_after(columns, values, descending))
+
+    items = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        last = items[-1]
+        next_cursor = encode_cursor(getattr(last, column.key) for column in columns)
+    return Page(items, next_cursor, limit)
@@ -0,0 +1,179 @@
+""" Markup rules for the price floor, and bulk repricing of the catalog
+
+A product's price may not go below its cost times the markup of the rule
+for its category, or of the global rule (category_id NULL), or
+DEFAULT_MARKUP when neither exists. The floor is computed with Decimal
+and rounded half up to the cent:
+
+    rules = load_rules()
+    price = apply_floor(Decimal('9.99'), Decimal('10.00'), rules.markup_for(3))
+
+reprice() applies the current rules to every product already in the
+catalog. It works a range of product ids at a time, with one UPDATE per
+range that evaluates all the rules in SQL through a CASE on category_id.
+The arithmetic is in integer cents and basis points, so the database
+rounds exactly as apply_floor() does even where it stores money as
+floating point, as SQLite does. With dry_run it only reports the changes
+it would make.
+"""
+
+from collections import namedtuple
+from decimal import Decimal, ROUND_HALF_UP
+
+from sqlalchemy import Integer, and_, case, cast, func, literal_column, select
+
+from bulk import LOOKUP_BATCH_SIZE
+from models import db, refresh_product_sales, PricingRule, Product
+
+
+DEFAULT_MARKUP = Decimal('1.3')
+DEFAULT_CHUNK_SIZE = 5000
+CENT = Decimal('0.01')
+
+# One product whose price is below its floor.
+Change = namedtuple('Change', 'id product_name category_id cost old_price new_price')
+
+
+class Rules(object):
+    """ The markups in force: a global one and per-category overrides """
+
+    def __init__(self, default=DEFAULT_MARKUP, by_category=None):
+        self.default = Decimal(default)
+        self.by_category = {category_id: Decimal(markup) for category_id, markup in (by_category or {}).items()}
+
+    def markup_for(self, category_id):
+        if category_id is not None and int(category_id) in self.by_category:
+            return self.by_category[int(category_id)]
+        return self.default
+
+    def basis_points(self, markup):
+        return int((markup * 10000).to_integral_value(ROUND_HALF_UP))
+
+
+def load_rules(default=DEFAULT_MARKUP, session=None):
+    """ Read every rule in one query """
+    session = session or db.session
+    by_category = {}
+    for category_id, markup in session.query(PricingRule.category_id, PricingRule.markup):
+        if category_id is None:
+            default = markup
+        else:
+            by_category[category_id] = markup
+    return Rules(default, by_category)
+
+
+def set_rule(category_id, markup, session=None):
+    """ Create, change or, with markup None, remove the rule for category_id """
+    session = session or db.session
+    rule = session.query(PricingRule).filter(
+        PricingRule.category_id.is_(None) if category_id is None else PricingRule.category_id == category_id
+    ).first()
+    if markup is None:
+        if rule is not None:
+            session.delete(rule)
+        return None
+    markup = Decimal(markup)
+    if markup < 1:
+        raise ValueError('A markup below 1 would allow selling under cost')
+    if rule is None:
+        rule = PricingRule(category_id=category_id)
+        session.add(rule)
+    rule.markup = markup
+    return rule
+
+
+def to_money(value):
+    """ Decimal of a price or cost from a form string, float or Decimal """
+    return Decimal(str(value)).quantize(CENT, ROUND_HALF_UP)
+
+
+def floor(cost, markup):
+    """ The lowest allowed price for cost under markup """
+    return (to_money(cost) * Decimal(markup)).quantize(CENT, ROUND_HALF_UP)
+
+
+def apply_floor(price, cost, markup):
+    """ price, raised to the floor if it is below it """
+    return max(to_money(price), floor(cost, markup))
+
+
+def _cents(column):
+    # A literal keeps 100 from being bound as a Numeric parameter.
+    return cast(func.round(column * literal_column('100')), Integer)
+
+
+def _floor_cents(rules):
+    """ SQL for the floor in cents: (cost cents * basis points + 5000) / 10000, all integers """
+    table = Product.__table__
+    basis_points = rules.basis_points(rules.default)
+    if rules.by_category:
+        basis_points = case(
+            [(table.c.category_id == category_id, rules.basis_points(markup))
+             for category_id, markup in sorted(rules.by_category.items())],
+            else_=basis_points)
+    return (_cents(table.c.product_cost) * basis_points + 5000) / 10000
+
+
+def _ranges(session, chunk_size):
+    """ Yield (after id, last id, products) ranges of chunk_size products, walking the primary key """
+    table = Product.__table__
+    last = 0
+    while True:
+        upper = session.execute(
+            select([table.c.id]).where(table.c.id > last).order_by(table.c.id)
+            .offset(chunk_size - 1).limit(1)).scalar()
+        size = chunk_size
+        if upper is None:
+            upper, size = session.execute(
+                select([func.max(table.c.id), func.count()]).where(table.c.id > last)).first()
+            if upper is None:
+                return
+        yield last, upper, size
+        last = upper
+
+
+def reprice(rules, dry_run=False, chunk_size=DEFAULT_CHUNK_SIZE, session=None, progress=None):
+    """ Raise every price below its floor; yields a Change per product
+
+    Without dry_run each range is committed before its changes are
+    yielded, so stopping the iteration early leaves a consistent catalog.
+    progress(products checked so far) is called after each range if given.
+    """
+    session = session or db.session
+    table = Product.__table__
+    floor_cents = _floor_cents(rules)
+    checked = 0
+    for after, upper, size in _ranges(session, chunk_size):
+        in_range = and_(table.c.id > after, table.c.id <= upper)
+        below = and_(in_range, _cents(table.c.product_price) < floor_cents)
+        changes = [
+            Change(id, name, category_id, to_money(cost), to_money(price),
+                   (Decimal(new_cents) / 100).quantize(CENT))
+            for id, name, category_id, cost, price, new_cents in session.execute(
+                select([table.c.id, table.c.product_name, table.c.category_id, table.c.product_cost,
+                        table.c.product_price, floor_cents]).where(below).order_by(table.c.id))
+        ]
+        if changes and not dry_run:
+            session.execute(table.update().where(below).values(
+                product_price=floor_cents / literal_column('100.0')))
+            ids = [change.id for change in changes]
+            for start in range(0, len(ids), LOOKUP_BATCH_SIZE):
+                refresh_product_sales(*ids[start:start + LOOKUP_BATCH_SIZE])
+            session.commit()
+        checked += size
+        if progress is not None:
+            progress(checked)
+        for change in changes:
+            yield change
+
+
+def summarize(changes, sample=50):
+    """ Count, total increase and the first sample changes of a reprice run """
+    report = {'products': 0, 'increase': Decimal('0.00'), 'by_category': {}, 'sample': []}
+    for change in changes:
+        report['products'] += 1
+        report['increase'] += change.new_price - change.old_price
+        report['by_category'][change.category_id] = report['by_category'].get(change.category_id, 0) + 1
+        if len(report['sample']) < sample:
+            report['sample'].append(change)
+    return report
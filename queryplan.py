@@ -0,0 +1,125 @@
+""" EXPLAIN QUERY PLAN checks for the queries behind each page
+
+check() requests a list of URLs through the test client, records every
+SELECT they run, and asks SQLite for the plan of each one. A statement
+fails the check when its plan scans a whole table holding more than
+max_rows rows:
+
+    SCAN product                                 full table scan
+    SCAN order_product USING INDEX ix_...        walks a whole index
+    SEARCH product USING INDEX ix_... (id=?)     fine, an index lookup
+
+A scan of an unfiltered statement under a LIMIT is allowed when the plan
+needs no temporary B-tree for ORDER BY, because SQLite then stops after
+the first rows, as the first keyset page of a listing does. With a WHERE
+clause it may have to read the whole table to find them. Scans of
+subqueries, CTEs and virtual tables (the full-text index) are ignored;
+their own tables show up on their own plan lines.
+
+Each statement is explained once, for the first URL that runs it.
+
+Only SQLite understands EXPLAIN QUERY PLAN.
+"""
+
+import re
+from collections import namedtuple
+
+from sqlalchemy import event
+
+
+SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)')
+LIMIT = re.compile(r'\bLIMIT\b', re.IGNORECASE)
+WHERE = re.compile(r'\bWHERE\b', re.IGNORECASE)
+TEMP_SORT = 'USE TEMP B-TREE FOR ORDER BY'
+
+# One statement whose plan scans a table larger than allowed.
+Problem = namedtuple('Problem', 'url statement table rows plan')
+
+
+def supported(engine):
+    return engine.dialect.name == 'sqlite'
+
+
+def explain(engine, statement, parameters=()):
+    """ The detail column of EXPLAIN QUERY PLAN for statement """
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+        return [row[-1] for row in cursor.fetchall()]
+    finally:
+        connection.close()
+
+
+def row_counts(engine, tables):
+    """ {table name: rows} for every table """
+    with engine.connect() as connection:
+        return {table.name: connection.execute(table.count()).scalar() for table in tables}
+
+
+def full_scans(plan, statement, counts, max_rows):
+    """ [(table, rows)] the plan scans in full beyond max_rows """
+    if (LIMIT.search(statement) and not WHERE.search(statement)
+            and not any(TEMP_SORT in detail for detail in plan)):
+        return []
+    scans = []
+    for detail in plan:
+        match = SCAN.match(detail)
+        if match and counts.get(match.group(1), 0) > max_rows:
+            scans.append((match.group(1), counts[match.group(1)]))
+    return scans
+
+
+class Recorder(object):
+    """ Collects the SELECT statements run on an engine while active """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+            self.statements.append((statement, parameters))
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self._record)
+
+
+def check(app, engine, tables, urls, max_rows, user_id=None, session=None):
+    """ Request every URL and return ([(url, status, statements)], [Problem])
+
+    Requests made inside an app context share its scoped session; pass it
+    to have it removed after each one, so no page is answered from rows
+    an earlier page loaded.
+    """
+    counts = row_counts(engine, tables)
+    client = app.test_client()
+    if user_id is not None:
+        with client.session_transaction() as cookie:
+            cookie['_user_id'] = str(user_id)
+            cookie['_fresh'] = True
+
+    visited = []
+    problems = []
+    seen = set()
+    for url in urls:
+        with Recorder(engine) as recorder:
+            response = client.get(url)
+            # Streamed bodies run their queries while being read.
+            response.get_data()
+            response.close()
+            if session is not None:
+                session.remove()
+        visited.append((url, response.status_code, len(recorder.statements)))
+        for statement, parameters in recorder.statements:
+            if statement in seen:
+                continue
+            seen.add(statement)
+            plan = explain(engine, statement, parameters)
+            for table, rows in full_scans(plan, statement, counts, max_rows):
+                problems.append(Problem(url, statement, table, rows, plan))
+    return visited, problems
@@ -0,0 +1,159 @@
+""" Full-text product search backed by an SQLite FTS5 index
+
+product_search is an FTS5 table over product name, description and
+category name, keyed by product id (its rowid). Triggers on product and
+category keep it in sync, so every write path (forms, bulk imports, raw
+SQL) updates the index in the same transaction.
+
+Queries match every word by prefix and are ranked by bm25 with the
+product name weighted above the category and description. Other databases
+have no FTS5; there search() falls back to a LIKE scan.
+"""
+
+import re
+
+from sqlalchemy import text
+
+from models import db, Category, Product
+from pagination import Page, decode_cursor, encode_cursor
+
+
+# bm25 weights for product_name, product_description, category_name.
+RANK = 'bm25(10.0, 1.0, 2.0)'
+
+DDL = [
+    # prefix='2 3' adds prefix indexes so short "pi*" style terms stay fast.
+    """CREATE VIRTUAL TABLE IF NOT EXISTS product_search USING fts5(
+        product_name, product_description, category_name,
+        tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')""",
+    """CREATE TRIGGER IF NOT EXISTS product_search_insert AFTER INSERT ON product BEGIN
+        INSERT INTO product_search (rowid, product_name, product_description, category_name)
+        VALUES (new.id, new.product_name, new.product_description,
+                (SELECT category_name FROM category WHERE id = new.category_id));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS product_search_update
+    AFTER UPDATE OF product_name, product_description, category_id ON product BEGIN
+        DELETE FROM product_search WHERE rowid = old.id;
+        INSERT INTO product_search (rowid, product_name, product_description, category_name)
+        VALUES (new.id, new.product_name, new.product_description,
+                (SELECT category_name FROM category WHERE id = new.category_id));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS product_search_delete AFTER DELETE ON product BEGIN
+        DELETE FROM product_search WHERE rowid = old.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS category_search_update
+    AFTER UPDATE OF category_name ON category BEGIN
+        UPDATE product_search SET category_name = new.category_name
+        WHERE rowid IN (SELECT id FROM product WHERE category_id = new.id);
+    END""",
+]
+
+
+def supported(engine):
+    return engine.dialect.name == 'sqlite'
+
+
+def install(engine):
+    """ Create the index and triggers if missing; True if the index is new """
+    if not supported(engine):
+        return False
+    with engine.begin() as connection:
+        exists = connection.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'product_search'")).first()
+        for statement in DDL:
+            connection.execute(text(statement))
+        connection.execute(text(
+            "INSERT INTO product_search (product_search, rank) VALUES ('rank', :rank)"), rank=RANK)
+    return exists is None
+
+
+def rebuild(engine):
+    """ Refill the index from the product and category tables """
+    with engine.begin() as connection:
+        connection.execute(text('DELETE FROM product_search'))
+        connection.execute(text("""
+            INSERT INTO product_search (rowid, product_name, product_description, category_name)
+            SELECT product.id, product.product_name, product.product_description, category.category_name
+            FROM product LEFT JOIN category ON category.id = product.category_id"""))
+        connection.execute(text("INSERT INTO product_search (product_search) VALUES ('optimize')"))
+
+
+def match_expression(query):
+    """ Turn free text into an FTS5 query matching every word as a prefix
+
+    Words are quoted so user input can never be parsed as FTS5 syntax.
+    """
+    words = re.findall(r'\w+', query)
+    return ' '.join('"{}"*'.format(word) for word in words)
+
+
+def search(query, category_id=None, min_price=None, max_price=None, cursor=None, limit=20):
+    """ Ranked products matching query, optionally filtered
+
+    Pages are keyed on (rank, product id), so following a cursor does not
+    rescan the earlier pages' rows in Python.
+    """
+    expression = match_expression(query)
+    if not expression:
+        return Page([], None, limit)
+    if not supported(db.engine):
+        return _like_search(query, category_id, min_price, max_price, cursor, limit)
+
+    conditions = ['product_search MATCH :expression']
+    params = {'expression': expression, 'limit': limit + 1}
+    if category_id is not None:
+        conditions.append('product.category_id = :category_id')
+        params['category_id'] = category_id
+    if min_price is not None:
+        conditions.append('product.product_price >= :min_price')
+        params['min_price'] = min_price
+    if max_price is not None:
+        conditions.append('product.product_price <= :max_price')
+        params['max_price'] = max_price
+    if cursor:
+        rank, last_id = decode_cursor(cursor)
+        conditions.append('(product_search.rank > :rank OR (product_search.rank = :rank AND product.id > :last_id))')
+        params.update(rank=float(rank), last_id=int(last_id))
+
+    rows = db.session.execute(text("""
+        SELECT product.id, product.product_name, product.product_description,
+               product.product_price, product.category_id, category.category_name,
+               product_search.rank AS rank
+        FROM product_search
+        JOIN product ON product.id = product_search.rowid
+        LEFT JOIN category ON category.id = product.category_id
+        WHERE {}
+        ORDER BY product_search.rank, product.id
+        LIMIT :limit""".format(' AND '.join(conditions))), params).fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([rows[-1].rank, rows[-1].id])
+    return Page(rows, next_cursor, limit)
+
+
+def _like_search(query, category_id, min_price, max_price, cursor, limit):
+    columns = (Product.id, Product.product_name, Product.product_description,
+               Product.product_price, Product.category_id, Category.category_name)
+    found = db.session.query(*columns).outerjoin(Category, Category.id == Product.category_id)
+    # The same three columns the index covers, matched through the category join.
+    for word in re.findall(r'\w+', query):
+        pattern = '%{}%'.format(word)
+        found = found.filter(Product.product_name.ilike(pattern) |
+                             Product.product_description.ilike(pattern) |
+                             Category.category_name.ilike(pattern))
+    if category_id is not None:
+        found = found.filter(Product.category_id == category_id)
+    if min_price is not None:
+        found = found.filter(Product.product_price >= min_price)
+    if max_price is not None:
+        found = found.filter(Product.product_price <= max_price)
+    if cursor:
+        found = found.filter(Product.id > int(decode_cursor(cursor)[0]))
+    rows = found.order_by(Product.id).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([rows[-1].id])
+    return Page(rows, next_cursor, limit)
@@ -0,0 +1,290 @@
+""" Password hashing off the request thread, and login rate limiting
+
+PasswordHasher hashes and verifies passwords with werkzeug's hash formats
+on a small bounded pool. At most PASSWORD_HASH_WORKERS hashes run at once
+however many requests arrive, and a request that cannot get a slot within
+PASSWORD_HASH_TIMEOUT fails with HashingBusy instead of queueing forever.
+pbkdf2 releases the GIL, so the default thread pool already runs hashes on
+separate cores; a process pool is available for hash methods that do not.
+
+When PASSWORD_HASH_METHOD changes, stored hashes in the old format keep
+working and are replaced with the new format the next time their owner
+logs in (see User.checkPW).
+
+RateLimiter is a token bucket limiter with an in-process backend. login()
+spends one token from the client address's bucket and one from the
+username's bucket per attempt, so a burst from one address and a spread
+attack on one account are both slowed down.
+
+UserCache keeps the column values of recently authenticated users in an
+LRU so the login manager's user_loader does not query the user table on
+every request. An ORM write to a user drops its entry when the session
+commits; the TTL bounds how long another process can serve a stale copy.
+
+Config:
+    PASSWORD_HASH_METHOD    werkzeug method, e.g. pbkdf2:sha256:150000
+    PASSWORD_SALT_LENGTH    salt characters for new hashes
+    PASSWORD_HASH_POOL      'thread' or 'process'
+    PASSWORD_HASH_WORKERS   concurrent hashes per web process
+    PASSWORD_HASH_TIMEOUT   seconds to wait for a free worker
+    LOGIN_RATE_LIMIT_ENABLED
+    LOGIN_IP_BURST, LOGIN_IP_PER_MINUTE
+    LOGIN_USERNAME_BURST, LOGIN_USERNAME_PER_MINUTE
+    USER_CACHE_SIZE         users kept per process (0 disables)
+    USER_CACHE_TTL          seconds before a cached user is reloaded
+"""
+
+import threading
+import time
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, make_transient_to_detached, object_session
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+
+from cache import LRUBackend
+from models import db, User
+
+
+DEFAULT_METHOD = 'pbkdf2:sha256:{}'.format(DEFAULT_PBKDF2_ITERATIONS)
+
+
+class HashingBusy(Exception):
+    """ No hashing worker became free within PASSWORD_HASH_TIMEOUT """
+
+
+def normalize_method(method):
+    """ The method prefix werkzeug stores for method, e.g. pbkdf2:sha256 -> pbkdf2:sha256:150000 """
+    parts = method.split(':')
+    if parts[0] == 'pbkdf2':
+        if len(parts) == 1:
+            parts.append('sha256')
+        if len(parts) == 2:
+            parts.append(str(DEFAULT_PBKDF2_ITERATIONS))
+    return ':'.join(parts)
+
+
+class HashPool(object):
+    """ One app's hashing parameters and bounded pool """
+
+    def __init__(self, method, salt_length, timeout, workers, kind='thread'):
+        self.method = normalize_method(method)
+        self.salt_length = salt_length
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(workers or 1)
+        if not workers:
+            self._pool = None
+        elif kind == 'process':
+            # Imported here: it drags in multiprocessing, which the default
+            # thread pool never needs.
+            from concurrent.futures import ProcessPoolExecutor
+            self._pool = ProcessPoolExecutor(max_workers=workers)
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+            self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+
+    def _run(self, function, *args):
+        if self._pool is None:
+            return function(*args)
+        # Waiting for a slot rather than on the future keeps the queue in
+        # front of the pool bounded, and a slow hash that did start is
+        # never abandoned half way.
+        if not self._slots.acquire(timeout=self.timeout):
+            raise HashingBusy('password hashing is saturated')
+        try:
+            return self._pool.submit(function, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method, self.salt_length)
+
+    def verify(self, password_hash, password):
+        if not password_hash:
+            return False
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """ True if password_hash was made with other parameters than the configured ones """
+        return password_hash.split('$', 1)[0] != self.method
+
+
+class PasswordHasher(object):
+    """ Flask extension giving each app a HashPool, in app.extensions['password_hasher'] """
+
+    def init_app(self, app):
+        app.config.setdefault('PASSWORD_HASH_METHOD', DEFAULT_METHOD)
+        app.config.setdefault('PASSWORD_SALT_LENGTH', 8)
+        app.config.setdefault('PASSWORD_HASH_POOL', 'thread')
+        app.config.setdefault('PASSWORD_HASH_WORKERS', 2)
+        app.config.setdefault('PASSWORD_HASH_TIMEOUT', 5)
+        app.extensions['password_hasher'] = HashPool(
+            app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_SALT_LENGTH'],
+            app.config['PASSWORD_HASH_TIMEOUT'], app.config['PASSWORD_HASH_WORKERS'],
+            app.config['PASSWORD_HASH_POOL'])
+
+    @property
+    def pool(self):
+        return current_app.extensions['password_hasher']
+
+    def hash(self, password):
+        return self.pool.hash(password)
+
+    def verify(self, password_hash, password):
+        return self.pool.verify(password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        return self.pool.needs_rehash(password_hash)
+
+
+class MemoryBuckets(object):
+    """ Token buckets in a dictionary; full buckets are dropped to bound memory """
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _level(self, key, capacity, rate, now):
+        tokens, updated = self._buckets.get(key, (capacity, now))
+        return min(capacity, tokens + (now - updated) * rate)
+
+    def take(self, limits, cost=1):
+        """ Spend cost from every (key, capacity, rate) bucket, or from none
+
+        Returns 0 when allowed, else the seconds until all buckets can pay.
+        """
+        now = time.monotonic()
+        with self._lock:
+            levels = [self._level(key, capacity, rate, now) for key, capacity, rate in limits]
+            wait = max([(cost - level) / rate for level, (key, capacity, rate) in zip(levels, limits)
+                        if level < cost] or [0])
+            if wait:
+                return wait
+            for level, (key, capacity, rate) in zip(levels, limits):
+                self._buckets[key] = (level - cost, now)
+            if len(self._buckets) > self.max_keys:
+                self._prune(now)
+            return 0
+
+    def _prune(self, now):
+        # An hour idle refills any sensibly configured bucket, and a full
+        # bucket is the same as none.
+        for key, (tokens, updated) in list(self._buckets.items()):
+            if now - updated > 3600:
+                del self._buckets[key]
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class LoginLimits(object):
+    """ One app's login buckets and their sizes """
+
+    def __init__(self, enabled, limits, backend=None):
+        self.enabled = enabled
+        self.limits = limits
+        self.backend = backend or MemoryBuckets()
+
+
+class RateLimiter(object):
+    """ Flask extension throttling login attempts per address and per username
+
+    Each app keeps its own LoginLimits in app.extensions['rate_limiter'].
+    """
+
+    def init_app(self, app):
+        app.config.setdefault('LOGIN_RATE_LIMIT_ENABLED', True)
+        app.config.setdefault('LOGIN_IP_BURST', 20)
+        app.config.setdefault('LOGIN_IP_PER_MINUTE', 20)
+        app.config.setdefault('LOGIN_USERNAME_BURST', 5)
+        app.config.setdefault('LOGIN_USERNAME_PER_MINUTE', 5)
+        app.extensions['rate_limiter'] = LoginLimits(app.config['LOGIN_RATE_LIMIT_ENABLED'], {
+            'ip': (app.config['LOGIN_IP_BURST'], app.config['LOGIN_IP_PER_MINUTE'] / 60.0),
+            'username': (app.config['LOGIN_USERNAME_BURST'], app.config['LOGIN_USERNAME_PER_MINUTE'] / 60.0),
+        })
+
+    def login_attempt(self, address, username):
+        """ Spend a login attempt; returns 0 if allowed, else seconds to wait """
+        state = current_app.extensions['rate_limiter']
+        if not state.enabled:
+            return 0
+        keys = {'ip': 'login:ip:{}'.format(address),
+                'username': 'login:user:{}'.format((username or '').strip().lower())}
+        return state.backend.take([(keys[name],) + state.limits[name] for name in ('ip', 'username')])
+
+
+class CachedUsers(object):
+    """ One app's cached user rows and hit/miss counters """
+
+    def __init__(self, max_entries, ttl):
+        self.backend = LRUBackend(max_entries)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+
+class UserCache(object):
+    """ Flask extension caching the users the login manager loads, by id
+
+    Each app keeps its own CachedUsers in app.extensions['user_cache'].
+    """
+
+    def __init__(self):
+        self._listening = False
+
+    def init_app(self, app):
+        app.config.setdefault('USER_CACHE_SIZE', 1000)
+        app.config.setdefault('USER_CACHE_TTL', 60)
+        app.extensions['user_cache'] = CachedUsers(app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'])
+        self._listen()
+
+    @property
+    def state(self):
+        return current_app.extensions['user_cache']
+
+    def _listen(self):
+        if self._listening:
+            return
+        self._listening = True
+
+        def changed(mapper, connection, target):
+            # Dropped now and again after commit: a request that reads the
+            # user between the flush and the commit may cache the old row.
+            self.invalidate(target.id)
+            object_session(target).info.setdefault('changed_users', set()).add(target.id)
+
+        def finished(session):
+            self.invalidate(*session.info.pop('changed_users', ()))
+
+        event.listen(User, 'after_update', changed)
+        event.listen(User, 'after_delete', changed)
+        event.listen(Session, 'after_commit', finished)
+        event.listen(Session, 'after_soft_rollback', lambda session, transaction: finished(session))
+
+    def load(self, user_id):
+        """ The user with user_id attached to the current session, or None """
+        state = self.state
+        found, values = state.backend.get(user_id)
+        if not found:
+            state.misses += 1
+            user = User.query.get(user_id)
+            if user is not None and state.backend.max_entries:
+                state.backend.set(user_id, {attribute.key: getattr(user, attribute.key)
+                                            for attribute in inspect(User).column_attrs}, state.ttl)
+            return user
+        state.hits += 1
+        user = User(**values)
+        make_transient_to_detached(user)
+        # load=False attaches the copy without a SELECT to check it.
+        return db.session.merge(user, load=False)
+
+    def invalidate(self, *user_ids):
+        # Sessions can commit outside an app, e.g. in scripts; other
+        # processes' caches expire by TTL anyway.
+        if user_ids and has_app_context() and 'user_cache' in current_app.extensions:
+            self.state.backend.delete(*user_ids)
+
+    def clear(self):
+        self.state.backend.clear()
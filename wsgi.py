@@ -0,0 +1,11 @@
+""" WSGI entry point for running shop24 under a production server
+
+    $ SHOP24_ENV=production SECRET_KEY=... gunicorn --workers 4 --threads 4 wsgi:app
+
+Each worker process builds its own application and connection pool.
+"""
+
+from app import create_app
+
+
+app = application = create_app()